@@ -0,0 +1,346 @@
+"""
+Benchmark suite
+
+Runs headless benchmarks with fixed seeds and reports timings as json.
+Results can be compared with a stored baseline, and slowdowns beyond a threshold are reported.
+Example:
+    python benchmark.py --output baseline.json
+    python benchmark.py --compare baseline.json --threshold 0.2
+"""
+import argparse
+import collections
+import json
+import platform
+import random
+import statistics
+import sys
+import time
+import tracemalloc
+
+import battle_utils
+from battle_utils import draw_block
+from sim.dice import RandomStream, np
+from sim.entity import Entity
+from sim.grid import Grid, Point, Tile, TERRAIN_WALL
+from sim.attackdesc import AttackDesc
+from sim.turnstate import TurnState
+import sim.events as events
+from sim.pathfinder import PathFinder, DistanceFieldCache
+from sim.runner import Scenario, run_battle
+from sim.combatlog import NULL_LOG
+import brain
+
+
+# Registered benchmarks: name -> setup function
+BENCHMARKS = collections.OrderedDict()
+
+
+def benchmark(name, number=1):
+    """
+    Register benchmark. Setup function prepares the data and returns a callable to be timed
+    :param str name: benchmark name
+    :param int number: number of calls in a single timing
+    """
+    def register(setup):
+        BENCHMARKS[name] = (setup, number)
+        return setup
+    return register
+
+
+class _BenchEntity(Entity):
+    """
+    Entity with default reach, for grid benchmarks
+    """
+    def natural_reach(self):
+        return 1
+
+    def has_reach_near(self):
+        return True
+
+    def has_reach_far(self):
+        return False
+
+
+# Grid 48x48 with rows of walls, that have gaps on alternate sides
+def draw_maze(grid):
+    for index, y in enumerate(range(4, grid.height - 4, 4)):
+        gap = 2 if index % 2 else grid.width - 4
+        draw_block(grid, TERRAIN_WALL, 0, y, gap - 1, 1)
+        draw_block(grid, TERRAIN_WALL, gap + 2, y, grid.width - gap - 2, 1)
+
+
+@benchmark('grid_construct', number=10)
+def bench_grid_construct():
+    return lambda: Grid(64, 64)
+
+
+if np is not None:
+    @benchmark('grid_construct_dense', number=10)
+    def bench_grid_construct_dense():
+        return lambda: Grid(64, 64, dense=True)
+
+
+def _setup_churn(dense):
+    generator = random.Random(1)
+    grid = Grid(64, 64, dense=dense)
+    entities = []
+    for index in range(40):
+        entity = _BenchEntity("e%d" % index)
+        entity.x = generator.randrange(64)
+        entity.y = generator.randrange(64)
+        grid.register_entity(entity)
+        entities.append(entity)
+
+    def run():
+        for entity in entities:
+            grid.unregister_entity(entity)
+            entity.x = min(63, max(0, entity.x + generator.randint(-1, 1)))
+            entity.y = min(63, max(0, entity.y + generator.randint(-1, 1)))
+            grid.register_entity(entity)
+    return run
+
+
+@benchmark('register_churn', number=10)
+def bench_register_churn():
+    return _setup_churn(False)
+
+
+if np is not None:
+    @benchmark('register_churn_dense', number=10)
+    def bench_register_churn_dense():
+        return _setup_churn(True)
+
+
+def _setup_path(maze):
+    grid = Grid(48, 48)
+    if maze:
+        draw_maze(grid)
+    pathfinder = PathFinder(grid)
+    start = Point(x=1, y=1)
+    # Center of the target tile
+    dest = Point(x=46.5, y=46.5)
+    return lambda: pathfinder.path_to_melee_range(start, dest, 0.5, 1.5)
+
+
+@benchmark('path_melee_open', number=5)
+def bench_path_open():
+    return _setup_path(False)
+
+
+@benchmark('path_melee_maze', number=5)
+def bench_path_maze():
+    return _setup_path(True)
+
+
+@benchmark('distance_field_maze', number=5)
+def bench_distance_field():
+    grid = Grid(48, 48)
+    draw_maze(grid)
+    target = _BenchEntity("target")
+    target.x = 46
+    target.y = 46
+    start = Point(x=1, y=1)
+    # New cache every time, so the field is computed from scratch
+    return lambda: DistanceFieldCache(grid).get_field(target, 1).path_from(start)
+
+
+def _make_duelists():
+    attacker = battle_utils.make_twf_fighter('A')
+    defender = battle_utils.make_angry_guisarme('B')
+    for combatant in (attacker, defender):
+        combatant.recalculate()
+        combatant.check_weapon_wield()
+    return attacker, defender
+
+
+@benchmark('generate_bab_chain', number=100)
+def bench_bab_chain():
+    attacker, defender = _make_duelists()
+    return lambda: attacker.generate_bab_chain(defender)
+
+
+@benchmark('find_best_style', number=20)
+def bench_find_best_style():
+    attacker, defender = _make_duelists()
+    return lambda: brain.find_best_style(attacker, defender)
+
+
+def _setup_battle(size, count):
+    scenario = Scenario(size, size, max_rounds=20)
+    builders = [battle_utils.make_twf_fighter, battle_utils.make_angry_guisarme, battle_utils.make_shield_fighter]
+    per_side = count // 2
+    columns = max(1, size // 4)
+    for index in range(per_side):
+        x = 1 + (index % columns) * 2
+        y = 1 + (index // columns) * 2
+        builder = builders[index % len(builders)]
+        scenario.add_combatant(builder, "red%d" % index, x, y, 'red')
+        builder = builders[(index + 1) % len(builders)]
+        scenario.add_combatant(builder, "blue%d" % index, size - 2 - x, size - 2 - y, 'blue')
+    seeds = random.Random(1)
+    return lambda: run_battle(scenario, rng=RandomStream(seeds.getrandbits(63)))
+
+
+@benchmark('battle_2', number=10)
+def bench_battle_2():
+    return _setup_battle(16, 2)
+
+
+@benchmark('battle_10', number=2)
+def bench_battle_10():
+    return _setup_battle(24, 10)
+
+
+@benchmark('battle_100')
+def bench_battle_100():
+    return _setup_battle(48, 100)
+
+
+@benchmark('alloc_objects', number=10)
+def bench_alloc_objects():
+    weapon = battle_utils.make_twf_fighter('A').get_main_weapon()
+
+    # Objects, that are created in huge numbers during the battle
+    def run():
+        return [(Point(x=index, y=index), Tile(index, index), AttackDesc(weapon, attack=index), TurnState(),
+                 events.TurnEnd(None)) for index in range(1000)]
+    return run
+
+
+@benchmark('snapshot_10', number=100)
+def bench_snapshot():
+    scenario = Scenario(24, 24)
+    for index in range(5):
+        scenario.add_combatant(battle_utils.make_twf_fighter, "red%d" % index, 1 + index * 2, 1, 'red')
+        scenario.add_combatant(battle_utils.make_angry_guisarme, "blue%d" % index, 21 - index * 2, 21, 'blue')
+    battle = scenario.create_battle(RandomStream(1), log=NULL_LOG)
+    return lambda: battle.restore_snapshot(battle.save_snapshot())
+
+
+@benchmark('nearest_enemy_500', number=10)
+def bench_nearest_enemy():
+    scenario = Scenario(96, 96)
+    positions = random.Random(1)
+    for index in range(500):
+        faction = 'red' if index % 2 else 'blue'
+        scenario.add_combatant(battle_utils.make_twf_fighter, "%s%d" % (faction, index),
+                               positions.randrange(96), positions.randrange(96), faction)
+    battle = scenario.create_battle(RandomStream(1), log=NULL_LOG)
+    combatants = battle.combatants[:100]
+    return lambda: [battle.find_enemy(combatant) for combatant in combatants]
+
+
+def run_benchmark(name, repeat=5):
+    """
+    Time a registered benchmark
+    :param str name: benchmark name
+    :param int repeat: number of timings
+    :return: dict with timings of a single call, in seconds
+    """
+    setup, number = BENCHMARKS[name]
+    run = setup()
+    timings = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        for _ in range(number):
+            run()
+        timings.append((time.perf_counter() - start) / number)
+    return {
+        'min': min(timings),
+        'median': statistics.median(timings),
+        'number': number,
+        'repeat': repeat,
+    }
+
+
+def measure_memory(name):
+    """
+    Run a registered benchmark once and measure its memory usage
+    :param str name: benchmark name
+    :return: dict with peak traced memory and memory, kept by the results, in bytes
+    """
+    setup, _ = BENCHMARKS[name]
+    run = setup()
+    tracemalloc.start()
+    try:
+        result = run()
+        current, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    del result
+    return {'peak_memory': peak, 'kept_memory': current}
+
+
+def compare(results, baseline, threshold):
+    """
+    Compare timings with baseline
+    :param dict results: current report
+    :param dict baseline: baseline report
+    :param float threshold: allowed relative slowdown, 0.2 means 20%
+    :return: list of (name, baseline time, current time, ratio, regressed)
+    """
+    rows = []
+    for name, timing in results['benchmarks'].items():
+        base = baseline['benchmarks'].get(name)
+        if base is None:
+            continue
+        ratio = timing['min'] / base['min'] if base['min'] > 0 else float('inf')
+        rows.append((name, base['min'], timing['min'], ratio, ratio > 1 + threshold))
+    return rows
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Run benchmarks and compare them with a baseline")
+    parser.add_argument('names', nargs='*', help="benchmarks to run. One of: %s" % ', '.join(BENCHMARKS))
+    parser.add_argument('--repeat', type=int, default=5, help="number of timings for each benchmark")
+    parser.add_argument('--output', help="save results as json to this file")
+    parser.add_argument('--compare', help="baseline json file to compare with")
+    parser.add_argument('--threshold', type=float, default=0.2, help="allowed relative slowdown")
+    parser.add_argument('--quick', action='store_true', help="skip slow benchmarks with 100 combatants")
+    parser.add_argument('--memory', action='store_true', help="measure memory of a single run as well")
+    args = parser.parse_args()
+
+    names = args.names or [name for name in BENCHMARKS if not (args.quick and name == 'battle_100')]
+    for name in names:
+        if name not in BENCHMARKS:
+            parser.error("Unknown benchmark '%s'" % name)
+
+    results = {
+        'python': platform.python_version(),
+        'numpy': np is not None,
+        'benchmarks': collections.OrderedDict(),
+    }
+    for name in names:
+        timing = run_benchmark(name, args.repeat)
+        results['benchmarks'][name] = timing
+        print("%-24s %10.3f ms (median %.3f ms)" % (name, timing['min'] * 1e3, timing['median'] * 1e3),
+              file=sys.stderr)
+        if args.memory:
+            memory = measure_memory(name)
+            timing.update(memory)
+            print("%-24s %10.1f KiB peak, %.1f KiB kept" % ('', memory['peak_memory'] / 1024.0,
+                                                            memory['kept_memory'] / 1024.0), file=sys.stderr)
+
+    if args.output:
+        with open(args.output, 'w') as file:
+            json.dump(results, file, indent=2)
+    else:
+        print(json.dumps(results, indent=2))
+
+    if args.compare:
+        with open(args.compare) as file:
+            baseline = json.load(file)
+        regressions = 0
+        for name, base, current, ratio, regressed in compare(results, baseline, args.threshold):
+            if regressed:
+                regressions += 1
+            print("%-24s %10.3f -> %10.3f ms  x%.2f%s" % (name, base * 1e3, current * 1e3, ratio,
+                                                        "  SLOWER" if regressed else ""), file=sys.stderr)
+        if regressions:
+            print("%d benchmarks are slower than baseline by more than %d%%" % (regressions, 100 * args.threshold),
+                  file=sys.stderr)
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -1,10 +1,18 @@
+import collections
+import itertools
 import math
 import logging
 from sim.actions import *
 from sim.combatant import *
+from sim.attackdesc import estimate_full_attack
+from sim.profile import AttackProfile
+import sim.combatlog as combatlog
+from sim.grid import Coord, get_line
+from sim.pathfinder import get_reach_tiles
 
 
 # Estimate fight probabilities against specified enemy
+# Critical hits and confirmation rolls are taken into account
 def estimate_attack_round(attacker: Combatant, defender: Combatant):
     attacks = attacker.generate_bab_chain(defender)
     total_dmg = 0
@@ -15,22 +23,109 @@ def estimate_attack_round(attacker: Combatant, defender: Combatant):
     return attacks, total_dmg
 
 
+# Estimate exact damage distribution of a full attack against specified enemy
+def estimate_attack_distribution(attacker: Combatant, defender: Combatant):
+    """
+    :return: (attacks, expected damage, Distribution of round damage)
+    """
+    attacks = attacker.generate_bab_chain(defender)
+    total_dmg, distribution = estimate_full_attack(attacks, attacker, defender)
+    return attacks, total_dmg, distribution
+
+
+# Numeric estimation of an attack round. Distribution is None, if it was not requested
+AttackEstimate = collections.namedtuple('AttackEstimate', 'damage distribution')
+
+
+# Names of active styles. Styles are compared by name
+def active_style_names(combatant):
+    return frozenset(style.name for style in combatant._active_styles)
+
+
+class ExchangeCache:
+    """
+    Bounded LRU cache for attack round estimations
+
+    Estimation is keyed by state fingerprints of attacker and defender and by their active styles,
+    so it is recalculated only when stats, items, styles or status are changed.
+    Only numbers are stored, so cached entries do not keep attack descriptions or combatants.
+    All the brains of a battle share the same cache, see Brain.get_exchange_cache.
+    """
+    def __init__(self, max_size=4096):
+        self.max_size = max_size
+        self.hits = 0
+        self.misses = 0
+        self._entries = collections.OrderedDict()
+
+    @staticmethod
+    def _calculate(attacker, defender, distribution):
+        if distribution:
+            _, damage, result = estimate_attack_distribution(attacker, defender)
+            return AttackEstimate(damage, result)
+        _, damage = estimate_attack_round(attacker, defender)
+        return AttackEstimate(damage, None)
+
+    def estimate(self, attacker: Combatant, defender: Combatant, distribution=False):
+        """
+        Cached estimation of an attack round
+        :param bool distribution: calculate distribution of round damage as well
+        :rtype: AttackEstimate
+        """
+        fp_attacker = attacker.state_fingerprint()
+        fp_defender = defender.state_fingerprint()
+        if fp_attacker is None or fp_defender is None:
+            # Transient state should not be cached
+            return self._calculate(attacker, defender, distribution)
+        key = (fp_attacker, fp_defender, active_style_names(attacker), active_style_names(defender))
+        result = self._entries.get(key)
+        if result is not None and (result.distribution is not None or not distribution):
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return result
+        self.misses += 1
+        result = self._calculate(attacker, defender, distribution)
+        self._entries[key] = result
+        self._entries.move_to_end(key)
+        if len(self._entries) > self.max_size:
+            self._entries.popitem(last=False)
+        return result
+
+    def clear(self):
+        self._entries.clear()
+
+    def __len__(self):
+        return len(self._entries)
+
+
 class StrikeExchange:
-    def __init__(self, a: Combatant, b: Combatant, data):
-        attacks_a, dmg_a = estimate_attack_round(a, b)
+    def __init__(self, a: Combatant, b: Combatant, data, cache=None):
+        """
+        :param cache: ExchangeCache for attack estimations. Estimations are recalculated if it is None
+        """
         self.a = a
-        self.attacks_a = attacks_a
+        self.b = b
+        if cache is not None:
+            dmg_a = cache.estimate(a, b).damage
+            dmg_b = cache.estimate(b, a).damage
+        else:
+            dmg_a = estimate_attack_round(a, b)[1]
+            dmg_b = estimate_attack_round(b, a)[1]
         self.dmg_a = dmg_a
         self.rounds_a = b.health / dmg_a if dmg_a > 0 else 1000
-
-        attacks_b, dmg_b = estimate_attack_round(b, a)
-        self.b = b
-        self.attacks_b = attacks_b
         self.dmg_b = dmg_b
         self.rounds_b = a.health / dmg_b if dmg_b > 0 else 1000
 
         self.data = data
 
+    # Strikes are not stored, they are generated again for printing
+    @property
+    def attacks_a(self):
+        return estimate_attack_round(self.a, self.b)[0]
+
+    @property
+    def attacks_b(self):
+        return estimate_attack_round(self.b, self.a)[0]
+
     def delta(self):
         return self.dmg_a - self.dmg_b
 
@@ -77,50 +172,155 @@ class StyleSet:
             combatant.activate_style(style)
 
     def deactivate(self, combatant: Combatant):
-        for style in self.styles:
+        for style in reversed(self.styles):
             combatant.deactivate_style(style)
 
     def __str__(self):
         return str(self.styles)
 
 
-def pick_by_bitmask(data, bitmask, max):
-    result = []
-    for i in range(0, max):
-        if bitmask & (1 << i):
-            result.append(data[i])
-    return result
+# Split known styles to groups of mutually exclusive styles.
+# Styles without exclusion group get a group of their own
+def style_groups(a: Combatant):
+    groups = collections.OrderedDict()
+    # Sorting by name makes the search order stable
+    for style in sorted(a._known_styles, key=str):
+        key = style.exclusion_group if style.exclusion_group is not None else style
+        groups.setdefault(key, []).append(style)
+    return list(groups.values())
 
 
-# Generate style variations
-def style_variations(a: Combatant):
-    style_list = list(a._known_styles)
-    max_choice = 1 << len(style_list)
+# Generate style variations. Only one style from exclusion group can be active
+def style_variations(a: Combatant, groups=None):
+    if groups is None:
+        groups = style_groups(a)
+    options = [[None] + group for group in groups]
+    for choice in itertools.product(*options):
+        yield StyleSet([style for style in choice if style is not None])
 
-    for mask in range(0, max_choice):
-        styles = pick_by_bitmask(style_list, mask, len(style_list))
-        yield StyleSet(styles)
 
+class StyleOptimizer:
+    """
+    Searches for the best style set against specified enemy
 
-def find_best_style(a: Combatant, b: Combatant):
-    best_style = None
-    best_exchange = None
-    best_score = 0
-    for variation in style_variations(a):
-
-        variation.activate(a)
-        exchange = StrikeExchange(a,b, variation)
+    Small style sets are checked exhaustively. Bigger sets are pruned: styles, that do not
+    improve damage or defence on their own, are dropped. If there are still too many variations,
+    beam search picks styles group by group, keeping only beam_width best partial sets.
+    Beam search with beam_width=1 is a greedy search.
+    """
+    def __init__(self, a: Combatant, b: Combatant, cache=None, **kwargs):
+        """
+        :param cache: ExchangeCache to skip estimations for already seen states
+        :param int max_variations: limit for exhaustive search
+        :param int beam_width: number of partial style sets, kept by beam search
+        :param str mode: 'auto', 'exhaustive' or 'beam'
+        :param CombatLog log: log for checked styles. Combat log of 'a' is used by default
+        """
+        self.a = a
+        self.b = b
+        self.cache = cache
+        self.max_variations = kwargs.get('max_variations', 64)
+        self.beam_width = kwargs.get('beam_width', 4)
+        self.mode = kwargs.get('mode', 'auto')
+        # Combat log for checked styles
+        self.log = kwargs.get('log', a.log)
+        # Number of estimated exchanges
+        self.evaluations = 0
+        self._evaluated = {}
+        # Variations are evaluated on snapshots, so live combatants are not changed
+        self._profile_a = AttackProfile.from_combatant(a)
+        self._profile_b = AttackProfile.from_combatant(b)
+
+    def evaluate(self, variation: StyleSet):
+        """
+        Estimate exchange with activated style set
+        :return: (score, exchange)
+        """
+        key = frozenset(variation.styles)
+        if key in self._evaluated:
+            return self._evaluated[key]
+        profile = self._profile_a.with_styles(*variation.styles)
+        exchange = StrikeExchange(profile, self._profile_b, variation, self.cache)
         score = exchange.score()
+        self.evaluations += 1
+
+        if self.log.enabled:
+            self.log.write(combatlog.StyleEstimate(self.a.get_name(), variation, score[0], score[1]))
+        self._evaluated[key] = (score, exchange)
+        return score, exchange
+
+    # Drop styles, that neither increase our damage, nor decrease damage of the enemy
+    def prune(self, groups):
+        _, base = self.evaluate(StyleSet([]))
+        result = []
+        for group in groups:
+            kept = []
+            for style in group:
+                _, exchange = self.evaluate(StyleSet([style]))
+                if exchange.dmg_a > base.dmg_a or exchange.dmg_b < base.dmg_b:
+                    kept.append(style)
+            if kept:
+                result.append(kept)
+        return result
 
-        print("Checking style %s. Score=%s, survive=%s" % (str(variation), str(score[0]), str(score[1])))
+    @staticmethod
+    def count_variations(groups):
+        count = 1
+        for group in groups:
+            count *= len(group) + 1
+        return count
+
+    def search_exhaustive(self, groups):
+        best = None
+        for variation in style_variations(self.a, groups):
+            score, exchange = self.evaluate(variation)
+            if best is None or score > best[0]:
+                best = (score, exchange, variation)
+        return best
+
+    def search_beam(self, groups):
+        beam = [[]]
+        best = None
+        for group in groups:
+            candidates = []
+            for styles in beam:
+                for style in [None] + group:
+                    variation = StyleSet(styles if style is None else styles + [style])
+                    score, exchange = self.evaluate(variation)
+                    candidates.append((score, exchange, variation))
+            # Stable sort keeps earlier candidates on ties
+            candidates.sort(key=lambda item: item[0], reverse=True)
+            beam = [variation.styles for _, _, variation in candidates[:self.beam_width]]
+            if best is None or candidates[0][0] > best[0]:
+                best = candidates[0]
+        return best
+
+    def find_best(self):
+        """
+        :return: (StyleSet, StrikeExchange, score)
+        """
+        groups = style_groups(self.a)
+        if self.mode == 'beam':
+            best = self.search_beam(groups)
+        elif self.mode == 'exhaustive' or self.count_variations(groups) <= self.max_variations:
+            best = self.search_exhaustive(groups)
+        else:
+            groups = self.prune(groups)
+            if self.count_variations(groups) <= self.max_variations:
+                best = self.search_exhaustive(groups)
+            else:
+                best = self.search_beam(groups)
+        score, exchange, variation = best
+        return variation, exchange, score
 
-        variation.deactivate(a)
-        if best_style is None or score > best_score:
-            best_style = variation
-            best_exchange = exchange
-            best_score = score
 
-    return best_style, best_exchange, best_score
+def find_best_style(a: Combatant, b: Combatant, cache=None, **kwargs):
+    """
+    :param cache: ExchangeCache to skip estimations for already seen states
+    :param kwargs: search parameters, see StyleOptimizer
+    :return: (StyleSet, StrikeExchange, score)
+    """
+    return StyleOptimizer(a, b, cache, **kwargs).find_best()
 
 
 class Brain(object):
@@ -139,26 +339,41 @@ class Brain(object):
         self._allow_move = True
         self._allow_attack = True
         self._allow_spells = True
-        self._pathfinder = None
 
     @property
     def slave(self):
         return self._slave
 
+    def save_state(self):
+        """
+        Save decisions, that are kept between turns
+        """
+        return self.target, self.path
+
+    def restore_state(self, state):
+        self.target, self.path = state
+
+    # Get estimations of strike exchanges for style selection. They are shared by all the brains of the battle
+    @staticmethod
+    def get_exchange_cache(battle):
+        if battle.exchange_cache is None:
+            battle.exchange_cache = ExchangeCache()
+        return battle.exchange_cache
+
     def on_attach_to_grid(self, grid):
-        if self._pathfinder is None:
-            self._pathfinder = PathFinder(grid)
-        else:
-            self._pathfinder.sync_grid(grid)
+        # Brains use pathfinders of the battle, see Battle.distance_fields
+        pass
 
     # Prepare to start a turn
     # Used for selecting fighting styles, activating feats and so on
     def prepare_turn(self, battle):
         # Trying iteratively use all turn actions
         if self.find_enemy_target(battle):
-            style, exchange, score = find_best_style(self.slave, self.target)
-            print("Best style %s provides %s damage" % (str(style), str(score)))
-            print(str(exchange))
+            style, exchange, score = find_best_style(self.slave, self.target, self.get_exchange_cache(battle))
+            log = self.slave.log
+            if log.enabled:
+                log.write(combatlog.StyleChoice(self.slave.get_name(), self.target.get_name(), style,
+                                                score[0], score[1], exchange.dmg_a, exchange.dmg_b))
 
     # Brain make its turn right here
     def make_turn(self, battle):
@@ -200,7 +415,8 @@ class Brain(object):
     def respond_provocation(self, battle, target: Combatant, action=None):
         state = self.get_turn_state()
         if self.slave.opportunities_left() > 0 and state.attack_AoO is not None:
-            print("%s uses opportunity to attack %s" % (self.slave.get_name(), target.get_name()))
+            if self.slave.log.enabled:
+                self.slave.log.write(combatlog.Opportunity(self.slave.get_name(), target.get_name()))
             desc = self.slave.calculate_attack_of_opportunity(target)
             yield from self.slave.do_action_strike(battle, desc)
 
@@ -208,25 +424,33 @@ class Brain(object):
         return self.slave.get_turn_state()
 
     # Estimate fight probabilities against specified enemy
+    # Estimation is used only by the combat log, so it is skipped when the log is disabled
     def estimate_battle(self, enemy: Combatant):
-        attacks = self.slave.generate_bab_chain(enemy)
+        log = self.slave.log
+        if not log.enabled:
+            return
+        # Profile keeps pending bonus strikes of the combatant
+        attacks = AttackProfile.from_combatant(self.slave).generate_bab_chain(enemy)
         total_dmg = 0
-        strikes = []
         for strike in attacks:
             dam, prob = strike.estimated_damage(self.slave, enemy)
             total_dmg += dam
-            strikes.append("prob=%d;dam=%0.3f"%(100*prob,dam))
-        print("Estimated strikes=[%s]. Round damage=%.2f" % (str(strikes), total_dmg))
+        log.write(combatlog.DamageEstimate(self.slave.get_name(), enemy.get_name(), len(attacks), total_dmg))
 
     def find_enemy_target(self, battle, force = False):
         if self.target is None or force:
             self.target = battle.find_enemy(self.slave)
             if self.target is not None:
-                print("%s found enemy: %s" % (self.slave.get_name(), str(self.target)))
+                if self.slave.log.enabled:
+                    self.slave.log.write(combatlog.TargetFound(self.slave.get_name(), self.target.get_name()))
                 self.estimate_battle(self.target)
                 return True
         return False
 
+    def log_no_targets(self):
+        if self.slave.log.enabled:
+            self.slave.log.write(combatlog.TargetFound(self.slave.get_name(), None))
+
     def can_attack(self, target):
         weapon = self.slave.get_main_weapon()
         if weapon.is_ranged():
@@ -253,26 +477,21 @@ class Brain(object):
         # There are some ways to make ranged trip
         return slave.get_main_weapon().can_trip() or slave.has_status_flag(STATUS_HAS_IMPROVED_TRIP)
 
-    def check_straight_path(self, start_pos, dest):
-        self._pathfinder.check_straight_path(start_pos, dest)
-
-    def sync_pathfinder(self, combatant, battle):
-        additional_range = 2
-        distance = combatant.max_sense_range()/5 + additional_range
-        left = combatant.x - distance
-        top = combatant.y - distance
-        right = combatant.x + distance
-        bottom = combatant.y + distance
+    # Find straight path for a charge: the line to the target ends at its first tile, where target is in reach
+    def check_straight_path(self, battle, start_pos, target):
+        size = self.slave.get_size()
+        reach_tiles = set(get_reach_tiles(target, self.slave.total_reach(), size))
+        for x, y in get_line((start_pos.x, start_pos.y), (target.x, target.y))[1:]:
+            if (x, y) in reach_tiles:
+                return battle.distance_fields.get_pathfinder(size).check_straight_path(start_pos, Coord(x, y))
+        return None
 
-        self._pathfinder.attach_grid(battle.grid, left, top, right, bottom)
-
-    def path_to_melee_range(self, target, attack_range):
-        near = target.get_size() * 0.5
-        far = target.get_size() * 0.5 + attack_range
-        pos_src = self.slave.get_coord()
-        pos_target = target.get_center()
-        path = self._pathfinder.path_to_melee_range(pos_src, pos_target, near, far)
-        return path
+    # Find path to melee range of the target
+    # Distance field to the target is shared with all the brains in the battle
+    def path_to_melee_range(self, battle, target, attack_range):
+        with battle.profile('pathfinding', self.slave):
+            field = battle.distance_fields.get_field(target, attack_range, self.slave.get_size())
+            return field.path_from(self.slave.get_coord())
 
 
 # Brain for simple movement and attacking
@@ -284,13 +503,12 @@ class MoveAttackBrain(Brain):
         state = self.get_turn_state()
 
         if self.target is None:
-            print("%s has no targets" % self.slave.get_name())
+            self.log_no_targets()
             return
 
         no_charge = False
 
         while not state.complete():
-            self.sync_pathfinder(self.slave, battle)
             if self.slave.has_status_flag(STATUS_PRONE):
                 yield StandUpAction(self.slave)
 
@@ -298,15 +516,13 @@ class MoveAttackBrain(Brain):
 
             # Use all the attacks
             if self.target.is_consciousness():
-                if self.in_charge_range(self.target) and not no_charge:
-                    # Pick best tile for charging
-                    self.sync_pathfinder(self.slave, battle)
-                    path = self.check_straight_path(self.slave.get_coord(), self.target.get_coord())
+                if self.in_charge_range(self.target) and not no_charge and not self.can_attack(self.target):
+                    # Charge is tried only once per turn
+                    no_charge = True
+                    path = self.check_straight_path(battle, self.slave.get_coord(), self.target)
                     if path is not None:
                         yield from self.slave.do_action_charge(battle, state, self.target, path)
                         continue
-                    else:
-                        no_charge = True
                 # 2. If enemy is in range - full round attack
                 elif self.can_attack(self.target):
                     self.logger.debug("target is near, can attack")
@@ -322,15 +538,23 @@ class MoveAttackBrain(Brain):
                 break
 
             if state.can_move_distance() and self.target is not None and need_move:
-                self.logger.debug("target %s is away. Finding path" % self.target.name)
-                path = self.path_to_melee_range(self.target, self.slave.total_reach())
-                if path is not None:
-                    self.logger.debug("found path of %d feet length" % path.length())
+                self.logger.debug("target %s is away. Finding path", self.target.name)
+                path = self.path_to_melee_range(battle, self.target, self.slave.total_reach())
+                if path is not None and path.count() == 0:
+                    # Already in the destination area, but still can not attack
+                    break
+                elif path is not None:
+                    self.logger.debug("found path of %d feet length", path.length())
                     yield from self.slave.do_action_move_tiles(battle, state, path)
                 else:
-                    print("No path is found")
+                    if self.slave.log.enabled:
+                        self.slave.log.write(combatlog.PathNotFound(self.slave.get_name(), self.target.get_name()))
+                    break
+            elif need_move:
+                # Target can not be reached in this turn
+                break
 
-        self.logger.debug("%s has done thinking" % self.slave.name)
+        self.logger.debug("%s has done thinking", self.slave.name)
 
 
 # Brain that attacks only if enemy is adjacent
@@ -346,7 +570,7 @@ class StandAttackBrain(Brain):
         self.find_enemy_target(battle)
 
         if self.target is None:
-            print("%s has no targets" % self.slave.get_name())
+            self.log_no_targets()
             return
 
         if self.slave.has_status_flag(STATUS_PRONE):
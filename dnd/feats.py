@@ -23,6 +23,20 @@ class BasicCombat(Feat):
         combatant.allow_effect_activation(styles.StyleDefenciveFight())
 
 
+class CombatExpertise(Feat):
+    """
+    Combat expertise
+    Requirements: INT 13
+    Attack penalty of up to 5 is traded for the same dodge bonus to AC
+    """
+    def __init__(self):
+        Feat.__init__(self, "CombatExpertise")
+
+    def apply(self, combatant):
+        for value in range(1, 6):
+            combatant.allow_effect_activation(styles.StyleCombatExpertise(value), self)
+
+
 class TwoWeaponFighting(Feat):
     def __init__(self):
         Feat.__init__(self, "twf1")
@@ -254,7 +268,7 @@ class InsightfulStrike(Feat):
         def event(c, desc: AttackDesc):
             mod = c.intellect_modifier()
             if mod > 0:
-                desc.damage.add_die(1, mod)
+                desc.damage = desc.damage + mod
         combatant.event_manager.on_calc_attack += event
 
 
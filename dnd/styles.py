@@ -53,3 +53,31 @@ class StyleFlurryOfBlows(Combatant.StatusEffect):
 
     def __str__(self):
         return "flurry_blows"
+
+
+class StyleCombatExpertise(Combatant.StatusEffect):
+    """
+    Combat expertise: penalty on attack rolls is added as a dodge bonus to AC.
+    Every penalty value is a separate style, so they share the exclusion group
+    """
+    def __init__(self, value):
+        super(StyleCombatExpertise, self).__init__("Combat expertise %d" % value)
+        self.value = value
+        self.applied = 0
+        self.exclusion_group = 'combat_expertise'
+
+    # Called when effect has started
+    def on_start(self, combatant, **kwargs):
+        # Penalty can not exceed base attack bonus
+        self.applied = max(0, min(self.value, combatant._BAB))
+        combatant._attack_bonus_style -= self.applied
+        combatant.modify_ac_dodge(self.applied)
+
+    # Called when effect has finished
+    def on_finish(self, combatant, **kwargs):
+        combatant._attack_bonus_style += self.applied
+        combatant.modify_ac_dodge(-self.applied)
+        self.applied = 0
+
+    def __str__(self):
+        return "combat_expertise%d" % self.value
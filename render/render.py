@@ -40,6 +40,7 @@ class Renderer:
     def __init__(self, battle, offset=0):
         pygame.init()
         grid = battle.grid
+        self._grid = grid
         self._tiler = Tiler(grid.get_width(), grid.get_height(), 32, 'data/peasanttiles02.png')
         self._modeller = ModelDrawer(32, 'data/RPGCharacterSprites32x32_alpha.png', model_desc)
         self.grid_top = offset
@@ -189,7 +190,7 @@ class Renderer:
             self.draw_path(u.path)
 
         if self._draw_threaten:
-            for tile in u.threatened_tiles:
+            for tile in self._grid.get_threatened_tiles(u):
                 coord_cur = self.grid_to_screen((tile.x + 0.5, tile.y + 0.5))
                 pygame.draw.line(self.surface, RED, coord, coord_cur)
 
@@ -3,6 +3,7 @@ from .battle import *
 from .core import *
 import animation
 import sim.events as events
+import sim.combatlog as combatlog
 from .turnstate import TurnState
 
 ACTION_RESULT_SUCCESS = 0
@@ -228,7 +229,10 @@ class MoveAction(BattleAction):
         combatant = self._combatant
         distance = self.cost()
 
-        print("moving %s at %s from %s to %s, moves=%d, tiles=%d" % (str(combatant), str(combatant.get_coord()), str(combatant.get_coord()), str(self._finish), distance, len(self._path)))
+        log = battle.log
+        if log.enabled:
+            log.write(combatlog.Move(combatant.get_name(), combatant.x, combatant.y, self._finish.x, self._finish.y,
+                                     distance, len(self._path)))
         # AoO can interupt movement
         # 5ft step still can provoke
         # Not moving still can provoke
@@ -239,12 +243,7 @@ class MoveAction(BattleAction):
         if not success:
             return False
 
-        battle.grid.unregister_entity(combatant)
-
-        combatant.x = self._finish.x
-        combatant.y = self._finish.y
-
-        battle.grid.register_entity(combatant)
+        battle.move_combatant(combatant, self._finish.x, self._finish.y)
         yield events.AnimationEvent(animation.MovePath(combatant, self.regular_path))
         combatant.fix_visual()
         state.use_action(combatant, ACTION_TYPE_MOVE, distance=distance)
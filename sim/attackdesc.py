@@ -1,5 +1,6 @@
-import copy
+import functools
 import sim.item
+from .core import roll_hits
 from .dice import *
 
 
@@ -17,6 +18,10 @@ class AttackDesc:
     :type damage: Dice
     :type bonus_damage: Dice
     """
+    __slots__ = ('attack', 'damage', 'bonus_damage', 'prob', 'damage_multiplier', 'critical_confirm_bonus',
+                 'two_handed', 'weapon', 'touch', 'target', 'opportunity', 'spell', 'ranged', 'offhand', 'range',
+                 'provoke', 'method', 'check', 'check_success')
+
     def __init__(self, weapon: sim.item.Weapon, **kwargs):
         self.attack = kwargs.get('attack', 0)
         self.damage = kwargs.get('damage', Dice())
@@ -57,7 +62,10 @@ class AttackDesc:
         return self.ranged
 
     def copy(self):
-        return copy.copy(self)
+        result = AttackDesc.__new__(AttackDesc)
+        for name in AttackDesc.__slots__:
+            setattr(result, name, getattr(self, name))
+        return result
 
     def text(self):
         dmg_min, dmg_max = self.damage.get_range()
@@ -75,11 +83,11 @@ class AttackDesc:
         return self.attack + result, result
     '''
 
-    def roll_damage(self):
-        return self.damage.roll()
+    def roll_damage(self, stream=None):
+        return self.damage.roll(stream)
 
-    def roll_bonus_damage(self):
-        return self.bonus_damage.roll()
+    def roll_bonus_damage(self, stream=None):
+        return self.bonus_damage.roll(stream)
 
     # Calculates hit probability
     def hit_probability(self, armor_class):
@@ -90,13 +98,40 @@ class AttackDesc:
             delta = 19
         return delta / 20.0
 
+    # Get armor class of the target against this attack
+    def target_armor_class(self, source, target):
+        return target.get_touch_armor_class(source) if self.touch else target.get_armor_class(source)
+
+    def crit_multiplier(self):
+        return self.weapon.crit_mult if self.weapon is not None else 1
+
+    def hit_chances(self, armor_class):
+        """
+        Exact chances to hit and to land a confirmed critical hit.
+        Resolved the same way as do_action_strike does: critical hit needs a hit,
+        a threat roll and a confirmation roll with critical_confirm_bonus
+        :param int armor_class: armor class of the target
+        :return: (hit probability, critical hit probability)
+        """
+        return _hit_chances(self.attack, self.critical_confirm_bonus, armor_class,
+                            self.weapon.crit_range if self.weapon is not None else 0)
+
+    def damage_distribution(self, armor_class):
+        """
+        Exact damage distribution of the strike, including misses and critical hits.
+        Critical hit multiplies weapon damage, but not bonus damage
+        :param int armor_class: armor class of the target
+        :rtype: Distribution
+        """
+        hit, crit = self.hit_chances(armor_class)
+        return strike_distribution(self.damage, self.bonus_damage, self.crit_multiplier(), hit, crit)
+
     # Calculate estimated damage per round
     def estimated_damage(self, source, target):
-        ac = target.get_touch_armor_class(source) if self.touch else target.get_armor_class(source)
-        prob = self.hit_probability(ac)
-        # TODO: calculate critical damage bonus
-        damage = self.damage.mean() + self.bonus_damage.mean()
-        return prob * damage, prob
+        prob, crit = self.hit_chances(self.target_armor_class(source, target))
+        damage = self.damage.mean()
+        damage = prob * (damage + self.bonus_damage.mean()) + crit * damage * (self.crit_multiplier() - 1)
+        return damage, prob
 
     def is_critical(self, roll):
         return self.weapon.is_critical(roll)
@@ -116,3 +151,132 @@ class AttackDesc:
 
     def __repr__(self):
         return self.text()
+
+
+@functools.lru_cache(maxsize=4096)
+def _hit_chances(attack, confirm_bonus, armor_class, crit_range):
+    hits = 0
+    threats = 0
+    confirms = 0
+    for roll in range(1, 21):
+        if roll_hits(attack, roll, armor_class):
+            hits += 1
+            if roll > 20 - crit_range:
+                threats += 1
+        if roll_hits(attack + confirm_bonus, roll, armor_class):
+            confirms += 1
+    return hits / 20.0, threats * confirms / 400.0
+
+
+@functools.lru_cache(maxsize=4096)
+def strike_distribution(damage, bonus_damage, crit_mult, hit, crit):
+    """
+    Damage distribution of a single strike. Results are memoized
+    :param Dice damage: weapon damage, multiplied by critical hit
+    :param Dice bonus_damage: bonus damage, like sneak attack
+    :param int crit_mult: critical multiplier
+    :param float hit: hit probability, including critical hits
+    :param float crit: critical hit probability
+    :rtype: Distribution
+    """
+    weapon = damage.distribution()
+    bonus = bonus_damage.distribution()
+    if hit <= 0:
+        return Distribution.constant(0)
+    on_hit = weapon + bonus
+    if crit > 0:
+        # Critical hits are a part of all the hits
+        on_hit = on_hit.mix(weapon.scale(crit_mult) + bonus, crit / hit)
+    return Distribution.constant(0).mix(on_hit, hit)
+
+
+def estimate_full_attack(attacks, source, target):
+    """
+    Analytic estimation of a full attack, like generate_bab_chain sequence.
+    Strikes are independent, so total damage is a sum of strike damages
+    :param attacks: list of AttackDesc
+    :param source: attacking combatant
+    :param target: defending combatant
+    :return: (expected damage, Distribution of total damage)
+    """
+    total = Distribution.constant(0)
+    for desc in attacks:
+        total = total + desc.damage_distribution(desc.target_armor_class(source, target))
+    return total.mean(), total
+
+
+def generate_attack(owner, attack, weapon, target, handlers, **kwargs):
+    """
+    Fill in attack for specified weapon and wield. Shared by Combatant and AttackProfile
+    :param owner: attacking Combatant or AttackProfile
+    :param attack: attack bonus, bab+circumstances
+    :param weapon: used weapon
+    :param target: attack target. Can be unavailable at this stage
+    :param handlers: on_calc_attack handlers, that get the owner and generated attack
+    :param kwargs: additional parameters
+    :rtype: AttackDesc generated attack description
+    """
+    damage = weapon.damage(owner, target)
+    damage_mod = 0
+    str_mod = owner.strength_modifier()
+
+    two_handed = owner._two_hand_wield
+    ranged = weapon.is_ranged()
+
+    if weapon.is_light(owner) and not two_handed:
+        damage_mod += int(str_mod / 2)
+    elif two_handed:
+        damage_mod += int(str_mod * 1.5)
+    else:
+        damage_mod += int(str_mod)
+
+    if damage_mod != 0:
+        damage = damage + int(damage_mod)
+
+    if kwargs.get('offhand', False):
+        attack -= 4
+
+    if weapon.is_ranged():
+        attack += owner.dexterity_modifier()
+    else:
+        attack += owner.strength_modifier()
+
+    # For all effects
+    desc = AttackDesc(weapon, attack=attack, damage=damage, two_handed=two_handed, ranged=ranged, **kwargs)
+    for handler in handlers:
+        handler(owner, desc)
+    return desc
+
+
+def generate_bab_chain(owner, target=None, **kwargs):
+    """
+    Generate strikes of full attack action from BAB: iterative main hand strikes and an offhand strike.
+    Bonus strikes are added by the owner
+    :param owner: attacking Combatant or AttackProfile
+    :param target: target to be attacked
+    :return: list of AttackDesc
+    """
+    attack_chain = []
+    bab = owner._BAB
+    weapon = owner.get_main_weapon()
+
+    weapon_offhand = owner.get_offhand_weapon()
+    attack_bonus_style = owner._attack_bonus_style
+
+    """
+    Two weapon fighting:
+    Normal penalties: Main -6     Offhand -10
+    Offhand is light: Main -4     Offhand -8    -> add +2 to both attacks
+    Two-weapon fighting: Main -4    Offhand -4  -> add +2 to main and +6 to offhand
+    """
+    # Get attacks from main slot
+    while bab >= 0:
+        attack = bab + attack_bonus_style
+        attack_chain.append(owner.generate_attack(attack, weapon, target, **kwargs))
+        bab -= 5
+
+    if owner._many_weapon_wield:
+        attack = owner._BAB + attack_bonus_style
+        desc = owner.generate_attack(attack, weapon_offhand, target, offhand=True, **kwargs)
+        attack_chain.append(desc)
+    return attack_chain
@@ -2,14 +2,33 @@ import types
 from .dice import *
 from .core import *
 from sim.grid import Tile, Grid
-from sim.pathfinder import PathFinder
+from sim.pathfinder import PathFinder, DistanceFieldCache
+from sim.spatial import SpatialIndex
 from .combatant import Combatant, AttackDesc
 from .turnstate import TurnState
+from .profiler import NULL_SECTION
+from .combatlog import CombatLog, PrintSink
+import sim.combatlog as combatlog
 
 import sim.actions
 import sim.events as events
 
 
+class BattleSnapshot(object):
+    """
+    Saved dynamic state of a battle: round, random stream, combatant list and states of the combatants.
+    Static data, like grid terrain, feats, items and brains, is not copied, so the snapshot
+    is restored to the battle it was taken from. Save and restore take time proportional to the state size
+    """
+    __slots__ = ('round', 'rng_state', 'combatants', 'states')
+
+    def __init__(self, round, rng_state, combatants, states):
+        self.round = round
+        self.rng_state = rng_state
+        self.combatants = combatants
+        self.states = states
+
+
 class Battle(object):
     NEXT_ACTION = 1
     """
@@ -19,23 +38,105 @@ class Battle(object):
     :type _combatants: Combatant[]
     :type round: int - Current round
     """
-    def __init__(self, grid_width, grid_height):
+    def __init__(self, grid_width, grid_height, **kwargs):
         """
         Creates an instance of a battle.
+
+        :param int grid_width: Width of battle grid
+        :param int grid_height: Height of battle grid
+        :param bool dense: Use dense (numpy) grid storage
+        :param int seed: Seed for battle random stream
+        :param RandomStream rng: Random stream for all the rolls in the battle. Created from seed if not specified
+        :param Profiler profiler: Profiler for turn processing phases. Profiling is disabled if it is None
+        :param CombatLog log: Combat log. Records are printed to stdout if it is not specified
+        :param int spatial_cell: Size of spatial index buckets, in tiles
         """
-        self._grid = Grid(grid_width, grid_height)
+        self._grid = Grid(grid_width, grid_height, dense=kwargs.get('dense', False))
+        self._rng = kwargs.get('rng', None)
+        if self._rng is None:
+            self._rng = RandomStream(kwargs.get('seed', None))
         #self.pathfinder = PathFinder(self.grid)
+        # Distance fields, shared by all brains
+        self._distance_fields = DistanceFieldCache(self._grid)
+        # Estimations of strike exchanges, shared by all brains. Created by the first brain, that needs it
+        self.exchange_cache = None
         self._combatants = []
+        # Positions of combatants, for proximity queries
+        self._spatial = SpatialIndex(kwargs.get('spatial_cell', 4))
         self.round = 0
+        self._profiler = None
+        self.set_profiler(kwargs.get('profiler', None))
+        self._log = None
+        self.set_log(kwargs.get('log', None))
 
     @property
     def grid(self):
         return self._grid
 
+    @property
+    def profiler(self):
+        return self._profiler
+
+    def set_profiler(self, profiler):
+        """
+        :param Profiler profiler: profiler, or None to disable profiling
+        """
+        self._profiler = profiler
+        self._grid.profiler = profiler
+
+    @property
+    def log(self):
+        return self._log
+
+    def set_log(self, log):
+        """
+        :param CombatLog log: combat log for all the combatants. Records are printed if it is None
+        """
+        self._log = log if log is not None else CombatLog(PrintSink())
+        if self._log.enabled:
+            seed = self._rng.seed
+            self._log.write(combatlog.BattleStart(self._grid.width, self._grid.height, seed if seed is not None else -1))
+        for combatant in self._combatants:
+            combatant.set_log(self._log)
+            self._log_spawn(combatant)
+
+    # Write initial state of the combatant to the log, so the battle can be replayed from it
+    def _log_spawn(self, combatant):
+        log = self._log
+        if not log.enabled:
+            return
+        name = combatant.get_name()
+        log.write(combatlog.Spawn(name, combatant.get_faction(), combatant.x, combatant.y,
+                                  combatant.health, combatant.health_max))
+        for status in sorted(combatant._status_flags):
+            log.write(combatlog.StatusFlag(name, status, True))
+
+    def profile(self, phase, combatant=None):
+        """
+        Get context manager, that times a phase of turn processing
+        :param str phase: phase name
+        :param combatant: processed combatant
+        """
+        if self._profiler is None:
+            return NULL_SECTION
+        return self._profiler.section(phase, combatant)
+
+    @property
+    def rng(self):
+        return self._rng
+
+    @property
+    def distance_fields(self):
+        return self._distance_fields
+
     @property
     def combatants(self):
         return self._combatants
 
+    @property
+    def spatial(self):
+        return self._spatial
+
     def add_combatant(self, combatant, x, y, **kwargs):
         """
         Adds a combatant to the battle. This is typically a Character or a Monster.
@@ -51,13 +152,17 @@ class Battle(object):
             return
 
         combatant.set_faction(kwargs.get('faction', 'none'))
+        combatant.set_rng(self._rng)
+        combatant.set_log(self._log)
         combatant.x = x
         combatant.y = y
         combatant.recalculate()
         self._combatants.append(combatant)
         self.grid.register_entity(combatant)
+        self._spatial.insert(combatant)
         combatant.on_attach_to_grid(self.grid)
         combatant.on_turn_start(self, False)
+        self._log_spawn(combatant)
 
         combatant.fix_visual()
 
@@ -67,6 +172,63 @@ class Battle(object):
         """
         self._combatants.remove(combatant)
         self.grid.unregister_entity(combatant)
+        self._spatial.remove(combatant)
+
+    def move_combatant(self, combatant, x, y):
+        """
+        Move combatant to another tile. Grid occupancy and spatial index are updated
+        :param Combatant combatant: moving combatant
+        :param int x: destination x
+        :param int y: destination y
+        """
+        self._grid.unregister_entity(combatant)
+        combatant.x = x
+        combatant.y = y
+        self._grid.register_entity(combatant)
+        self._spatial.move(combatant)
+
+    def save_snapshot(self):
+        """
+        Save state of the battle between turns
+        :rtype: BattleSnapshot
+        """
+        combatants = tuple(self._combatants)
+        return BattleSnapshot(self.round, self._rng.get_state(), combatants,
+                              tuple(combatant.save_state() for combatant in combatants))
+
+    def restore_snapshot(self, snapshot):
+        """
+        Rewind the battle to the snapshot. Grid occupancy is updated for the combatants, that have moved
+        Combat log is append-only, so it is not rewound
+        :param BattleSnapshot snapshot: snapshot, taken from this battle
+        """
+        grid = self._grid
+        current = set(self._combatants)
+        saved = set(snapshot.combatants)
+        for combatant in self._combatants:
+            if combatant not in saved:
+                grid.unregister_entity(combatant)
+        for combatant, state in zip(snapshot.combatants, snapshot.states):
+            attached = combatant in current
+            # Position goes first in combatant state
+            moved = not attached or combatant.x != state[0] or combatant.y != state[1]
+            if attached and moved:
+                grid.unregister_entity(combatant)
+            combatant.restore_state(state)
+            if moved:
+                grid.register_entity(combatant)
+                combatant.fix_visual()
+        self._combatants[:] = snapshot.combatants
+        if current == saved:
+            for combatant in self._combatants:
+                self._spatial.move(combatant)
+        else:
+            # Keep insertion order of the index same as order of combatants
+            self._spatial.clear()
+            for combatant in self._combatants:
+                self._spatial.insert(combatant)
+        self.round = snapshot.round
+        self._rng.set_state(snapshot.rng_state)
 
     def print_characters(self):
         for ch in self._combatants:
@@ -74,12 +236,18 @@ class Battle(object):
 
     # Gather attacks of opportunity, provoked by combatant, standing at specified tile
     def get_threatening_enemies(self, combatant: Combatant, action):
-        opportunity_attacks = []
-        is_enemy = lambda a: self.is_combatant_enemy(a, combatant) and combatant.opportunities_left() > 0
+        if combatant.opportunities_left() <= 0:
+            return []
+
+        if self._grid.dense:
+            return self._grid.get_hostile_threateners(combatant.x, combatant.y, combatant.get_size(),
+                                                      combatant.get_faction())
 
+        opportunity_attacks = []
         for tile in combatant.tiles_threatened_by_enemies():
-            for attacker in filter(is_enemy, tile.threaten):
-                opportunity_attacks.append(attacker)
+            for attacker in tile.threaten:
+                if attacker not in opportunity_attacks and self.is_combatant_enemy(attacker, combatant):
+                    opportunity_attacks.append(attacker)
         return opportunity_attacks
 
     def execute_combatant_action(self, action, state):
@@ -102,8 +270,12 @@ class Battle(object):
         # Hard limit on action generator
         iteration_limit = 20
 
+        actions = combatant.gen_brain_actions(self)
+        if self._profiler is not None:
+            actions = self._profiler.wrap_generator(actions, 'make_turn', combatant)
+
         # Iterate through all combatant actions during the turn
-        for action in combatant.gen_brain_actions(self):
+        for action in actions:
             yield from self.execute_combatant_action(action, state)
 
             iteration_limit -= 1
@@ -126,7 +298,10 @@ class Battle(object):
         while True:
             dead = []
             self.round += 1
-            print("======================================\nStarting round %d" % self.round)
+            if self._profiler is not None:
+                self._profiler.round = self.round
+            if self._log.enabled:
+                self._log.write(combatlog.RoundStart(self.round))
             for combatant in self._combatants:
                 if combatant.is_dead():
                     dead.append(combatant)
@@ -141,39 +316,55 @@ class Battle(object):
                 else:
                     yield from self.combatant_make_turn(combatant)
 
+            if self._log.enabled:
+                self._log.write(combatlog.RoundEnd(self.round))
             yield events.RoundEnd(self.round)
 
-
-        print(" ----==== Round %d is complete ====---- " % self.round)
-
     # Check if object is enemy
     def is_combatant_enemy(self, char_a, char_b):
         if char_a == char_b:
             return False
         return self.is_faction_enemy(char_a.get_faction(),char_b.get_faction())
 
+    # Dense grid threat layers follow the same rule: any other faction is hostile
     def is_faction_enemy(self, faction_a, faction_b):
         return faction_a != faction_b
 
-    # Find best enemy
+    # Find best enemy. It is the nearest conscious enemy
     def find_enemy(self, char):
-        enemies = []
-        for combatant in self._combatants:
-            if combatant.is_consciousness() and self.is_combatant_enemy(char, combatant):
-                enemies.append(combatant)
+        enemies = self.nearest_enemies(char, 1)
+        return enemies[0] if enemies else None
 
-        if len(enemies) > 0:
-            # TODO: filter enemies by range
-            return enemies[0]
-        return None
+    def nearest_enemies(self, char, count):
+        """
+        Get nearest conscious enemies. Distance is measured between centers, like melee reach
+        :param Combatant char: combatant, looking for enemies
+        :param int count: maximum number of enemies
+        :return: list of enemies, from the nearest one
+        """
+        center = char.get_center()
+        return self._spatial.nearest(center.x, center.y, count,
+                                     lambda other: other.is_consciousness() and self.is_combatant_enemy(char, other))
+
+    def find_enemies(self, char, distance):
+        """
+        Get conscious enemies within specified distance
+        :param Combatant char: combatant, looking for enemies
+        :param float distance: distance between centers, in feet
+        :return: list of enemies, from the nearest one
+        """
+        center = char.get_center()
+        # Tile is 5 feet
+        return self._spatial.within(center.x, center.y, distance / 5.0,
+                                    lambda other: other.is_consciousness() and self.is_combatant_enemy(char, other))
 
     # Roll initiative for all the objects
     def roll_initiative(self):
-        print("Rolling new initiative order")
         for combatant in self._combatants:
             combatant.reset_round()
-            initiative = combatant.current_initiative() + d20.roll()
-            print(combatant, "rolls %d for initiative" % initiative)
+            initiative = combatant.current_initiative() + d20.roll(self._rng)
+            if self._log.enabled:
+                self._log.write(combatlog.Initiative(combatant.get_name(), initiative))
             self._combatants.update_priority(combatant, initiative)
 
     # TODO: Get rid of it
@@ -186,12 +377,16 @@ class Battle(object):
     def tile_threatened(self, tile, combatant):
         if tile is None:
             return False
+        if self._grid.dense:
+            return self._grid.hostile_threats(tile.x, tile.y, combatant.get_faction()) > 0
         for u in tile.threaten:
             if self.is_combatant_enemy(u, combatant):
                 return True
         return False
 
     def position_threatened(self, combatant, x, y):
+        if self._grid.dense:
+            return self._grid.area_threatened(x, y, combatant.get_size(), combatant.get_faction())
         dx = x - combatant.x
         dy = y - combatant.y
         for tile in combatant.occupied_tiles:
@@ -202,6 +397,13 @@ class Battle(object):
 
     ############## Action generators ################
     def provoke_opportunity(self, combatant, action, exclude=[]):
+        if self._profiler is not None:
+            yield from self._profiler.wrap_generator(self._provoke_opportunity(combatant, action, exclude),
+                                                     'provoke_opportunity', combatant)
+        else:
+            yield from self._provoke_opportunity(combatant, action, exclude)
+
+    def _provoke_opportunity(self, combatant, action, exclude):
         enemies = self.get_threatening_enemies(combatant, action)
         for enemy in enemies:
             if enemy not in exclude:
@@ -147,7 +147,7 @@ class Character(Combatant):
         :rtype: int
         """
         skill = self.skill_with_name(skill_name)
-        return d20.roll() + skill.level + self.ability_modifier(skill.ability)
+        return d20.roll(self.rng) + skill.level + self.ability_modifier(skill.ability)
 
     def has_learned_skill(self, skill_name):
         """
@@ -3,11 +3,15 @@ from sim.dice import *
 import sim.item
 from .entity import Entity
 import copy
+import itertools
 import animation
 
 from .attackdesc import AttackDesc
+import sim.attackdesc
 from sim.events import AnimationEvent
 from .turnstate import TurnState
+from .combatlog import NULL_LOG
+import sim.combatlog as combatlog
 
 
 class CustomAction(object):
@@ -52,6 +56,19 @@ class SubscriberList:
         for handler in self._subscribers:
             handler(*args, **kwargs)
 
+    def __iter__(self):
+        return iter(self._subscribers)
+
+
+# Copy a value of combatant state. Containers are copied shallowly
+def _copy_state_value(value):
+    kind = type(value)
+    if kind is list or kind is set or kind is dict:
+        return kind(value)
+    if kind is TurnState:
+        return value.copy()
+    return value
+
 
 class Combatant(Entity):
     """
@@ -117,6 +134,8 @@ class Combatant(Entity):
         def __init__(self, name):
             self._duration = -1
             self._name = name
+            # Only one style from the same exclusion group can be active, like different power attack values
+            self.exclusion_group = None
 
         # Get effect name
         @property
@@ -142,6 +161,21 @@ class Combatant(Entity):
         def update(self, combatant):
             pass
 
+        # Save own state of the effect, like applied bonuses. Used by Combatant.save_state
+        def save_state(self):
+            return {name: _copy_state_value(value) for name, value in vars(self).items()}
+
+        def restore_state(self, state):
+            for name, value in state.items():
+                setattr(self, name, _copy_state_value(value))
+
+        # Get a private copy of the effect with the same state.
+        # What-if estimations apply the copy, so the shared effect is not changed
+        def copy(self):
+            result = object.__new__(type(self))
+            vars(result).update(self.save_state())
+            return result
+
         def __repr__(self):
             return str(self)
 
@@ -249,6 +283,10 @@ class Combatant(Entity):
 
         self._feats = []
         self._events = Combatant.EventManager()
+        # Random stream for all the rolls. Battle provides its own stream
+        self._rng = None
+        # Combat log. Battle provides its own log
+        self._log = NULL_LOG
 
         # Current path. For visualization
         self.path = None
@@ -291,6 +329,30 @@ class Combatant(Entity):
         # There can be some penalties for skill usage. Maybe we cut result by events?
         return result
 
+    # Random stream for the rolls of this combatant
+    @property
+    def rng(self):
+        if self._rng is None:
+            return get_default_stream()
+        return self._rng
+
+    def set_rng(self, stream):
+        """
+        :param RandomStream stream: random stream, or None to use the default one
+        """
+        self._rng = stream
+
+    # Combat log for the records about this combatant
+    @property
+    def log(self):
+        return self._log
+
+    def set_log(self, log):
+        """
+        :param CombatLog log: combat log, or None to drop the records
+        """
+        self._log = log if log is not None else NULL_LOG
+
     @property
     def event_manager(self):
         """
@@ -303,10 +365,14 @@ class Combatant(Entity):
         return status in self._status_flags
 
     def add_status_flag(self, status):
+        if self._log.enabled and status not in self._status_flags:
+            self._log.write(combatlog.StatusFlag(self.name, status, True))
         self._status_flags.add(status)
 
     def remove_status_flag(self, status):
         self._status_flags.remove(status)
+        if self._log.enabled:
+            self._log.write(combatlog.StatusFlag(self.name, status, False))
 
     # Recalculate internal data
     def recalculate(self):
@@ -384,7 +450,8 @@ class Combatant(Entity):
         self._opportunities_used = []
         self._events.on_turn_start(self)
         if brain:
-            self._brain.prepare_turn(battle)
+            with battle.profile('prepare_turn', self):
+                self._brain.prepare_turn(battle)
 
         return state
 
@@ -452,12 +519,11 @@ class Combatant(Entity):
         self._events.on_get_hit(self, source, damage)
         self._health -= damage
 
-        print("%s damages %s for %d damage, %d HP left" % (source.name, self.name, damage, self._health))
-
-        if self._health <= -10:
-            print("%s is dead" % self.name)
-        elif self._health < 0:
-            print("%s is unconsciousness" % self.name)
+        log = self._log
+        if log.enabled:
+            log.write(combatlog.Damage(source.name, self.name, damage, self._health))
+            if self._health < 0:
+                log.write(combatlog.Fall(self.name, self._health <= -10))
         return self._health
 
     def update_effects(self):
@@ -465,6 +531,49 @@ class Combatant(Entity):
             effect.update(self)
 
     # Link brain
+    # Attributes, that change during the battle. They are saved by save_state
+    STATE_FIELDS = ('x', 'y', 'path', '_health', '_health_temporary', '_status_flags', '_effects', '_resources',
+                    '_stats', '_AC', '_ac_armor', '_ac_dodge', '_ac_natural', '_ac_deflection', '_max_dex_ac',
+                    '_save_fort_bonus', '_save_ref_bonus', '_save_will_bonus',
+                    '_current_initiative', '_move_speed_bonus', '_move_penalty',
+                    '_attack_bonus_style', '_damage_bonus_style', '_two_hand_wield', '_many_weapon_wield',
+                    '_additional_strikes', '_opportunities_used', '_active_styles', '_turn_state')
+
+    # Styles and effects of the combatant. Effects are compared by name, so duplicates are found by identity
+    def _stateful_effects(self):
+        result = []
+        seen = set()
+        for effect in itertools.chain(self._active_styles, self._effects):
+            if id(effect) not in seen:
+                seen.add(id(effect))
+                result.append(effect)
+        return result
+
+    def save_state(self):
+        """
+        Save dynamic state of the combatant: position, hit points, status flags, effects, style modifiers,
+        pending strikes and turn state. Containers are copied, objects inside them are shared.
+        Active styles and effects keep their own state, like applied bonuses, so it is saved as well.
+        Feats, items and event handlers do not change during the battle, so they are not saved
+        :return: tuple of values
+        """
+        values = [_copy_state_value(getattr(self, name)) for name in Combatant.STATE_FIELDS]
+        values.append(tuple((effect, effect.save_state()) for effect in self._stateful_effects()))
+        values.append(self._brain.save_state() if self._brain is not None else None)
+        return tuple(values)
+
+    def restore_state(self, state):
+        """
+        Restore state, saved by save_state. The same state can be restored many times
+        Grid registration is not updated, battle does it
+        """
+        for name, value in zip(Combatant.STATE_FIELDS, state):
+            setattr(self, name, _copy_state_value(value))
+        for effect, effect_state in state[len(Combatant.STATE_FIELDS)]:
+            effect.restore_state(effect_state)
+        if self._brain is not None:
+            self._brain.restore_state(state[-1])
+
     def set_brain(self, brain):
         if brain == self._brain:
             return
@@ -591,6 +700,25 @@ class Combatant(Entity):
     def health_max(self):
         return self._health_max
 
+    def state_fingerprint(self):
+        """
+        Get a cheap hashable fingerprint of the state, that affects attack estimation:
+        stats, equipped items, feat names, active styles and effects, status flags, BAB and AC components.
+        Health is not included.
+        Combatants with equal fingerprints generate the same attack chains.
+        :return: tuple, or None if the state is transient, i.e. there are pending bonus strikes,
+        which are consumed by generate_bab_chain
+        """
+        if self._additional_strikes:
+            return None
+        return (tuple(self._stats), self._size_type, self._BAB,
+                self._attack_bonus_style, self._damage_bonus_style,
+                self._two_hand_wield, self._many_weapon_wield,
+                self._AC, self._ac_armor, self._ac_dodge, self._ac_natural, self._ac_deflection, self._max_dex_ac,
+                frozenset(self._status_flags),
+                tuple(sorted(self._equipped.items(), key=lambda pair: pair[0])),
+                tuple(feat.name for feat in self._feats), tuple(self._active_styles), tuple(self._effects))
+
     # Add bonus attack, from feat, style or status effect
     def add_bonus_strike(self, weapon, immediate=False, **kwargs):
         attack = kwargs.pop('attack', 0)
@@ -622,35 +750,7 @@ class Combatant(Entity):
         :param kwargs: additional parameters
         :rtype: AttackDesc generated attack description
         """
-        damage = weapon.damage(self, target)
-        damage_mod = 0
-        str_mod = self.strength_modifier()
-
-        two_handed = self._two_hand_wield
-        ranged = weapon.is_ranged()
-
-        if weapon.is_light(self) and not two_handed:
-            damage_mod += int(str_mod / 2)
-        elif two_handed:
-            damage_mod += int(str_mod * 1.5)
-        else:
-            damage_mod += int(str_mod)
-
-        if damage_mod != 0:
-            damage.add_die(1, int(damage_mod))
-
-        if kwargs.get('offhand', False):
-            attack -= 4
-
-        if weapon.is_ranged():
-            attack += self.dexterity_modifier()
-        else:
-            attack += self.strength_modifier()
-
-        # For all effects
-        desc = AttackDesc(weapon, attack=attack, damage=damage, two_handed=two_handed, ranged=ranged, **kwargs)
-        self._events.on_calc_attack(self, desc)
-        return desc
+        return sim.attackdesc.generate_attack(self, attack, weapon, target, self._events.on_calc_attack, **kwargs)
 
     def check_weapon_wield(self):
         """
@@ -674,35 +774,12 @@ class Combatant(Entity):
 
     def generate_bab_chain(self, target=None, **kwargs):
         """
-        Generate attack chain for full attack action
+        Generate attack chain for full attack action. Pending bonus strikes are consumed
 
         :param target: target to be attacked
         :return: list of AttackDesc
         """
-        attack_chain = []
-        bab = self._BAB
-        weapon = self.get_main_weapon()
-
-        weapon_offhand = self.get_offhand_weapon()
-        attack_bonus_style = self._attack_bonus_style
-
-        """
-        Two weapon fighting:
-        Normal penalties: Main -6     Offhand -10
-        Offhand is light: Main -4     Offhand -8    -> add +2 to both attacks
-        Two-weapon fighting: Main -4    Offhand -4  -> add +2 to main and +6 to offhand
-        """
-        # Get attacks from main slot
-        while bab >= 0:
-            attack = bab + attack_bonus_style
-            attack_chain.append(self.generate_attack(attack, weapon, target, **kwargs))
-            bab -= 5
-
-        if self._many_weapon_wield:
-            attack = self._BAB + attack_bonus_style
-            desc = self.generate_attack(attack, weapon_offhand, target, offhand=True, **kwargs)
-            attack_chain.append(desc)
-
+        attack_chain = sim.attackdesc.generate_bab_chain(self, target, **kwargs)
         attack_chain.extend(self._additional_strikes)
         self._additional_strikes = []
         return attack_chain
@@ -791,7 +868,7 @@ class Combatant(Entity):
 
         :rtype: int
         """
-        return d20.roll() + self.dexterity_modifier()
+        return d20.roll(self.rng) + self.dexterity_modifier()
 
     def resource_remaining(self, resource_type):
         return self._resources.get(resource_type, 0)
@@ -847,7 +924,8 @@ class Combatant(Entity):
         target = desc.get_target()
         armor_class = self._set_attack_target(desc, target)
 
-        roll, crit_confirm_roll = d20.roll(), d20.roll()
+        rng = self.rng
+        roll, crit_confirm_roll = d20.roll(rng), d20.roll(rng)
 
         # Roll for critical confirmation
         has_crit = False
@@ -863,22 +941,22 @@ class Combatant(Entity):
         elif desc.is_ranged():
             yield AnimationEvent(animation.RangedAttack(self, target))
 
-        attack_text = "misses"
+        result = combatlog.ATTACK_MISS
         total_damage = 0
 
         if hit:
-            damage = desc.roll_damage()
-            bonus_damage = desc.roll_bonus_damage()
+            damage = desc.roll_damage(rng)
+            bonus_damage = desc.roll_bonus_damage(rng)
             if has_crit:
                 damage *= desc.weapon.crit_mult
-                attack_text = "critically hits"
+                result = combatlog.ATTACK_CRITICAL
             else:
-                attack_text = "hits"
+                result = combatlog.ATTACK_HIT
             total_damage = damage + bonus_damage
             self._on_attack_hit(desc)
 
-        print("%s %s %s with roll %s" %
-              (self.name, attack_text, target.get_name(), desc.attack_roll_info(roll, armor_class)))
+        if self._log.enabled:
+            self._log.write(combatlog.AttackRoll(self.name, target.get_name(), result, roll, desc.attack, armor_class))
         if hit:
             target.receive_damage(damage, self)
 
@@ -893,7 +971,7 @@ class Combatant(Entity):
         # Make d20 roll. There are some feats that allow to reroll result
         # TODO: Brain also can alter some decisions as well
         self._events
-        return d20.roll()
+        return d20.roll(self.rng)
 
     # Execute trip attack  action
     # All data is already set. Attack can be resolved right now
@@ -929,23 +1007,25 @@ class Combatant(Entity):
 
         yield AnimationEvent(animation.MeleeAttackStart(self, target))
 
-        roll_info = desc.attack_roll_info(roll_attack, armor_class)
+        result = combatlog.TRIP_MISS
+        check = opposed_roll = 0
 
         if hit:
             roll_trip = self._make_roll_d20()
             opposed_roll = target._make_roll_d20(source=self, attack=desc)
-            if roll_trip + desc.check > opposed_roll:
-                attack_text = "trips"
+            check = roll_trip + desc.check
+            if check > opposed_roll:
+                result = combatlog.TRIP_SUCCESS
                 desc.check_success = True
                 target.add_status_flag(STATUS_PRONE)
-                print("%s trips %s with roll %s" % (self.name, target.get_name(), roll_info))
             else:
-                print("%s fails to trip %s with roll %s" % (self.name, target.get_name(), roll_info))
+                result = combatlog.TRIP_FAIL
 
             self._on_attack_hit(desc)
-            print("%s rolls %d, %s rolls %d" % (self.name, roll_trip+desc.check, target.get_name(), opposed_roll))
-        else:
-            print("%s misses its trip attack %s with roll %s" % (self.name, target.get_name(), roll_info))
+
+        if self._log.enabled:
+            self._log.write(combatlog.TripAttack(self.name, target.get_name(), result, roll_attack, desc.attack,
+                                                 armor_class, check, opposed_roll))
 
         self.expend_attack(desc)
 
@@ -971,6 +1051,9 @@ class Combatant(Entity):
                 yield sim.actions.MoveAction(self, tiles_moved)
                 tiles_moved = []
                 traveled = 0
+                # Move actions can be expended by the previous steps
+                if not state.can_move_distance():
+                    break
 
             traveled += cost
             if traveled >= state.moves_left:
@@ -993,7 +1076,7 @@ class Combatant(Entity):
         # [0,1,2,3,4,5,6]
         # [0,0,0,T,T,0,0]
         # Moves: 0->3, 3->4, 4->6
-        waypoints = copy.copy(path)
+        waypoints = list(path.get_path())
         while len(waypoints) > 0:
             tile = waypoints.pop(0)
             cost = 5
@@ -1002,6 +1085,9 @@ class Combatant(Entity):
                 yield sim.actions.MoveAction(self, tiles_moved)
                 tiles_moved = []
                 traveled = 0
+                # Move actions can be expended by the previous steps
+                if not state.can_move_distance():
+                    break
 
             traveled += cost
             if traveled >= state.moves_left:
@@ -0,0 +1,443 @@
+"""
+Structured combat log
+
+Battle code writes typed records to a CombatLog instead of printing text: attack rolls, damage,
+moves, attacks of opportunity, style choices and so on. The log passes records to a sink:
+    - NullSink drops everything. Writers check CombatLog.enabled, so records are not even created
+    - PrintSink prints records as text, like the old console log
+    - RingBufferSink packs records into a fixed size binary buffer, keeping only the latest ones
+    - JsonlSink writes a json object per record
+Text is formatted only when a record is read, by CombatLog.lines or by PrintSink.
+
+Writers should look like this:
+    log = battle.log
+    if log.enabled:
+        log.write(combatlog.Damage(source.name, target.name, damage, health))
+"""
+import collections
+import json
+import struct
+import sys
+
+import sim.core as core
+
+
+# Registered record types: code -> record class
+RECORD_TYPES = {}
+# Record name -> record class
+RECORD_NAMES = {}
+
+# Field kinds and their binary format:
+# 's' - string, stored as an index in the string table. Other values are converted with str()
+# 'i' - integer
+# 'q' - 64 bit integer
+# 'f' - float
+# 'b' - boolean
+_KIND_FORMAT = {'s': 'I', 'i': 'i', 'q': 'q', 'f': 'd', 'b': '?'}
+
+# Results of an attack roll
+ATTACK_MISS = 0
+ATTACK_HIT = 1
+ATTACK_CRITICAL = 2
+
+# Results of a trip attack
+TRIP_MISS = 0
+TRIP_FAIL = 1
+TRIP_SUCCESS = 2
+
+
+def record(code, kinds):
+    """
+    Register record type
+    :param int code: unique record code for binary encoding
+    :param str kinds: kinds of record fields, one letter for each field
+    """
+    def register(cls):
+        if code in RECORD_TYPES:
+            raise ValueError("Record code %d is used by %s" % (code, RECORD_TYPES[code].__name__))
+        if len(kinds) != len(cls._fields):
+            raise ValueError("Record %s has %d fields, but %d kinds" % (cls.__name__, len(cls._fields), len(kinds)))
+        cls.code = code
+        cls.kinds = kinds
+        cls.layout = struct.Struct('<B' + ''.join(_KIND_FORMAT[kind] for kind in kinds))
+        RECORD_TYPES[code] = cls
+        RECORD_NAMES[cls.__name__] = cls
+        return cls
+    return register
+
+
+class LogRecord(object):
+    """
+    Base for log records. Records are named tuples, so they are cheap to create
+    """
+    __slots__ = ()
+    code = 0
+    kinds = ''
+    layout = None
+
+    def format(self):
+        """
+        Get text representation of the record
+        :rtype: str
+        """
+        return repr(self)
+
+    def to_dict(self):
+        result = {'type': type(self).__name__}
+        result.update(zip(self._fields, self))
+        return result
+
+    @staticmethod
+    def from_dict(data):
+        """
+        Restore record from a dict, made by to_dict
+        :rtype: LogRecord
+        """
+        cls = RECORD_NAMES[data['type']]
+        return cls(*[data[field] for field in cls._fields])
+
+
+@record(1, 'i')
+class RoundStart(LogRecord, collections.namedtuple('RoundStart', 'round')):
+    __slots__ = ()
+
+    def format(self):
+        return "======================================\nStarting round %d" % self.round
+
+
+@record(2, 'i')
+class RoundEnd(LogRecord, collections.namedtuple('RoundEnd', 'round')):
+    __slots__ = ()
+
+    def format(self):
+        return " ----==== Round %d is complete ====---- " % self.round
+
+
+@record(3, 'si')
+class Initiative(LogRecord, collections.namedtuple('Initiative', 'combatant initiative')):
+    __slots__ = ()
+
+    def format(self):
+        return "%s rolls %d for initiative" % (self.combatant, self.initiative)
+
+
+@record(4, 'ssiiii')
+class AttackRoll(LogRecord, collections.namedtuple('AttackRoll', 'attacker target result roll attack armor_class')):
+    __slots__ = ()
+
+    def format(self):
+        if self.result == ATTACK_CRITICAL:
+            text = "critically hits"
+        elif self.result == ATTACK_HIT:
+            text = "hits"
+        else:
+            text = "misses"
+        return "%s %s %s with roll %d(r%d%+d) vs AC=%d" % (self.attacker, text, self.target,
+                                                          self.attack + self.roll, self.roll, self.attack,
+                                                          self.armor_class)
+
+
+@record(5, 'ssiiiiii')
+class TripAttack(LogRecord, collections.namedtuple('TripAttack', 'attacker target result roll attack armor_class '
+                                                                 'check opposed')):
+    __slots__ = ()
+
+    def format(self):
+        roll_info = "%d(r%d%+d) vs AC=%d" % (self.attack + self.roll, self.roll, self.attack, self.armor_class)
+        if self.result == TRIP_MISS:
+            return "%s misses its trip attack %s with roll %s" % (self.attacker, self.target, roll_info)
+        text = "trips" if self.result == TRIP_SUCCESS else "fails to trip"
+        return "%s %s %s with roll %s\n%s rolls %d, %s rolls %d" % (self.attacker, text, self.target, roll_info,
+                                                                    self.attacker, self.check,
+                                                                    self.target, self.opposed)
+
+
+@record(6, 'ssii')
+class Damage(LogRecord, collections.namedtuple('Damage', 'source target damage health')):
+    __slots__ = ()
+
+    def format(self):
+        return "%s damages %s for %d damage, %d HP left" % (self.source, self.target, self.damage, self.health)
+
+
+@record(7, 'sb')
+class Fall(LogRecord, collections.namedtuple('Fall', 'combatant dead')):
+    """
+    Combatant is dead or unconscious
+    """
+    __slots__ = ()
+
+    def format(self):
+        return "%s is %s" % (self.combatant, "dead" if self.dead else "unconscious")
+
+
+@record(8, 'siiiifi')
+class Move(LogRecord, collections.namedtuple('Move', 'combatant x y dest_x dest_y distance tiles')):
+    __slots__ = ()
+
+    def format(self):
+        return "moving %s from (%d, %d) to (%d, %d), moves=%d, tiles=%d" % self
+
+
+@record(9, 'ss')
+class Opportunity(LogRecord, collections.namedtuple('Opportunity', 'attacker target')):
+    __slots__ = ()
+
+    def format(self):
+        return "%s uses opportunity to attack %s" % (self.attacker, self.target)
+
+
+@record(10, 'ss')
+class TargetFound(LogRecord, collections.namedtuple('TargetFound', 'combatant target')):
+    """
+    Brain has picked a target. Target is None if there are no enemies
+    """
+    __slots__ = ()
+
+    def format(self):
+        if self.target is None:
+            return "%s has no targets" % self.combatant
+        return "%s found enemy: %s" % (self.combatant, self.target)
+
+
+@record(11, 'ssif')
+class DamageEstimate(LogRecord, collections.namedtuple('DamageEstimate', 'combatant target strikes damage')):
+    __slots__ = ()
+
+    def format(self):
+        return "%s estimates %d strikes against %s. Round damage=%.2f" % (self.combatant, self.strikes,
+                                                                          self.target, self.damage)
+
+
+@record(12, 'ssfb')
+class StyleEstimate(LogRecord, collections.namedtuple('StyleEstimate', 'combatant style score survive')):
+    """
+    Style set is checked by style search
+    """
+    __slots__ = ()
+
+    def format(self):
+        return "Checking style %s. Score=%s, survive=%s" % (self.style, self.score, self.survive)
+
+
+@record(13, 'sssfbff')
+class StyleChoice(LogRecord, collections.namedtuple('StyleChoice', 'combatant target style score survive '
+                                                                   'damage_dealt damage_taken')):
+    __slots__ = ()
+
+    def format(self):
+        return "%s picks style %s against %s. Score=%s, round damage %.2f vs %.2f" % (
+            self.combatant, self.style, self.target, self.score, self.damage_dealt, self.damage_taken)
+
+
+@record(14, 'ss')
+class PathNotFound(LogRecord, collections.namedtuple('PathNotFound', 'combatant target')):
+    __slots__ = ()
+
+    def format(self):
+        return "%s has found no path to %s" % (self.combatant, self.target)
+
+
+@record(15, 'iiq')
+class BattleStart(LogRecord, collections.namedtuple('BattleStart', 'width height seed')):
+    """
+    Battle is created. Seed is -1 if the random stream was seeded from OS entropy
+    """
+    __slots__ = ()
+
+    def format(self):
+        return "Battle on %dx%d grid with seed %d" % self
+
+
+@record(16, 'ssiiii')
+class Spawn(LogRecord, collections.namedtuple('Spawn', 'combatant faction x y health health_max')):
+    """
+    Combatant is added to the battle
+    """
+    __slots__ = ()
+
+    def format(self):
+        return "%s joins %s at (%d, %d) with %d/%d HP" % self
+
+
+@record(17, 'sib')
+class StatusFlag(LogRecord, collections.namedtuple('StatusFlag', 'combatant status enabled')):
+    __slots__ = ()
+
+    def format(self):
+        return "%s %s %s" % (self.combatant, "gets" if self.enabled else "loses", status_name(self.status))
+
+
+# Get name of a status flag from sim.core, like 'PRONE'
+def status_name(status):
+    for name, value in vars(core).items():
+        if name.startswith('STATUS_') and name != 'STATUS_LAST' and value == status:
+            return name[len('STATUS_'):]
+    return str(status)
+
+
+class NullSink(object):
+    """
+    Sink that drops all the records
+    """
+    enabled = False
+
+    def write(self, record):
+        pass
+
+    def records(self):
+        return iter(())
+
+    def close(self):
+        pass
+
+
+class PrintSink(object):
+    """
+    Prints records as text
+    """
+    enabled = True
+
+    def __init__(self, file=None):
+        """
+        :param file: text stream. Current sys.stdout is used if it is None
+        """
+        self.file = file
+
+    def write(self, record):
+        print(record.format(), file=self.file if self.file is not None else sys.stdout)
+
+    # Printed records can not be read back
+    def records(self):
+        return iter(())
+
+    def close(self):
+        pass
+
+
+class RingBufferSink(object):
+    """
+    Keeps the latest records in a binary ring buffer of fixed size.
+    Every record takes a slot of the same size. Strings are stored in a string table
+    """
+    enabled = True
+
+    def __init__(self, capacity=4096):
+        """
+        :param int capacity: maximum number of stored records
+        """
+        self.capacity = capacity
+        self.slot_size = max(cls.layout.size for cls in RECORD_TYPES.values())
+        self._buffer = bytearray(capacity * self.slot_size)
+        # Total number of written records
+        self.written = 0
+        # Index 0 is reserved for None
+        self._strings = [None]
+        self._string_ids = {None: 0}
+
+    def _intern(self, value):
+        index = self._string_ids.get(value)
+        if index is None:
+            if not isinstance(value, str):
+                return self._intern(str(value))
+            index = len(self._strings)
+            self._strings.append(value)
+            self._string_ids[value] = index
+        return index
+
+    def write(self, record):
+        values = [self._intern(value) if kind == 's' else value for kind, value in zip(record.kinds, record)]
+        offset = (self.written % self.capacity) * self.slot_size
+        record.layout.pack_into(self._buffer, offset, record.code, *values)
+        self.written += 1
+
+    def __len__(self):
+        return min(self.written, self.capacity)
+
+    def records(self):
+        """
+        Decode stored records, from the oldest to the latest
+        """
+        strings = self._strings
+        for index in range(max(0, self.written - self.capacity), self.written):
+            offset = (index % self.capacity) * self.slot_size
+            cls = RECORD_TYPES[self._buffer[offset]]
+            values = cls.layout.unpack_from(self._buffer, offset)[1:]
+            yield cls(*[strings[value] if kind == 's' else value for kind, value in zip(cls.kinds, values)])
+
+    def clear(self):
+        self.written = 0
+
+    def close(self):
+        pass
+
+
+class JsonlSink(object):
+    """
+    Writes records as json objects, one per line
+    """
+    enabled = True
+
+    def __init__(self, path):
+        """
+        :param str path: output file path
+        """
+        self.path = path
+        self._file = open(path, 'w')
+
+    def write(self, record):
+        values = [str(value) if kind == 's' and value is not None else value
+                  for kind, value in zip(record.kinds, record)]
+        data = {'type': type(record).__name__}
+        data.update(zip(record._fields, values))
+        self._file.write(json.dumps(data))
+        self._file.write('\n')
+
+    def records(self):
+        """
+        Read records back from the file
+        """
+        self._file.flush()
+        with open(self.path) as file:
+            for line in file:
+                if line.strip():
+                    yield LogRecord.from_dict(json.loads(line))
+
+    def close(self):
+        self._file.close()
+
+
+class CombatLog(object):
+    """
+    Combat log, that passes records to a sink
+    """
+    def __init__(self, sink=None):
+        """
+        :param sink: record sink. Records are dropped if it is None
+        """
+        self.sink = sink if sink is not None else NullSink()
+        # Writers check this flag before creating a record
+        self.enabled = self.sink.enabled
+
+    def write(self, record):
+        self.sink.write(record)
+
+    def records(self):
+        """
+        Iterate stored records, if the sink can read them back
+        """
+        return self.sink.records()
+
+    def lines(self):
+        """
+        Iterate text of stored records
+        """
+        for item in self.records():
+            yield item.format()
+
+    def close(self):
+        self.sink.close()
+
+
+# Log that drops everything
+NULL_LOG = CombatLog(NullSink())
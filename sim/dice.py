@@ -1,4 +1,308 @@
+import contextlib
+import functools
+import itertools
+import math
 import random
+import re
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+
+class RandomStream(object):
+    """
+    Source of random numbers for dice rolls
+
+    Every battle owns its stream, so a battle can be reproduced from its seed, and parallel
+    simulations get independent streams. Uses numpy PCG64 generator with a buffer of pre-drawn
+    uniform numbers, or random.Random if numpy is not available.
+    """
+    # Number of values, drawn from numpy generator at once
+    BUFFER_SIZE = 1024
+
+    def __init__(self, seed=None):
+        """
+        :param seed: int seed. Stream is seeded from OS entropy if it is None
+        """
+        self._seed = seed
+        self._buffer = []
+        self._index = 0
+        if np is not None:
+            self._generator = np.random.Generator(np.random.PCG64(seed))
+            self.random = self._random_buffered
+        else:
+            self._generator = random.Random(seed)
+            self.random = self._generator.random
+
+    @property
+    def seed(self):
+        return self._seed
+
+    def get_state(self):
+        """
+        Get state of the stream, that can be restored by set_state
+        """
+        if np is not None:
+            # Buffer is replaced as a whole, so it can be shared with the state
+            return self._generator.bit_generator.state, self._buffer, self._index
+        return self._generator.getstate()
+
+    def set_state(self, state):
+        """
+        Restore state of the stream
+        :param state: state, returned by get_state
+        """
+        if np is not None:
+            self._generator.bit_generator.state, self._buffer, self._index = state
+        else:
+            self._generator.setstate(state)
+
+    # Underlying generator: numpy.random.Generator or random.Random
+    @property
+    def generator(self):
+        return self._generator
+
+    # Get uniform number from [0, 1)
+    def _random_buffered(self):
+        index = self._index
+        if index >= len(self._buffer):
+            self._buffer = self._generator.random(self.BUFFER_SIZE).tolist()
+            index = 0
+        self._index = index + 1
+        return self._buffer[index]
+
+    def randint(self, low, high):
+        """
+        Get random integer from [low, high] range
+        """
+        return low + int(self.random() * (high - low + 1))
+
+    def roll(self, sides, count=1):
+        """
+        Roll a number of dice with the same sides
+        :param int sides: number of sides. Dice with a single side is a constant modifier
+        :param int count: number of dice. Negative count subtracts the dice
+        :return:int sum of the rolls
+        """
+        if sides <= 1:
+            return count
+        if count < 0:
+            return -self.roll(sides, -count)
+        random = self.random
+        result = 0
+        for _ in range(count):
+            result += int(random() * sides) + 1
+        return result
+
+
+# Stream for the rolls outside of a battle, like character generation
+_default_stream = RandomStream()
+
+
+def get_default_stream():
+    return _default_stream
+
+
+def set_default_stream(stream):
+    """
+    Replace stream for the rolls without explicit stream
+    :param RandomStream stream: new stream
+    :return: previous stream
+    """
+    global _default_stream
+    previous = _default_stream
+    _default_stream = stream
+    return previous
+
+
+@contextlib.contextmanager
+def using_stream(stream):
+    """
+    Temporarily use the stream for all the rolls without explicit stream
+    """
+    previous = set_default_stream(stream)
+    try:
+        yield stream
+    finally:
+        set_default_stream(previous)
+
+
+class Distribution(object):
+    """
+    Probability mass function of an integer value
+
+    Keeps probabilities for all values in [min, max] range
+    """
+    def __init__(self, offset, probabilities):
+        """
+        :param int offset: value for the first probability
+        :param probabilities: probabilities for values offset, offset+1, ...
+        """
+        self._offset = offset
+        self._pmf = tuple(probabilities)
+
+    # Distribution of a constant value
+    @staticmethod
+    def constant(value):
+        return Distribution(value, (1.0,))
+
+    @property
+    def min(self):
+        return self._offset
+
+    @property
+    def max(self):
+        return self._offset + len(self._pmf) - 1
+
+    def probability(self, value):
+        index = value - self._offset
+        if 0 <= index < len(self._pmf):
+            return self._pmf[index]
+        return 0.0
+
+    def items(self):
+        """
+        :return: generator of (value, probability)
+        """
+        for index, p in enumerate(self._pmf):
+            yield self._offset + index, p
+
+    def mean(self):
+        return sum(value * p for value, p in self.items())
+
+    def variance(self):
+        mean = self.mean()
+        return sum((value - mean) ** 2 * p for value, p in self.items())
+
+    def std(self):
+        return math.sqrt(self.variance())
+
+    def prob_at_least(self, value):
+        """
+        Probability P(X >= value)
+        """
+        index = max(value - self._offset, 0)
+        return sum(self._pmf[index:])
+
+    def percentile(self, q):
+        """
+        Get the smallest value v, where P(X <= v) >= q
+        :param float q: probability in [0, 1]
+        """
+        total = 0.0
+        for value, p in self.items():
+            total += p
+            # Small tolerance for accumulated rounding errors
+            if total >= q - 1e-12:
+                return value
+        return self.max
+
+    def __add__(self, other):
+        """
+        Distribution of a sum of independent values
+        :param other: Distribution or int
+        """
+        if isinstance(other, int):
+            return Distribution(self._offset + other, self._pmf)
+        return Distribution(self._offset + other._offset, _convolve(self._pmf, other._pmf))
+
+    __radd__ = __add__
+
+    def __neg__(self):
+        return Distribution(-self.max, reversed(self._pmf))
+
+    def __sub__(self, other):
+        return self + (-other)
+
+    def scale(self, factor):
+        """
+        Distribution of value*factor, like damage of a critical hit
+        :param int factor: positive multiplier
+        """
+        pmf = [0.0] * ((len(self._pmf) - 1) * factor + 1)
+        for index, p in enumerate(self._pmf):
+            pmf[index * factor] = p
+        return Distribution(self._offset * factor, pmf)
+
+    def mix(self, other, weight):
+        """
+        Distribution, that takes other value with probability weight
+        :param Distribution other: another distribution
+        :param float weight: probability of other value
+        """
+        offset = min(self._offset, other._offset)
+        size = max(self.max, other.max) - offset + 1
+        pmf = [0.0] * size
+        for value, p in self.items():
+            pmf[value - offset] += p * (1 - weight)
+        for value, p in other.items():
+            pmf[value - offset] += p * weight
+        return Distribution(offset, pmf)
+
+    def __eq__(self, other):
+        return isinstance(other, Distribution) and self._offset == other._offset and self._pmf == other._pmf
+
+    def __hash__(self):
+        return hash((self._offset, self._pmf))
+
+    def __repr__(self):
+        return "Distribution(%d..%d, mean=%.2f)" % (self.min, self.max, self.mean())
+
+
+def _convolve(a, b):
+    result = [0.0] * (len(a) + len(b) - 1)
+    for i, pa in enumerate(a):
+        if pa == 0:
+            continue
+        for j, pb in enumerate(b):
+            result[i + j] += pa * pb
+    return result
+
+
+@functools.lru_cache(maxsize=None)
+def dice_distribution(sides, count):
+    """
+    Distribution of a sum of count dice with the same sides. Results are memoized
+    :param int sides: number of sides. Dice with a single side is a constant modifier
+    :param int count: number of dice. Negative count subtracts the dice
+    :return: Distribution
+    """
+    if sides <= 1 or count == 0:
+        return Distribution.constant(count if sides == 1 else 0)
+    if count < 0:
+        return -dice_distribution(sides, -count)
+    if count == 1:
+        return Distribution(1, [1.0 / sides] * sides)
+    # Reusing distributions for halves
+    half = count // 2
+    return dice_distribution(sides, half) + dice_distribution(sides, count - half)
+
+
+@functools.lru_cache(maxsize=None)
+def keep_distribution(sides, count, keep):
+    """
+    Distribution of a sum of kept dice, like 4d6kh3. Results are memoized
+    :param int sides: number of sides
+    :param int count: number of rolled dice
+    :param int keep: number of highest dice to keep, or number of lowest dice if it is negative
+    :return: Distribution
+    """
+    total = float(sides ** count)
+    counts = {}
+    # Iterating sorted outcomes with their number of permutations
+    for outcome in itertools.combinations_with_replacement(range(1, sides + 1), count):
+        permutations = math.factorial(count)
+        for value in set(outcome):
+            permutations //= math.factorial(outcome.count(value))
+        value = sum(outcome[count - keep:]) if keep > 0 else sum(outcome[:-keep])
+        counts[value] = counts.get(value, 0) + permutations
+    offset = min(counts)
+    pmf = [0.0] * (max(counts) - offset + 1)
+    for value, number in counts.items():
+        pmf[value - offset] = number / total
+    return Distribution(offset, pmf)
 
 
 class Dice(object):
@@ -6,31 +310,50 @@ class Dice(object):
     """
     implements multiple dice
 
-    :type dice: Die[]
+    Dice are immutable and hashable. Dice, compiled by compile_dice, are interned:
+    the same expression shares one object.
+
+    :type _dice: tuple - (sides, count) pairs. Dice with a single side is a flat modifier,
+    negative count subtracts the dice
+    :type _keep: tuple - (sides, count, keep) for groups like 4d6kh3. Negative keep means lowest dice
     """
+    __slots__ = ('_dice', '_keep', '_hash')
 
     def __init__(self, string=None):
         """
         Creates a Dice object. It models multiple Die objects.
+        :param str string: dice expression, like '2d6+1d4-2'
         """
-        # Positive dice set
-        self.dice = {}
-
+        dice = ()
+        keep = ()
         if string is not None:
-            parts = string.lower().split("d")
-            if len(parts) != 2:
-                return
-            if parts[0] == '':
-                amount = 1
-            else:
-                amount = int(parts[0])
-            sides = int(parts[1])
-            self.add_die(sides, amount)
+            compiled = compile_dice(string)
+            dice = compiled._dice
+            keep = compiled._keep
+        self._dice = dice
+        self._keep = keep
+        self._hash = hash((dice, keep))
+
+    @staticmethod
+    def _make(dice, keep=()):
+        instance = Dice.__new__(Dice)
+        instance._dice = dice
+        instance._keep = keep
+        instance._hash = hash((dice, keep))
+        return instance
 
+    @staticmethod
+    def _merge(*groups):
+        counts = {}
+        for group in groups:
+            for side, count in group:
+                counts[side] = counts.get(side, 0) + count
+        # Bigger dice go first, modifier is the last one
+        return tuple(sorted(((side, count) for side, count in counts.items() if count != 0), reverse=True))
+
+    # Dice are immutable, so there is no need for a real copy
     def copy(self):
-        result = Dice()
-        result.dice = self.dice.copy()
-        return result
+        return self
 
     @staticmethod
     def from_string(string):
@@ -42,59 +365,64 @@ class Dice(object):
 
         :rtype: Dice
         """
-        instance = Dice()
-        parts = string.lower().split("d")
-        if len(parts) != 2:
-            return instance
-        if parts[0] == '':
-            amount = 1
-        else:
-            amount = int(parts[0])
-        sides = int(parts[1])
-        for i in range(amount):
-            instance.add_die(sides)
-        return instance
+        return compile_dice(string)
 
-    @staticmethod
-    def roll_dice(sides, count=1):
-        """
-        roll the die
-        """
-        result = 0
-        for i in range(0, count):
-            result += random.randint(1, sides) if sides > 1 else 1
-        return result
+    # Plain dice as a dict, maps sides -> count
+    @property
+    def dice(self):
+        return dict(self._dice)
 
-    def add_die(self, side, count = 1):
+    def with_die(self, side, count=1):
         """
-        add a die to the dice group
+        Get dice with added dice
+        :param int side: number of sides. Single side adds a flat modifier
+        :param int count: number of dice
+        :rtype: Dice
         """
-        if side in self.dice:
-            self.dice[side] += count
-        else:
-            self.dice[side] = count
+        return _add_dice(self, Dice._make(Dice._merge(((side, count),))))
 
-    def remove_die(self, die):
+    def __add__(self, other):
         """
-        remove a die from the dice group
+        :param other: Dice or int modifier
+        :rtype: Dice
         """
-        self.dice.remove(die)
+        if isinstance(other, int):
+            if other == 0:
+                return self
+            return self.with_die(1, other)
+        return _add_dice(self, other)
 
-    def __add__(self, other):
-        result = self.copy()
-        for side, count in other.dice.items():
-            result.add_die(side, count)
-        return result
+    __radd__ = __add__
+
+    def __eq__(self, other):
+        return isinstance(other, Dice) and self._dice == other._dice and self._keep == other._keep
+
+    def __hash__(self):
+        return self._hash
 
     # Get dice range, [min, max]
     def get_range(self):
         min = 0
         max = 0
-        for side, count in self.dice.items():
-            min += count
-            max += side*count
+        for side, count in self._dice:
+            if count >= 0 or side <= 1:
+                min += count
+                max += side*count
+            else:
+                min += side*count
+                max += count
+        for side, count, keep in self._keep:
+            min += abs(keep)
+            max += abs(keep) * side
         return min, max
 
+    def distribution(self):
+        """
+        Get exact probability mass function of the dice group
+        :rtype: Distribution
+        """
+        return _group_distribution(self)
+
     def __repr__(self):
         return self.to_string()
 
@@ -102,78 +430,170 @@ class Dice(object):
         return self.to_string()
 
     def to_string(self):
-        result = ""
-        first = True
-        for side, count in self.dice.items():
-            str = "%d" % (count) if side == 1 else "%dd%d" % (count, side)
-            if count > 0:
-                if first:
-                    result += str
-                    first = False
-                else:
-                    result += "+" + str
-            elif count < 0:
-                result += "-" + str
-        return result
-
-    # Remove zero-count dices
-    def trim_zero(self):
-        zeros = []
-        # Collecting zeros
-        for side, count in self.dice:
-            if count == 0:
-                zeros.append(side)
-        # Removing zeros
-        for side in zeros:
-            del self.dice[side]
+        terms = []
+        for side, count, keep in self._keep:
+            terms.append("%dd%dk%s%d" % (count, side, 'h' if keep > 0 else 'l', abs(keep)))
+        for side, count in self._dice:
+            text = "%d" % abs(count) if side == 1 else "%dd%d" % (abs(count), side)
+            terms.append(("-" if count < 0 else "+") + text)
+        result = "".join(term if term[0] in "+-" else "+" + term for term in terms)
+        return result[1:] if result.startswith("+") else result
 
-    def roll(self):
+    def roll(self, stream=None):
         """
         roll the dice group
+        :param RandomStream stream: random stream. Default stream is used if it is None
         :rtype: int
         """
+        if stream is None:
+            stream = _default_stream
         roll_sum = 0
-        for side, count in self.dice.items():
-            roll_sum += Dice.roll_dice(side, count)
+        for side, count in self._dice:
+            roll_sum += stream.roll(side, count)
 
+        for side, count, keep in self._keep:
+            rolls = sorted(stream.roll(side) for _ in range(count))
+            roll_sum += sum(rolls[count - keep:]) if keep > 0 else sum(rolls[:-keep])
         return roll_sum
 
+    def roll_many(self, n, stream=None):
+        """
+        Make n independent rolls of the dice group. Requires numpy
+        :param int n: number of rolls
+        :param RandomStream stream: random stream. Default stream is used if it is None
+        :return: numpy array with n roll totals
+        """
+        if np is None:
+            raise ImportError("Dice.roll_many requires numpy")
+        if stream is None:
+            stream = _default_stream
+        generator = stream.generator
+        totals = np.zeros(n, dtype=np.int64)
+        for side, count in self._dice:
+            if side <= 1:
+                totals += count
+                continue
+            # Narrow type is much faster to generate
+            dtype = np.int16 if side < 2**15 else np.int64
+            for _ in range(abs(count)):
+                if count > 0:
+                    totals += generator.integers(1, side + 1, size=n, dtype=dtype)
+                else:
+                    totals -= generator.integers(1, side + 1, size=n, dtype=dtype)
+
+        for side, count, keep in self._keep:
+            rolls = generator.integers(1, side + 1, size=(n, count), dtype=np.int64)
+            rolls.sort(axis=1)
+            totals += rolls[:, count - keep:].sum(axis=1) if keep > 0 else rolls[:, :-keep].sum(axis=1)
+        return totals
+
+    def variance(self):
+        return self.distribution().variance()
+
+    def percentile(self, q):
+        return self.distribution().percentile(q)
+
+    # Probability to roll at least specified value
+    def prob_at_least(self, value):
+        return self.distribution().prob_at_least(value)
+
     # Calculate mean
     def mean(self):
         summ1 = 0
-        total = 0
-        for side, count in self.dice.items():
-            summ1 += (1 + side) * 0.5 * count
-            total += 1
-        #if total > 0:
-        #    return summ1 / total
+        for side, count in self._dice:
+            summ1 += (1 + side) * 0.5 * count if side > 1 else count
+        for side, count, keep in self._keep:
+            summ1 += keep_distribution(side, count, keep).mean()
         return summ1
 
 
-def make_roll(dice_sting):
+@functools.lru_cache(maxsize=4096)
+def _add_dice(a, b):
+    return Dice._make(Dice._merge(a._dice, b._dice), tuple(sorted(a._keep + b._keep)))
+
+
+@functools.lru_cache(maxsize=1024)
+def _group_distribution(dice):
+    result = Distribution.constant(0)
+    for side, count in dice._dice:
+        result = result + dice_distribution(side, count)
+    for side, count, keep in dice._keep:
+        result = result + keep_distribution(side, count, keep)
+    return result
+
+
+_DICE_TERM = re.compile(r'([+-]?)(?:(\d*)d(\d+)(?:k([hl]?)(\d+))?|(\d+))')
+
+
+@functools.lru_cache(maxsize=None)
+def compile_dice(source):
+    """
+    compiles dice expression in the form:
+    <amount>d<sides>[k<h|l><keep>][<+/-><amount>d<sides>...][<+/-><value>]
+    for example '2d6+1d4-2' or '4d6kh3' (keep 3 highest of 4d6).
+    Results are interned: the same source gives the same object
+
+    :param str source: dice expression
+    :rtype: Dice
+    """
+    text = source.replace(" ", "").lower()
+    dice = []
+    keep = []
+    position = 0
+    while position < len(text):
+        match = _DICE_TERM.match(text, position)
+        if match is None or match.end() == position:
+            raise ValueError("Invalid dice expression '%s'" % source)
+        position = match.end()
+        sign, amount, sides, keep_type, keep_count, value = match.groups()
+        if value is not None:
+            dice.append((1, -int(value) if sign == '-' else int(value)))
+            continue
+        amount = int(amount) if amount != '' else 1
+        sides = int(sides)
+        if keep_count is None:
+            dice.append((sides, -amount if sign == '-' else amount))
+            continue
+        keep_count = int(keep_count)
+        if sign == '-' or keep_count > amount:
+            raise ValueError("Invalid keep group in dice expression '%s'" % source)
+        keep.append((sides, amount, -keep_count if keep_type == 'l' else keep_count))
+    return Dice._make(Dice._merge(dice), tuple(sorted(keep)))
+
+
+def make_roll(dice_sting, stream=None):
     """
     rolls dice that are represented by a string in the form:
     <amount>d<sides>[<+/-><value>]
     for example:
     '3d6' rolls a group with 3 six-sided dice
     '2d10+5' rolls two ten sided die and adds 5 to the result
+    '4d6kh3' rolls four six-sided dice and keeps three highest
 
+    Expression is compiled only once, see compile_dice
+
+    :param RandomStream stream: random stream. Default stream is used if it is None
     :rtype: int result of the roll
     """
-    if "+" in dice_sting:
-        parts = dice_sting.replace(" ", "").split("+")
-        return Dice.from_string(parts[0]).roll() + int(parts[1])
-    if "-" in dice_sting:
-        parts = dice_sting.replace(" ", "").split("-")
-        return Dice.from_string(parts[0]).roll() - int(parts[1])
-    return Dice.from_string(dice_sting).roll()
+    return compile_dice(dice_sting).roll(stream)
+
+
+def make_roll_many(dice_sting, n, stream=None):
+    """
+    the same as make_roll, but makes n independent rolls at once. Requires numpy
+
+    :param int n: number of rolls
+    :param RandomStream stream: random stream. Default stream is used if it is None
+    :return: numpy array with n roll results
+    """
+    return compile_dice(dice_sting).roll_many(n, stream)
 
-d4 = Dice("d4")
-d6 = Dice("d6")
-d8 = Dice("d8")
-d10 = Dice("d10")
-d20 = Dice("d20")
-d100 = Dice("d100")
+d4 = compile_dice("d4")
+d6 = compile_dice("d6")
+d8 = compile_dice("d8")
+d10 = compile_dice("d10")
+d20 = compile_dice("d20")
+d100 = compile_dice("d100")
 
 
 # RollResult class. It contains a result for a single d20 roll
@@ -188,7 +608,7 @@ class RollResult:
         self._dice = dice
 
     # Make a roll
-    def roll(self):
-        r = d20.roll()
+    def roll(self, stream=None):
+        r = d20.roll(stream)
         self._rolls.append(r)
         return r
\ No newline at end of file
@@ -1,5 +1,5 @@
 import math
-from .grid import Point
+from .grid import Point, Coord
 
 DIRECTION_FRONT = 0
 DIRECTION_LEFT = 1
@@ -22,6 +22,7 @@ class Entity:
         self._size = kwargs.get('size', 1)
         self._occupation_template = None
         # Should we keep a list of threatened tiles when we have occupation template?
+        # Dense grids do not fill it. Use Grid.get_threatened_tiles instead
         self._threatened_tiles = []
         self._occupied_tiles = []
 
@@ -50,19 +51,29 @@ class Entity:
     def get_size(self):
         return self._size
 
+    # Entity faction. Grid keeps separate threat layers for each faction
+    def get_faction(self):
+        return None
+
     def get_center(self) -> Point:
         return Point(x=(self.x + self._size*0.5), y=self.y + self._size*0.5)
 
-    def get_coord(self) -> Point:
-        return Point(x=self.x, y=self.y)
+    def get_coord(self) -> Coord:
+        return Coord(self.x, self.y)
 
     def get_visual_coord(self) -> Point:
         return Point(x=self.visual_X, y=self.visual_Y)
 
+    # Chebyshev distance from the border of this entity to the border of other entity,
+    # measured like for a medium creature: from the center of its tile, next to the border.
+    # So big creatures reach as far from their border, as threat templates do
+    # Centers are not allocated, as it is called for every reach check
     def distance_melee(self, other):
-        center_self = self.get_center()
-        center_other = other.get_center()
-        return center_self.distance_melee(center_other) - other.get_size() * 0.5
+        half = self._size * 0.5
+        other_half = other._size * 0.5
+        dx = abs(self.x + half - other.x - other_half)
+        dy = abs(self.y + half - other.y - other_half)
+        return (dx if dx > dy else dy) - other_half - half + 0.5
 
     def get_occupation_template(self):
         return self._occupation_template
@@ -73,7 +84,7 @@ class Entity:
     # Return distance between tiles
     @staticmethod
     def distance_tiles(obj_a, obj_b):
-        return math.sqrt((obj_a.x - obj_b.y) ** 2 + (obj_a.y - obj_b.y) ** 2)
+        return math.hypot(obj_a.x - obj_b.x, obj_a.y - obj_b.y)
 
     # Check if combatant obj_b is within reach of combatant obj_a
     def is_adjacent(self, other):
@@ -3,6 +3,8 @@ class BattleEvent(object):
     """
     Basic class for battle events
     """
+    __slots__ = ('_name',)
+
     def __init__(self, name):
         self._name = name
 
@@ -12,12 +14,16 @@ class BattleEvent(object):
 
 
 class TurnEnd(BattleEvent):
+    __slots__ = ('combatant',)
+
     def __init__(self, combatant):
         super(TurnEnd, self).__init__("turn end")
         self.combatant = combatant
 
 
 class RoundEnd(BattleEvent):
+    __slots__ = ('round',)
+
     def __init__(self, round):
         super(RoundEnd, self).__init__("round end")
         self.round = round
@@ -27,6 +33,8 @@ class AnimationEvent(BattleEvent):
     """
     This event contains animation for game action to be shown
     """
+    __slots__ = ('animation',)
+
     def __init__(self, animation):
         super(AnimationEvent, self).__init__("animation")
         self.animation = animation
\ No newline at end of file
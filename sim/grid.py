@@ -1,7 +1,13 @@
 import random
 import math
+import collections
 from .core import unit_length
 
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
 TERRAIN_OUTSIDE = -1
 TERRAIN_FREE = 0
 TERRAIN_GRASS = 1
@@ -12,9 +18,11 @@ class Point:
     """
     Generic 2d point/vector
     """
-    def __init__(self, **kwargs):
-        self.x = kwargs.get('x', 0.0)
-        self.y = kwargs.get('y', 0.0)
+    __slots__ = ('x', 'y')
+
+    def __init__(self, x=0.0, y=0.0):
+        self.x = x
+        self.y = y
 
     def tuple(self):
         return self.x, self.y
@@ -62,6 +70,73 @@ class Point:
         return "Point(%d;%d)" % (self.x, self.y)
 
 
+class Coord(collections.namedtuple('Coord', 'x y')):
+    """
+    Immutable integer coordinate of a tile
+
+    Coord is a tuple (x, y), so it is hashable and can be unpacked. Arithmetic works like
+    for Point, not like for tuples: coord + other is a vector sum. Sum with a Point gives a Point.
+    Coordinate can be packed to a single int x + y*width, like grid and pathfinder index their tiles.
+    """
+    __slots__ = ()
+
+    def tuple(self):
+        return self.x, self.y
+
+    def __add__(self, other):
+        if type(other) is Coord:
+            return Coord(self[0] + other[0], self[1] + other[1])
+        return Point(x=self.x + other.x, y=self.y + other.y)
+
+    def __sub__(self, other):
+        if type(other) is Coord:
+            return Coord(self[0] - other[0], self[1] - other[1])
+        return Point(x=self.x - other.x, y=self.y - other.y)
+
+    def __mul__(self, scale):
+        if type(scale) is int:
+            return Coord(self[0] * scale, self[1] * scale)
+        return Point(x=self.x * scale, y=self.y * scale)
+
+    __rmul__ = __mul__
+
+    # Chebyshev metric
+    def distance_melee(self, b):
+        return max(abs(self[0] - b.x), abs(self[1] - b.y))
+
+    # Euclidian metric
+    def distance_tiles(self, b):
+        return math.hypot(self[0] - b.x, self[1] - b.y)
+
+    def distance(self, b):
+        return math.hypot(self[0] - b.x, self[1] - b.y) * 5
+
+    def distance_xy(self, x, y):
+        return math.hypot(self[0] - x, self[1] - y) * 5
+
+    def pack(self, width):
+        """
+        Pack to a single int. Packed coordinates of the same grid can be used as dict keys and array indices
+        :param int width: grid width
+        """
+        return self[0] + self[1] * width
+
+    @staticmethod
+    def unpack(index, width):
+        """
+        Get coordinate from packed int
+        :rtype: Coord
+        """
+        y, x = divmod(index, width)
+        return Coord(x, y)
+
+    def __str__(self):
+        return "(%d;%d)" % self
+
+    def __repr__(self):
+        return "Coord(%d;%d)" % self
+
+
 def get_line(start, end):
     """Bresenham's Line Algorithm
     Produces a list of tuples from start and end
@@ -128,27 +203,79 @@ class Grid(object):
     Implements a battle grid. [The grid] consists of a grid of 1-inch squares.
     Each of these squares represents a 5-foot square in the game world (D&D 3.5 Players Handbook, p.133).
 
+    Grid has two storage backends:
+        - regular one keeps a Tile object for every cell
+        - dense one keeps terrain, occupant and threat counters in numpy arrays,
+          and creates Tile objects only for the cells that are asked for
+
+    Every change of the grid increments its revision. Grid keeps a journal of areas, changed by
+    last revisions, so its users can update only the changed parts of their data.
+
     :type _size: int
     :type __grid: Tile[]
     """
-
-    def __init__(self, width, height):
+    # Max number of revisions to be kept in change journal
+    JOURNAL_SIZE = 1024
+    # Size of a cell for threat lookups of dense grid, in tiles
+    THREAT_CELL = 8
+    # Max number of tiles in a template, that is stamped tile by tile instead of by numpy
+    FLAT_STAMP_TILES = 24
+
+    def __init__(self, width, height, dense=False):
         """
         Creates a Grid object
+        :param width:int grid width, in tiles
+        :param height:int grid height, in tiles
+        :param dense:bool use numpy-backed storage
         """
         self._size = 5.0
         self.set_tile_size(5.0)
         self._width = width
         self._height = height
         self._revision = 0
+        # Areas changed by last revisions: (revision, left, top, right, bottom)
+        self._journal = collections.deque(maxlen=Grid.JOURNAL_SIZE)
+        self._dense = dense
         self.__grid = []
 
         # Maps tuple (size, reach, near, far) -> OccupancyTemplate
         self._occupancy_templates = {}
-
-        for y in range(0, height):
-            for x in range(0, width):
-                self.__grid.append(Tile(x, y))
+        # Registered entities. Maps entity -> (x, y, template, faction)
+        self._placements = {}
+        # Profiler for entity registration. Attached by the battle
+        self.profiler = None
+
+        if dense:
+            if np is None:
+                raise ImportError("Dense grid storage requires numpy")
+            # Terrain type for each tile
+            self._terrain = np.full((height, width), TERRAIN_FREE, dtype=np.int16)
+            # Number of entities, occupying each tile
+            self._occupants = np.zeros((height, width), dtype=np.int16)
+            # Number of entities, threatening each tile
+            self._threats = np.zeros((height, width), dtype=np.int16)
+            # Threat counters for each faction. Maps faction -> numpy array
+            self._faction_threats = {}
+            # Flat views of the counters. Small templates are stamped through them, tile by tile,
+            # as numpy calls cost more than the update itself
+            self._occupants_view = self._flat_view(self._occupants)
+            self._threats_view = self._flat_view(self._threats)
+            self._faction_views = {}
+            # Threatened tiles of templates, as offsets in flat views. Maps template -> list of offsets
+            self._flat_offsets = {}
+            # Entities, whose threat template overlaps a cell of THREAT_CELL x THREAT_CELL tiles.
+            # Maps (cell x, cell y) -> list of entities, in registration order
+            self._threat_buckets = {}
+            # Registration number and lookup cells of each entity. Number keeps registration order
+            # for lookups over several cells. Maps entity -> (number, cells)
+            self._threat_entries = {}
+            self._serial = 0
+            # Tiles that were already requested. Maps tile index -> TileView
+            self.__tiles = {}
+        else:
+            for y in range(0, height):
+                for x in range(0, width):
+                    self.__grid.append(Tile(x, y))
 
     def set_tile_size(self, size):
         """
@@ -172,6 +299,10 @@ class Grid(object):
     def get_height(self):
         return self._height
 
+    @property
+    def dense(self):
+        return self._dense
+
     def get_tilesize(self):
         """
         returns size of a tile in the current unit
@@ -185,6 +316,13 @@ class Grid(object):
 
     # Get random free tile
     def get_free_tile(self):
+        if self._dense:
+            free = np.flatnonzero((self._occupants == 0) & (self._terrain != TERRAIN_WALL))
+            if len(free) == 0:
+                return None
+            index = int(free[random.randint(0, len(free)-1)])
+            return index % self._width, index // self._width
+
         free = []
         for tile in self.__grid:
             if tile.is_empty():
@@ -213,7 +351,14 @@ class Grid(object):
     # Projecting some entity to a map
     # Each cell, occupied by an entity, will keep reference to an entity
     # All threatened tiles will keep references as well
+    # Dense grid does not keep threat references. It stamps template masks to threat counters instead
     def register_entity(self, entity):
+        if self.profiler is not None:
+            with self.profiler.section('grid_register', entity):
+                return self._register_entity(entity)
+        return self._register_entity(entity)
+
+    def _register_entity(self, entity):
         # Obtain occupation template
         template = entity.get_occupation_template()
         if not isinstance(template, OccupationTemplate):
@@ -221,6 +366,11 @@ class Grid(object):
             template = self.get_occupancy_template(entity)
             entity.set_occupation_template(template)
 
+        if self._dense:
+            self._register_dense(entity, template)
+            self._record_placement(self._placements[entity])
+            return
+
         def offset_tile(coord) -> Tile:
             return self.get_tile(coord[0] + entity.x, coord[1] + entity.y)
 
@@ -240,25 +390,378 @@ class Grid(object):
                 if tile not in entity.threatened_tiles:
                     entity.threatened_tiles.append(tile)
 
-        self._revision += 1
+        placement = (entity.x, entity.y, template, entity.get_faction())
+        self._placements[entity] = placement
+        self._record_placement(placement)
 
     # Remove entity from grid.
     # Removes all the references, and tile threatening as well
     def unregister_entity(self, entity):
-        for tile in entity._threatened_tiles:
-            tile.threaten.remove(entity)
-        entity._threatened_tiles = []
+        if self.profiler is not None:
+            with self.profiler.section('grid_unregister', entity):
+                return self._unregister_entity(entity)
+        return self._unregister_entity(entity)
+
+    def _unregister_entity(self, entity):
+        placement = self._placements.get(entity)
+
+        if self._dense:
+            self._unregister_dense(entity)
+        else:
+            for tile in entity._threatened_tiles:
+                tile.threaten.remove(entity)
+            entity._threatened_tiles = []
+
+            for tile in entity._occupied_tiles:
+                tile.occupation.remove(entity)
+            entity._occupied_tiles = []
+            self._placements.pop(entity, None)
+
+        if placement is not None:
+            self._record_placement(placement)
+        else:
+            self._record_change(0, 0, 0, 0)
+
+    def _register_dense(self, entity, template):
+        if entity in self._placements:
+            self.unregister_entity(entity)
+
+        x = entity.x
+        y = entity.y
+        faction = entity.get_faction()
+        self._placements[entity] = (x, y, template, faction)
+
+        self._stamp_occupation(template, x, y, 1)
+        self._stamp_threats(template, x, y, faction, 1)
+        cells = self._threat_cells(x, y, template)
+        buckets = self._threat_buckets
+        for cell in cells:
+            bucket = buckets.get(cell)
+            if bucket is None:
+                buckets[cell] = [entity]
+            else:
+                bucket.append(entity)
+        self._threat_entries[entity] = (self._serial, cells)
+        self._serial += 1
+
+        # Occupied area is small, so we still keep references for occupied tiles
+        for cx, cy in template.tiles_occupied:
+            tile = self.get_tile(cx + x, cy + y)
+            if tile is not None:
+                tile.occupation.append(entity)
+                entity.occupied_tiles.append(tile)
+
+    def _unregister_dense(self, entity):
+        placement = self._placements.pop(entity, None)
+        if placement is None:
+            return
+        x, y, template, faction = placement
+
+        self._stamp_occupation(template, x, y, -1)
+        self._stamp_threats(template, x, y, faction, -1)
+        buckets = self._threat_buckets
+        for cell in self._threat_entries.pop(entity)[1]:
+            bucket = buckets[cell]
+            bucket.remove(entity)
+            if not bucket:
+                del buckets[cell]
 
         for tile in entity._occupied_tiles:
             tile.occupation.remove(entity)
         entity._occupied_tiles = []
 
-        self._revision += 1
+    # Get lookup cells, covered by the template block of an entity
+    def _threat_cells(self, x, y, template):
+        cell = Grid.THREAT_CELL
+        left = x - template.offset
+        top = y - template.offset
+        x0 = max(left, 0) // cell
+        y0 = max(top, 0) // cell
+        x1 = (min(left + template.block_size, self._width) - 1) // cell
+        y1 = (min(top + template.block_size, self._height) - 1) // cell
+        if x0 == x1 and y0 == y1:
+            return ((x0, y0),)
+        return [(cx, cy) for cy in range(y0, y1 + 1) for cx in range(x0, x1 + 1)]
+
+    # Get entities, whose templates can cover any tile of an area. Area should be inside the grid
+    def _threat_candidates(self, x0, y0, x1, y1):
+        cell = Grid.THREAT_CELL
+        buckets = self._threat_buckets
+        cx0 = x0 // cell
+        cy0 = y0 // cell
+        cx1 = (x1 - 1) // cell
+        cy1 = (y1 - 1) // cell
+        if cx0 == cx1 and cy0 == cy1:
+            return buckets.get((cx0, cy0), ())
+        candidates = set()
+        for cy in range(cy0, cy1 + 1):
+            for cx in range(cx0, cx1 + 1):
+                candidates.update(buckets.get((cx, cy), ()))
+        entries = self._threat_entries
+        return sorted(candidates, key=lambda entity: entries[entity][0])
+
+    # Get threat counters for specified faction
+    def _get_faction_threats(self, faction):
+        layer = self._faction_threats.get(faction)
+        if layer is None:
+            layer = self._faction_threats[faction] = np.zeros((self._height, self._width), dtype=np.int16)
+        return layer
+
+    # Get 1d view of a counter layer, that can be changed without numpy calls
+    @staticmethod
+    def _flat_view(layer):
+        return memoryview(layer).cast('B').cast('h')
+
+    # Add occupation of an entity to occupant counters
+    def _stamp_occupation(self, template, x, y, sign):
+        if len(template.tiles_occupied) == 1:
+            # Single tile, like for medium creatures, is cheaper to update directly
+            if 0 <= x < self._width and 0 <= y < self._height:
+                self._occupants_view[x + y * self._width] += sign
+            return
+        self._stamp(self._occupants, template.occupy_mask, x, y, template.offset, sign)
+
+    # Add threat mask of an entity to total and faction threat counters. Both layers share the clipping
+    def _stamp_threats(self, template, x, y, faction, sign):
+        mask = template.threat_mask
+        block_size = template.block_size
+        left = x - template.offset
+        top = y - template.offset
+        right = left + block_size
+        bottom = top + block_size
+        if left >= 0 and top >= 0 and right <= self._width and bottom <= self._height:
+            offsets = self._flat_offsets.get(template)
+            if offsets is None:
+                offsets = self._flat_offsets[template] = [cx + cy * self._width
+                                                          for cx, cy in template.tiles_threatened]
+            if len(offsets) <= Grid.FLAT_STAMP_TILES:
+                total = self._threats_view
+                own = self._faction_views.get(faction)
+                if own is None:
+                    own = self._faction_views[faction] = self._flat_view(self._get_faction_threats(faction))
+                base = x + y * self._width
+                for offset in offsets:
+                    index = base + offset
+                    total[index] += sign
+                    own[index] += sign
+                return
+            window = mask
+        else:
+            x0 = max(left, 0)
+            y0 = max(top, 0)
+            right = min(right, self._width)
+            bottom = min(bottom, self._height)
+            if x0 >= right or y0 >= bottom:
+                return
+            window = mask[y0 - top:bottom - top, x0 - left:right - left]
+            left = x0
+            top = y0
+        for layer in (self._threats, self._get_faction_threats(faction)):
+            area = layer[top:bottom, left:right]
+            if sign > 0:
+                np.add(area, window, out=area)
+            else:
+                np.subtract(area, window, out=area)
+
+    def _stamp(self, layer, mask, x, y, offset, sign):
+        """
+        Adds template mask to a grid layer. Mask is clipped by grid borders
+        :param layer: numpy array [height, width]
+        :param mask: numpy array [block_size, block_size]
+        :param x:int entity x coordinate
+        :param y:int entity y coordinate
+        :param offset:int template offset
+        :param sign:int 1 to add the mask, -1 to subtract it
+        """
+        block_size = mask.shape[0]
+        left = x - offset
+        top = y - offset
+        x0 = max(left, 0)
+        y0 = max(top, 0)
+        x1 = min(left + block_size, self._width)
+        y1 = min(top + block_size, self._height)
+        if x0 >= x1 or y0 >= y1:
+            return
+        window = mask[y0 - top:y1 - top, x0 - left:x1 - left]
+        if sign > 0:
+            layer[y0:y1, x0:x1] += window
+        else:
+            layer[y0:y1, x0:x1] -= window
+
+    # Check if entity template covers the tile
+    @staticmethod
+    def _placement_threatens(placement, x, y):
+        ex, ey, template, faction = placement
+        mx = x - ex + template.offset
+        my = y - ey + template.offset
+        if mx < 0 or my < 0 or mx >= template.block_size or my >= template.block_size:
+            return False
+        return template.threat_mask[my, mx] != 0
+
+    def get_threatening_entities(self, x, y):
+        """
+        Get all entities, that threaten specified tile
+        :param x:int x coordinate of a tile
+        :param y:int y coordinate of a tile
+        :return: list of entities
+        """
+        if not self._dense:
+            tile = self.get_tile(x, y)
+            return [] if tile is None else list(tile.threaten)
+        if not self.is_inside(x, y) or self._threats[y, x] == 0:
+            return []
+        placements = self._placements
+        return [entity for entity in self._threat_candidates(x, y, x + 1, y + 1)
+                if self._placement_threatens(placements[entity], x, y)]
+
+    def hostile_threats(self, x, y, faction):
+        """
+        Get number of entities, hostile to a faction, that threaten a tile.
+        Grid considers any other faction to be hostile.
+        :param x:int x coordinate of a tile
+        :param y:int y coordinate of a tile
+        :param faction: faction to be threatened
+        :return:int
+        """
+        if not self.is_inside(x, y):
+            return 0
+        if not self._dense:
+            return sum(1 for entity in self.get_tile(x, y).threaten if entity.get_faction() != faction)
+        own = self._faction_threats.get(faction)
+        if own is None:
+            return int(self._threats[y, x])
+        return int(self._threats[y, x] - own[y, x])
+
+    def area_threatened(self, x, y, size, faction):
+        """
+        Check if any tile of a square area is threatened by hostile entities
+        :param x:int left coordinate of an area
+        :param y:int top coordinate of an area
+        :param size:int area size, in tiles
+        :param faction: faction to be threatened
+        :return:bool
+        """
+        if not self._dense:
+            for ty in range(y, y + size):
+                for tx in range(x, x + size):
+                    if self.hostile_threats(tx, ty, faction) > 0:
+                        return True
+            return False
+
+        own = self._faction_threats.get(faction)
+        if size == 1:
+            if x < 0 or y < 0 or x >= self._width or y >= self._height:
+                return False
+            if own is None:
+                return self._threats[y, x] > 0
+            return self._threats[y, x] > own[y, x]
+
+        x0 = max(x, 0)
+        y0 = max(y, 0)
+        x1 = min(x + size, self._width)
+        y1 = min(y + size, self._height)
+        if x0 >= x1 or y0 >= y1:
+            return False
+        threats = self._threats[y0:y1, x0:x1]
+        if own is None:
+            return bool(threats.any())
+        # Total counter includes own faction, so hostile threats are the difference
+        return bool((threats > own[y0:y1, x0:x1]).any())
+
+    def get_hostile_threateners(self, x, y, size, faction):
+        """
+        Get entities, hostile to a faction, that threaten any tile of a square area
+        :param x:int left coordinate of an area
+        :param y:int top coordinate of an area
+        :param size:int area size, in tiles
+        :param faction: faction to be threatened
+        :return: list of unique entities, in registration order
+        """
+        result = []
+        if not self.area_threatened(x, y, size, faction):
+            return result
+
+        if not self._dense:
+            for ty in range(y, y + size):
+                for tx in range(x, x + size):
+                    for entity in self.get_threatening_entities(tx, ty):
+                        if entity.get_faction() != faction and entity not in result:
+                            result.append(entity)
+            return result
+
+        x0 = max(x, 0)
+        y0 = max(y, 0)
+        x1 = min(x + size, self._width)
+        y1 = min(y + size, self._height)
+        # Factions, that threaten the area, are known from their threat layers
+        hostile = [other for other, layer in self._faction_threats.items()
+                   if other != faction and layer[y0:y1, x0:x1].any()]
+        placements = self._placements
+        for entity in self._threat_candidates(x0, y0, x1, y1):
+            ex, ey, template, entity_faction = placements[entity]
+            if entity_faction not in hostile:
+                continue
+            left = ex - template.offset
+            top = ey - template.offset
+            # Part of the area, covered by the template block
+            bx0 = max(x0, left)
+            by0 = max(y0, top)
+            bx1 = min(x1, left + template.block_size)
+            by1 = min(y1, top + template.block_size)
+            if bx0 < bx1 and by0 < by1 and template.threat_mask[by0 - top:by1 - top, bx0 - left:bx1 - left].any():
+                result.append(entity)
+        return result
+
+    def get_threatened_tiles(self, entity):
+        """
+        Get tiles threatened by an entity
+        :param entity: registered entity
+        :return: list of tiles
+        """
+        if not self._dense:
+            return entity.threatened_tiles
+        placement = self._placements.get(entity)
+        if placement is None:
+            return []
+        x, y, template, faction = placement
+        tiles = [self.get_tile(cx + x, cy + y) for cx, cy in template.tiles_threatened]
+        return [tile for tile in tiles if tile is not None]
 
     @property
     def revision(self):
         return self._revision
 
+    # Increment revision and mark changed area. Area is [left, right) x [top, bottom)
+    def _record_change(self, left, top, right, bottom):
+        self._revision += 1
+        self._journal.append((self._revision, left, top, right, bottom))
+
+    # Mark area of entity template as changed
+    def _record_placement(self, placement):
+        x, y, template, faction = placement
+        left = x - template.offset
+        top = y - template.offset
+        self._record_change(left, top, left + template.block_size, top + template.block_size)
+
+    def changes_since(self, revision):
+        """
+        Get areas, changed after specified revision
+        :param revision:int revision, known by caller
+        :return: list of areas (left, top, right, bottom), or None if the journal
+        does not keep all the changes and caller should rebuild all its data
+        """
+        if revision >= self._revision:
+            return []
+        journal = self._journal
+        if len(journal) == 0 or journal[0][0] > revision + 1:
+            return None
+        changes = []
+        for entry in reversed(journal):
+            if entry[0] <= revision:
+                break
+            changes.append(entry[1:])
+        return changes
+
     def set_terrain(self, x, y, t):
         """
         Set terrain type for a tile
@@ -266,10 +769,43 @@ class Grid(object):
         :param y:int y coordinate of a tile
         :param t:int terrain type
         """
+        if self._dense:
+            if self.is_inside(x, y) and self._terrain[y, x] != t:
+                self._terrain[y, x] = t
+                self._record_change(x, y, x + 1, y + 1)
+            return
+
         tile = self.get_tile(x, y)
 
-        if tile.set_terrain(t):
-            self._revision += 1
+        if tile is not None and tile.set_terrain(t):
+            self._record_change(x, y, x + 1, y + 1)
+
+    @property
+    def terrain_layer(self):
+        """
+        Terrain types of dense grid, as numpy array [height, width]
+        """
+        return self._terrain
+
+    @property
+    def occupant_layer(self):
+        """
+        Number of occupants for each tile of dense grid, as numpy array [height, width]
+        """
+        return self._occupants
+
+    def get_terrain(self, x, y):
+        """
+        Get terrain type for a tile
+        :param x:int x coordinate of a tile
+        :param y:int y coordinate of a tile
+        :return:int terrain type, or TERRAIN_OUTSIDE for tiles out of the grid
+        """
+        if not self.is_inside(x, y):
+            return TERRAIN_OUTSIDE
+        if self._dense:
+            return int(self._terrain[y, x])
+        return self.__grid[x + y * self._width].terrain
 
     # Get tile reference
     def get_tile(self, x, y):
@@ -280,9 +816,15 @@ class Grid(object):
         :param int y: the y coordinate of the tile
         :rtype: Tile
         """
-        if self.is_inside(x, y):
-            return self.__grid[x + y * self._width]
-        return None
+        if not self.is_inside(x, y):
+            return None
+        index = x + y * self._width
+        if self._dense:
+            tile = self.__tiles.get(index)
+            if tile is None:
+                tile = self.__tiles[index] = TileView(self, x, y)
+            return tile
+        return self.__grid[index]
 
     # Get tile area
     def get_adjacent_tiles(self, tile):
@@ -326,19 +868,17 @@ class Grid(object):
     def get_tiles(self):
         """
         Returns all tiles
+        Dense grid has to create all the tiles for this call, so it is better to avoid it for large grids
 
         :rtype: Tile[]
         """
+        if self._dense:
+            return [self.get_tile(x, y) for y in range(0, self._height) for x in range(0, self._width)]
         return self.__grid
 
     def __repr__(self):
-        max_x = 0
-        max_y = 0
-        for tile in self.__grid:
-            if tile.x > max_x:
-                max_x = tile.x
-            if tile.y > max_y:
-                max_y = tile.y
+        max_x = self._width - 1
+        max_y = self._height - 1
 
         result = "<Grid>\n"
         for y in range(1, max_y):
@@ -359,6 +899,8 @@ class Tile(object):
     :type occupation: list
     :type threaten: list
     """
+    __slots__ = ('x', 'y', '_max_size', 'occupation', 'terrain', 'threaten')
+
     def __init__(self, x, y):
         """
         Creates a Tile object
@@ -384,10 +926,14 @@ class Tile(object):
         return len(self.occupation) == 0 and self.terrain != TERRAIN_WALL
 
     def get_coord(self):
-        return Point(x=self.x, y=self.y)
+        return Coord(self.x, self.y)
 
+    # Returns True if terrain is changed
     def set_terrain(self, t):
+        if self.terrain == t:
+            return False
         self.terrain = t
+        return True
 
     def has_occupation(self, thing):
         """
@@ -410,6 +956,49 @@ class Tile(object):
         return id(self)
 
 
+class TileView(Tile):
+    """
+    Tile of a dense grid.
+    Terrain and threats are stored in grid layers, and the object itself is created only when somebody asks for it.
+    """
+    # Terrain and threaten are properties here, so their slots of the base class are not used
+    __slots__ = ('_grid',)
+
+    def __init__(self, grid, x, y):
+        """
+        :param Grid grid: The grid, which stores tile data
+        :param int x: The x position of the Tile
+        :param int y: The y position of the Tile
+        """
+        self._grid = grid
+        self.x = x
+        self.y = y
+        self._max_size = 10
+        self.occupation = []
+
+    # Entities, that threaten this tile
+    @property
+    def threaten(self):
+        return self._grid.get_threatening_entities(self.x, self.y)
+
+    def is_threatened(self, combatant):
+        return self._grid._threats[self.y, self.x] > 0
+
+    @property
+    def terrain(self):
+        return int(self._grid._terrain[self.y, self.x])
+
+    @terrain.setter
+    def terrain(self, t):
+        self._grid._terrain[self.y, self.x] = t
+
+    def set_terrain(self, t):
+        if self.terrain == t:
+            return False
+        self._grid.set_terrain(self.x, self.y, t)
+        return True
+
+
 # Reach templates for different creature sizes and reaches
 # NOTE: reach weapon are doubling natural reach
 class OccupationTemplate:
@@ -429,6 +1018,9 @@ class OccupationTemplate:
         self.tiles_adjacent = []
         self.block_size = 0
         self.offset = 0
+        # Template masks for dense grids. Indexed as [y + offset, x + offset]
+        self.occupy_mask = None
+        self.threat_mask = None
         self.build()
 
     def build(self):
@@ -473,7 +1065,15 @@ class OccupationTemplate:
 
                 tile = (cx, cy, t)
                 self.template.append(tile)
-        pass
+
+        if np is not None:
+            shape = (self.block_size, self.block_size)
+            self.occupy_mask = np.zeros(shape, dtype=np.int16)
+            self.threat_mask = np.zeros(shape, dtype=np.int16)
+            for cx, cy in self.tiles_occupied:
+                self.occupy_mask[cy + self.offset, cx + self.offset] = 1
+            for cx, cy in self.tiles_threatened:
+                self.threat_mask[cy + self.offset, cx + self.offset] = 1
 
     def __str__(self):
         grid = []
@@ -101,7 +101,7 @@ class Weapon(Item):
         return True
 
     def damage(self, combatant, target=None):
-        return self._damage.copy()
+        return self._damage
 
     def has_reach(self):
         return self._reach > Weapon.REACH_NEAR
@@ -0,0 +1,85 @@
+"""
+Parallel Monte Carlo battle simulation
+
+Battles are split into shards with fixed size. Every shard gets its own seed, derived
+from the base seed and shard index, so results do not depend on the number of workers.
+Shards are run by a process pool and their stats are merged as soon as they are complete.
+"""
+import concurrent.futures
+import os
+import random
+
+from .runner import OutcomeStats, iterate_battles
+
+
+# Default number of battles in a shard
+SHARD_SIZE = 50
+
+
+def make_shards(count, seed=None, shard_size=SHARD_SIZE):
+    """
+    Split battles into shards with deterministic seeds
+    :param int count: total number of battles
+    :param seed: base seed. Random seeds are used if it is None
+    :param int shard_size: number of battles in a shard
+    :return: list of (battles, seed) for each shard
+    """
+    sizes = [shard_size] * (count // shard_size)
+    if count % shard_size:
+        sizes.append(count % shard_size)
+    generator = random.Random(seed)
+    return [(size, generator.getrandbits(63)) for size in sizes]
+
+
+def run_shard(scenario, count, seed):
+    """
+    Run a series of battles and aggregate its outcomes. Executed by pool workers
+    :param Scenario scenario: battle setup. Must be picklable: use module-level builders and painters
+    :param int count: number of battles
+    :param int seed: seed for the shard
+    :return: OutcomeStats
+    """
+    stats = OutcomeStats(scenario.factions)
+    for outcome in iterate_battles(scenario, count, seed=seed):
+        stats.add(outcome)
+    return stats
+
+
+def iterate_parallel(scenario, count, seed=None, workers=None, shard_size=SHARD_SIZE):
+    """
+    Run battles in a process pool and stream aggregated stats
+    :param Scenario scenario: battle setup
+    :param int count: total number of battles
+    :param seed: base seed
+    :param workers: number of worker processes. Number of CPUs by default.
+    Shards are run in the current process if it is 1
+    :param int shard_size: number of battles in a shard
+    :return: generator of OutcomeStats, accumulated after each completed shard
+    """
+    if workers is None:
+        workers = os.cpu_count() or 1
+    shards = make_shards(count, seed, shard_size)
+
+    stats = OutcomeStats(scenario.factions)
+    if workers == 1:
+        for size, shard_seed in shards:
+            stats.merge(run_shard(scenario, size, shard_seed))
+            yield stats
+        return
+
+    with concurrent.futures.ProcessPoolExecutor(max_workers=workers) as executor:
+        futures = [executor.submit(run_shard, scenario, size, shard_seed) for size, shard_seed in shards]
+        for future in concurrent.futures.as_completed(futures):
+            stats.merge(future.result())
+            yield stats
+
+
+def run_parallel(scenario, count, seed=None, workers=None, shard_size=SHARD_SIZE):
+    """
+    Run battles in a process pool
+    :return: OutcomeStats for all the battles
+    """
+    stats = OutcomeStats(scenario.factions)
+    for stats in iterate_parallel(scenario, count, seed, workers, shard_size):
+        pass
+    return stats
@@ -1,6 +1,12 @@
 import heapq
 import math
 
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+from .core import SIZE_CATEGORIES
 from .grid import *
 from .entity import *
 
@@ -22,62 +28,118 @@ def default_tile_cost(tile):
     return cost
 
 
-class PathFinder(object):
+# Cost of a move to adjacent tile: base cost + distance cost
+# Costs are scaled to integers, so equal paths have exactly equal costs
+COST_SCALE = 1000
+COST_STRAIGHT = (5 + 1) * COST_SCALE
+COST_DIAGONAL = round((7 + math.sqrt(2)) * COST_SCALE)
+
+# Neighbour moves: (dx, dy, cost, a, b)
+# Move is allowed only if straight moves with indexes 'a' and 'b' are allowed
+NEIGHBOUR_MOVES = (
+    (1, 0, COST_STRAIGHT, 0, 0),
+    (-1, 0, COST_STRAIGHT, 1, 1),
+    (0, 1, COST_STRAIGHT, 2, 2),
+    (0, -1, COST_STRAIGHT, 3, 3),
+    (1, 1, COST_DIAGONAL, 0, 2),
+    (1, -1, COST_DIAGONAL, 0, 3),
+    (-1, 1, COST_DIAGONAL, 1, 2),
+    (-1, -1, COST_DIAGONAL, 1, 3),
+)
+
+# Clearance is calculated up to the size of the largest creature
+MAX_CLEARANCE = max(size.tiles for size in SIZE_CATEGORIES)
+
+
+def get_melee_range_tiles(dest, range0, range1):
     """
-    Does pathfinding stuff
+    Get tiles inside the far square around dest, but outside the near one
+    :param dest:Point center of destination area
+    :param range0: inner range
+    :param range1: outer range
+    :return: [] array of tile coordinates
     """
+    if range0 > range1:
+        range0, range1 = range1, range0
 
-    class Node(Point):
-        """
-        Node for search tree
-        """
-        def __init__(self, x, y):
-            super(PathFinder.Node, self).__init__(x=x, y=y)
-            self.g = 0
-            self.h = 0
-            self._lh = 0
-            self.predecessor = None
-            self.pathstate = 0
-            self.target_mark = 0
+    near_x0 = math.floor(dest.x - range0)
+    near_x1 = math.ceil(dest.x + range0)
+    near_y0 = math.floor(dest.y - range0)
+    near_y1 = math.ceil(dest.y + range0)
 
-        def __lt__(self, other):
-            return self.g < other.g
+    return [(x, y) for x, y in get_coord_range(dest, range1)
+            if not (near_x0 <= x < near_x1 and near_y0 <= y < near_y1)]
 
-        def __hash__(self):
-            return id(self)
 
-    def __init__(self, objsize=1):
+class PathFinder(object):
+    """
+    Does pathfinding stuff
+
+    Pathfinder works with a rectangular window of the grid, attached by attach_grid.
+    All search data is kept in flat arrays, indexed by x + y*width, where x and y are window coordinates.
+    """
+
+    def __init__(self, grid=None, objsize=1):
         self.open_list = []
         self.search_index = 0
-        self._objsize = 1
+        self._objsize = objsize
+        self._clearance_limit = max(MAX_CLEARANCE, objsize)
         self._occupation = []
         self._corner_x = 0
         self._corner_y = 0
 
-        for y in range(0, self._objsize * 2 - 1):
-            for x in range(0, self._objsize * 2 - 1):
+        for y in range(0, self._objsize):
+            for x in range(0, self._objsize):
                 self._occupation.append((x, y))
 
         self._grid = None
+        self._cost_fn = None
+        # Grid revision, that costmap is synchronized with
         self._revision = 0
 
         self._width = 0
         self._height = 0
-        # Node index
-        self._node_index = []
         # Costs for each tile
         self._costmap = []
-        # Contains distance transform result
-        self._distance = []
+        # Size of the largest free square with top left corner at each tile
+        self._clearance = []
+        # Path cost from the start, for each tile
+        self._g = []
+        # Index of previous tile in the path, for each tile
+        self._parent = []
+        # Search index, when tile was reached
+        self._visited = []
+        # Search index, when tile was expanded
+        self._closed = []
+        # Search index, when tile was marked as a destination
+        self._target = []
+
+        if grid is not None:
+            self.sync_grid(grid)
+
+    @property
+    def grid(self):
+        return self._grid
+
+    # Size of a creature, pathfinder is looking path for
+    @property
+    def objsize(self):
+        return self._objsize
+
+    # Attach pathfinder to a whole grid
+    def sync_grid(self, grid, cost_fn=default_tile_cost):
+        self.attach_grid(grid, 0, 0, grid.width, grid.height, cost_fn)
 
     # Attach pathfinder to a grid, or update current projection
+    # Only changed part of the costmap is updated, if it is possible
     def attach_grid(self, grid, left, top, right, bottom, cost_fn=default_tile_cost):
         allocate = False
-        if self._grid != grid:
+        if self._grid != grid or cost_fn != self._cost_fn:
             self._grid = grid
+            self._cost_fn = cost_fn
             allocate = True
 
-        if self._node_index is None or len(self._node_index) == 0:
+        if self._costmap is None or len(self._costmap) == 0:
             allocate = True
 
         # Clamp desired area
@@ -101,35 +163,194 @@ class PathFinder(object):
 
             self._width = width
             self._height = height
-            # Node index
-            self._node_index = [None] * size
             # Costs for each tile
             self._costmap = [0] * size
-            # Contains distance transform result
-            self._distance = [0] * size
+            self._clearance = [0] * size
+            self._g = [0] * size
+            self._parent = [-1] * size
+            self._visited = [0] * size
+            self._closed = [0] * size
+            self._target = [0] * size
 
         corner_x = math.floor(left)
         corner_y = math.floor(top)
 
         # Sync tile costs
-        if self._corner_x != corner_x or self._corner_y != corner_y or allocate:
-            get_tile = self._grid.get_tile
-
-            index = 0
-            for y in range(0, self._width):
-                for x in range(0, self._height):
-                    tile = get_tile(x + self._corner_x, y + self._corner_y)
-                    self._costmap[index] = cost_fn(tile)
+        if allocate:
+            self._corner_x = corner_x
+            self._corner_y = corner_y
+            self._update_costs(0, 0, width, height)
+        else:
+            if self._corner_x != corner_x or self._corner_y != corner_y:
+                self._shift_window(corner_x, corner_y)
+            if self._revision != grid.revision:
+                areas = self._changed_areas(grid.changes_since(self._revision))
+                if areas is None:
+                    self._update_costs(0, 0, width, height)
+                else:
+                    for area in areas:
+                        self._update_costs(*area)
+
+        self._revision = grid.revision
+
+    # Max number of areas to be updated separately by vectorized update
+    VECTORIZED_AREAS_LIMIT = 8
+
+    def _changed_areas(self, changes):
+        """
+        Convert grid changes to window areas, that should be updated
+        :param changes: list of changed grid areas, or None
+        :return: list of window areas (x0, y0, x1, y1), or None if the whole window should be updated
+        """
+        if changes is None:
+            return None
+        vectorized = self._is_vectorized()
+        # Vectorized rebuild of the whole window is cheaper than clipping lots of changes
+        if vectorized and len(changes) > self.VECTORIZED_AREAS_LIMIT:
+            return None
+        areas = set()
+        changed_cells = 0
+        for left, top, right, bottom in changes:
+            x0 = max(left - self._corner_x, 0)
+            y0 = max(top - self._corner_y, 0)
+            x1 = min(right - self._corner_x, self._width)
+            y1 = min(bottom - self._corner_y, self._height)
+            if x0 < x1 and y0 < y1 and (x0, y0, x1, y1) not in areas:
+                areas.add((x0, y0, x1, y1))
+                changed_cells += (x1 - x0) * (y1 - y0)
+
+        if not vectorized and changed_cells >= self._width * self._height:
+            return None
+        return areas
+
+    # Check if costs can be calculated by numpy
+    def _is_vectorized(self):
+        return self._grid.dense and self._cost_fn is default_tile_cost
+
+    # Move window to new corner. Costs for the overlapping part are kept
+    def _shift_window(self, corner_x, corner_y):
+        dx = corner_x - self._corner_x
+        dy = corner_y - self._corner_y
+        width = self._width
+        height = self._height
+        self._corner_x = corner_x
+        self._corner_y = corner_y
+
+        # Range of window columns, that were visible before the shift
+        x0 = max(0, -dx)
+        x1 = min(width, width - dx)
+        if x0 >= x1 or abs(dy) >= height:
+            self._update_costs(0, 0, width, height)
+            return
+
+        rows = range(max(0, -dy), min(height, height - dy))
+        for name in ('_costmap', '_clearance'):
+            old = getattr(self, name)
+            data = [0] * len(old)
+            for y in rows:
+                row = y * width
+                old_row = (y + dy) * width + dx
+                data[row + x0:row + x1] = old[old_row + x0:old_row + x1]
+            setattr(self, name, data)
+
+        # Update new rows and columns
+        if dy > 0:
+            self._update_costs(0, height - dy, width, height)
+        elif dy < 0:
+            self._update_costs(0, 0, width, -dy)
+        if x0 > 0:
+            self._update_costs(0, 0, x0, height)
+        if x1 < width:
+            self._update_costs(x1, 0, width, height)
+
+    # Recalculate costs for window area [x0, x1) x [y0, y1)
+    def _update_costs(self, x0, y0, x1, y1):
+        grid = self._grid
+        corner_x = self._corner_x
+        corner_y = self._corner_y
+        costmap = self._costmap
+        width = self._width
+
+        if self._is_vectorized():
+            # The same as default_tile_cost, but for the whole area
+            terrain = grid.terrain_layer[y0 + corner_y:y1 + corner_y, x0 + corner_x:x1 + corner_x]
+            occupants = grid.occupant_layer[y0 + corner_y:y1 + corner_y, x0 + corner_x:x1 + corner_x]
+            wall = terrain == TERRAIN_WALL
+            costs = (wall * 100 + (wall | (occupants > 0)) * 5).tolist()
+            for y in range(y0, y1):
+                costmap[y * width + x0:y * width + x1] = costs[y - y0]
+        else:
+            get_tile = grid.get_tile
+            cost_fn = self._cost_fn
+            for y in range(y0, y1):
+                index = y * width + x0
+                for x in range(x0, x1):
+                    costmap[index] = cost_fn(get_tile(x + corner_x, y + corner_y))
                     index += 1
 
-            self._revision = grid.revision - 1
+        if self._is_vectorized():
+            self._update_clearance_vectorized(x0, y0, x1, y1)
+        else:
+            self._update_clearance(x0, y0, x1, y1)
 
-        self._corner_x = math.floor(left)
-        self._corner_y = math.floor(top)
+    def _update_clearance(self, x0, y0, x1, y1):
+        """
+        Recalculate clearance for tiles, affected by cost changes in window area [x0, x1) x [y0, y1)
 
-    # Search PF node by a coordinates
-    def __get_tile_node(self, x, y):
-        return self._node_index[x + y * self._width]
+        Clearance of a tile is the size of the largest free square with top left corner at this tile,
+        limited by _clearance_limit. Only tiles up and left from the changed area depend on it.
+        Tiles outside the window are considered free, so is_inside check is still required.
+        """
+        limit = self._clearance_limit
+        width = self._width
+        height = self._height
+        costmap = self._costmap
+        clearance = self._clearance
+        x0 = max(x0 - limit + 1, 0)
+        y0 = max(y0 - limit + 1, 0)
+
+        # Going backwards, so right and bottom neighbours are already updated
+        for y in range(y1 - 1, y0 - 1, -1):
+            index = y * width + x1 - 1
+            has_bottom = y + 1 < height
+            for x in range(x1 - 1, x0 - 1, -1):
+                if costmap[index] != 0:
+                    clearance[index] = 0
+                else:
+                    if x + 1 < width:
+                        right = clearance[index + 1]
+                        diagonal = clearance[index + width + 1] if has_bottom else limit
+                    else:
+                        right = diagonal = limit
+                    bottom = clearance[index + width] if has_bottom else limit
+                    clear = min(right, bottom, diagonal) + 1
+                    clearance[index] = clear if clear < limit else limit
+                index -= 1
+
+    # The same as _update_clearance, but calculated by numpy from grid layers
+    def _update_clearance_vectorized(self, x0, y0, x1, y1):
+        limit = self._clearance_limit
+        width = self._width
+        x0 = max(x0 - limit + 1, 0)
+        y0 = max(y0 - limit + 1, 0)
+        # Clearance of the area depends on tiles up to limit-1 to the right and bottom
+        x2 = min(x1 + limit - 1, width)
+        y2 = min(y1 + limit - 1, self._height)
+        left = x0 + self._corner_x
+        top = y0 + self._corner_y
+        terrain = self._grid.terrain_layer[top:y2 + self._corner_y, left:x2 + self._corner_x]
+        occupants = self._grid.occupant_layer[top:y2 + self._corner_y, left:x2 + self._corner_x]
+        # Free squares of size k are found by eroding free squares of size k-1
+        free = (terrain != TERRAIN_WALL) & (occupants == 0)
+        clearance = np.zeros(free.shape, dtype=np.int16)
+        for _ in range(limit):
+            clearance += free
+            padded = np.pad(free, ((0, 1), (0, 1)), constant_values=True)
+            free = padded[:-1, :-1] & padded[:-1, 1:] & padded[1:, :-1] & padded[1:, 1:]
+
+        rows = clearance[:y1 - y0, :x1 - x0].tolist()
+        for y in range(y0, y1):
+            self._clearance[y * width + x0:y * width + x1] = rows[y - y0]
 
     # TODO: should move costmap to cython
     def sum_obstacle(self, x0, y0):
@@ -139,183 +360,564 @@ class PathFinder(object):
             cost += self._costmap[index]
         return cost
 
-    def _get_node(self, x, y):
-        if not self.is_inside(x, y):
-            return None
-        index = x + y*self._width
-        node = self._node_index[index]
-        if node is None:
-            self._node_index[index] = node = PathFinder.Node(x,y)
-        return node
-
     # Check if coordinates are valid for creature and it is is inside the map
     def is_inside(self, x, y):
-        return x in range(0, self._width - self._objsize + 1) and y in range(0, self._height - self._objsize + 1)
-
-    # Iterates adjacent cells
-    def _get_adjacent(self, src, x, y):
-        def check_adjacent(x, y, base):
-            if self.is_inside(x, y) and self.sum_obstacle(x, y) == 0:
-                return self._get_node(x, y), base
+        return 0 <= x <= self._width - self._objsize and 0 <= y <= self._height - self._objsize
 
-        moves = [check_adjacent(x+1, y, 5),
-                 check_adjacent(x-1, y, 5),
-                 check_adjacent(x, y+1, 5),
-                 check_adjacent(x, y-1, 5)]
-        # Allow diagonals
-        if moves[0] is not None and moves[2] is not None:
-            moves.append(check_adjacent(x + 1, y + 1, 7))
-
-        if moves[0] is not None and moves[3] is not None:
-            moves.append(check_adjacent(x + 1, y - 1, 7))
-
-        if moves[1] is not None and moves[2] is not None:
-            moves.append(check_adjacent(x - 1, y + 1, 7))
-
-        if moves[1] is not None and moves[3] is not None:
-            moves.append(check_adjacent(x - 1, y - 1, 7))
+    # Check if creature can stand at specified window coordinates
+    def is_passable(self, x, y):
+        if not self.is_inside(x, y):
+            return False
+        return self._clearance[x + y*self._width] >= self._objsize
 
-        for move in moves:
-            if move is not None:
-                yield move
+    def is_passable_from(self, x, y, start_x, start_y):
+        """
+        Check if creature, standing at start tile, can move to specified tile.
+        Creature does not block itself, so tiles of its own square are blocked only by walls
+        :param x:int window x coordinate
+        :param y:int window y coordinate
+        :param start_x:int window x coordinate of the creature
+        :param start_y:int window y coordinate of the creature
+        """
+        if not self.is_inside(x, y):
+            return False
+        size = self._objsize
+        if self._clearance[x + y*self._width] >= size:
+            return True
+        if abs(x - start_x) >= size or abs(y - start_y) >= size:
+            return False
+        width = self._width
+        costmap = self._costmap
+        get_terrain = self._grid.get_terrain
+        for ty in range(y, y + size):
+            for tx in range(x, x + size):
+                if start_x <= tx < start_x + size and start_y <= ty < start_y + size:
+                    if get_terrain(tx + self._corner_x, ty + self._corner_y) == TERRAIN_WALL:
+                        return False
+                elif costmap[tx + ty*width] != 0:
+                    return False
+        return True
+
+    def get_clearance(self, x, y):
+        """
+        Get size of the largest free square with top left corner at specified tile
+        :param x:int grid x coordinate
+        :param y:int grid y coordinate
+        :return:int clearance, or 0 if the tile is outside the window
+        """
+        x -= self._corner_x
+        y -= self._corner_y
+        if not (0 <= x < self._width and 0 <= y < self._height):
+            return 0
+        return min(self._clearance[x + y*self._width], self._width - x, self._height - y)
+
+    # Octile distance from a tile to a rectangle
+    @staticmethod
+    def _heuristic(x, y, left, top, right, bottom):
+        dx = left - x if x < left else (x - right if x > right else 0)
+        dy = top - y if y < top else (y - bottom if y > bottom else 0)
+        if dx < dy:
+            return COST_DIAGONAL * dx + COST_STRAIGHT * (dy - dx)
+        return COST_DIAGONAL * dy + COST_STRAIGHT * (dx - dy)
+
+    def _new_search(self):
+        self.search_index += 1
+        return self.search_index
 
-    def expand_tile(self, tile, costfn=default_distance_cost):
+    def _run_astar(self, start_x, start_y, bounds):
         """
-        :param tile:
-        :param costfn: function for calculating tile cost
-        :return:
+        Runs A* search from start tile to any tile, marked by current search index in _target array
+
+        :param start_x:int window x coordinate of start tile
+        :param start_y:int window y coordinate of start tile
+        :param bounds: (left, top, right, bottom) - rectangle, containing all the target tiles
+        :return:Path | None
         """
-        # Check diagonals
-        for adjacent, cell_cost in self._get_adjacent(tile, tile.x, tile.y):
-            # Skip nodes that are already visited
-            if adjacent.pathstate == self.search_index:
-                continue
-            adjacent.g = tile.g + costfn(tile, adjacent) + cell_cost
-            adjacent.predecessor = tile
-            self.push_node(adjacent)
-        pass
+        if not self.is_inside(start_x, start_y):
+            return None
 
-    def push_node(self, node):
-        node.pathstate = self.get_wave_index()
-        heapq.heappush(self.open_list, (node.g, node))
+        search = self.search_index
+        width = self._width
+        g_score = self._g
+        parent = self._parent
+        visited = self._visited
+        closed = self._closed
+        target = self._target
+        is_passable = self.is_passable
+        if self._objsize > 1:
+            # Big creature overlaps its own square by the first moves
+            def is_passable(x, y):
+                return self.is_passable_from(x, y, start_x, start_y)
+        heuristic = self._heuristic
+        left, top, right, bottom = bounds
+        heappush = heapq.heappush
+        heappop = heapq.heappop
+
+        start = start_x + start_y * width
+        g_score[start] = 0
+        parent[start] = -1
+        visited[start] = search
+        h = heuristic(start_x, start_y, left, top, right, bottom)
+        self.open_list = open_list = [(h, h, start)]
+
+        while open_list:
+            f, h, index = heappop(open_list)
+            if closed[index] == search:
+                continue
+            closed[index] = search
 
-    def pop_node(self):
-        return heapq.heappop(self.open_list)[1]
+            # Check if we have reached our destination
+            if target[index] == search:
+                return self._compile_path(index)
+
+            y, x = divmod(index, width)
+            g = g_score[index]
+
+            straight = (is_passable(x + 1, y), is_passable(x - 1, y),
+                        is_passable(x, y + 1), is_passable(x, y - 1))
+
+            for dx, dy, cost, a, b in NEIGHBOUR_MOVES:
+                if not (straight[a] and straight[b]):
+                    continue
+                nx = x + dx
+                ny = y + dy
+                next_index = nx + ny * width
+                if closed[next_index] == search:
+                    continue
+                # Diagonal moves need their own check
+                if a != b and not is_passable(nx, ny):
+                    continue
+                new_g = g + cost
+                if visited[next_index] == search and g_score[next_index] <= new_g:
+                    continue
+                visited[next_index] = search
+                g_score[next_index] = new_g
+                parent[next_index] = index
+                h = heuristic(nx, ny, left, top, right, bottom)
+                # Ties are resolved in favour of tiles, closer to destination
+                heappush(open_list, (new_g + h, h, next_index))
+        return None
 
     # Compile path
-    def compile_path(self, start):
+    def _compile_path(self, index):
         path = Path(self._grid)
+        parent = self._parent
+        width = self._width
         # Building reversed path
-        current_node = start
-        while current_node.predecessor is not None:
-            path.append(Point(x=current_node.x + self._corner_x, y=current_node.y+self._corner_y))
-            current_node = current_node.predecessor
+        while parent[index] >= 0:
+            y, x = divmod(index, width)
+            path.append(Coord(x + self._corner_x, y + self._corner_y))
+            index = parent[index]
 
         # Flipping back reversed path
         path.reverse()
         return path
 
-    def get_wave_index(self):
-        return self.search_index
-
-    def get_target_index(self):
-        return self.search_index+1
-
-    def run_wave(self, start_node, finish_check):
-        start_node.g = 0
-        start_node.predecessor = None
-        self.open_list = []
-        self.push_node(start_node)
-
-        iteration = 0
-
-        while len(self.open_list) > 0:
-            # cost, current_tile = self.open_list.pop()
-            cost, current_tile = heapq.heappop(self.open_list)
-            # Check if we have reached our destination
-            if finish_check(current_tile):
-                return self.compile_path(current_tile)
-
-            self.expand_tile(current_tile)
-            iteration += 1
-        return None
+    # Mark tiles inside rectangle as destination. Coordinates are in grid space
+    # Returns marked bounds in window space, or None if no tile was marked
+    def _mark_targets(self, tiles):
+        search = self.search_index
+        target = self._target
+        width = self._width
+        left = top = right = bottom = None
+        for x, y in tiles:
+            x -= self._corner_x
+            y -= self._corner_y
+            if not self.is_inside(x, y):
+                continue
+            target[x + y * width] = search
+            if left is None:
+                left = right = x
+                top = bottom = y
+            else:
+                left = min(left, x)
+                right = max(right, x)
+                top = min(top, y)
+                bottom = max(bottom, y)
+        if left is None:
+            return None
+        return left, top, right, bottom
 
     def path_to_range(self, start_pos, dest, range):
-        self.sync_grid(self.grid)
         """
         :param start_pos:Point starting position
         :param dest:Point
         :param range:float desired range
         :return:Path
         """
-        center_x = start_pos.x - self._corner_x
-        center_y = start_pos.y - self._corner_y
-
-        def in_range(node):
-            distance = math.sqrt((center_x - node.x)**2 + (center_y - node.y)**2)*5
-            return distance <= range
-
-        start_node = self._get_node(start_pos.x, start_pos.y)
-
-        # Run wave and compile the path
-        return self.run_wave(start_node, in_range)
+        self._new_search()
+        distance = range / 5
+        tiles = [(x, y) for x, y in get_coord_range(dest, distance + 1)
+                 if math.sqrt((dest.x - x)**2 + (dest.y - y)**2) <= distance]
+        bounds = self._mark_targets(tiles)
+        if bounds is None:
+            return None
+        return self._run_astar(start_pos.x - self._corner_x, start_pos.y - self._corner_y, bounds)
 
     # Drawing a straight path for charge attacks
     def check_straight_path(self, start_pos, dest):
-        # There are obstacles that are created by the unit itself
-        # Pathfinder breaks into this obstacles
-        line_path = get_line(start_pos.tuple(), dest.tuple())
-        limit = 0
+        """
+        Check straight path for a charge. Creature does not block itself,
+        so only walls are checked inside its own square
+        :param start_pos: tile of the creature
+        :param dest: destination tile
+        :return:Path | None, path without the starting tile
+        """
+        # Line is drawn in window coordinates
+        start = (start_pos.x - self._corner_x, start_pos.y - self._corner_y)
+        finish = (dest.x - self._corner_x, dest.y - self._corner_y)
         path = Path(self._grid)
-        sum_obstacles = 0
-        for x, y in line_path:
-            move_cost = self.sum_obstacle(x, y)
-            if move_cost > limit:
+        for x, y in get_line(start, finish)[1:]:
+            if not self.is_passable_from(x, y, start[0], start[1]):
                 return None
-            path.append(Point(x=x+self._corner_x, y=y+self._corner_y))
-            sum_obstacles += move_cost
-        # Flipping back reversed path
-        path.reverse()
+            path.append(Coord(x + self._corner_x, y + self._corner_y))
         return path
 
     def path_to_melee_range(self, start_pos, dest, range0, range1):
         """
         Calculate path to any tile in range of dest_tile
-        :param start_tile: starting tile
-        :param dest_tile: destination tile
-        :param range: minimal range to achieve
-        :return:
-        """
-        self.search_index += 2
-        if range0 > range1:
-            tmp = range0
-            range0 = range1
-            range1 = tmp
-
-        dest.x -= self._corner_x
-        dest.y -= self._corner_y
-
-        # Mark destination tiles
-        tiles_near = get_coord_range(dest, range0)
-        tiles_far = get_coord_range(dest, range1)
-
-        for tile in tiles_far:
-            if tile in tiles_near:
-                continue
-            node = self._get_node(*tile)
-            if node is not None:
-                node.target_mark = self.get_target_index()
+        :param start_pos: starting tile
+        :param dest: center of destination area
+        :param range0: inner range
+        :param range1: outer range
+        :return:Path | None
+        """
+        self._new_search()
+        bounds = self._mark_targets(get_melee_range_tiles(dest, range0, range1))
+        if bounds is None:
+            return None
 
-        start_node = self._get_node(start_pos.x - self._corner_x, start_pos.y - self._corner_y)
-        # Run wave and compile the path
-        return self.run_wave(start_node, lambda x: x.target_mark == self.get_target_index())
+        return self._run_astar(start_pos.x - self._corner_x, start_pos.y - self._corner_y, bounds)
 
     # Find path between tiles
-    #
     def path_between_tiles(self, start_tile, dest_tile):
-        self.sync_grid(self.grid)
-        self.search_index += 2
-        return self.run_wave(start_tile, lambda x: x == dest_tile)
+        self._new_search()
+        bounds = self._mark_targets([(dest_tile.x, dest_tile.y)])
+        if bounds is None:
+            return None
+        return self._run_astar(start_tile.x - self._corner_x, start_tile.y - self._corner_y, bounds)
+
+
+class DistanceField(object):
+    """
+    Path costs from grid tiles to the nearest destination tile
+
+    Field is calculated by multi-source Dijkstra, starting from all destination tiles.
+    Search is lazy: it is expanded only until requested tile is settled, and later
+    requests continue the same search. Search reads passability only around the settled tiles
+    and the destinations, so the field stays valid after grid changes outside of this area.
+    """
+
+    def __init__(self, pathfinder, tiles):
+        """
+        :param PathFinder pathfinder: pathfinder, attached to the grid. Provides passability of the tiles
+        :param tiles: grid coordinates of destination tiles
+        """
+        self._pathfinder = pathfinder
+        self._revision = pathfinder._revision
+        size = pathfinder._width * pathfinder._height
+        # Path cost to the nearest destination, for each tile
+        self._cost = [-1] * size
+        # Index of the next tile in the path to destination
+        self._next = [-1] * size
+        self._closed = [False] * size
+        self._targets = set()
+        self._open_list = []
+        # Bounding box of settled and destination tiles, in window coordinates: [x0, y0, x1, y1]
+        self._bounds = None
+
+        width = pathfinder._width
+        for x, y in tiles:
+            x -= pathfinder._corner_x
+            y -= pathfinder._corner_y
+            if not pathfinder.is_inside(x, y):
+                continue
+            index = x + y * width
+            self._targets.add(index)
+            self._extend_bounds(x, y)
+            # Destination is reached only if creature can stand there
+            if pathfinder.is_passable(x, y) and self._cost[index] != 0:
+                self._cost[index] = 0
+                self._open_list.append((0, index))
+
+    @property
+    def revision(self):
+        return self._revision
+
+    def _extend_bounds(self, x, y):
+        bounds = self._bounds
+        if bounds is None:
+            self._bounds = [x, y, x, y]
+            return
+        if x < bounds[0]:
+            bounds[0] = x
+        elif x > bounds[2]:
+            bounds[2] = x
+        if y < bounds[1]:
+            bounds[1] = y
+        elif y > bounds[3]:
+            bounds[3] = y
+
+    def is_affected(self, changes):
+        """
+        Check if grid changes can alter this field
+        :param changes: changed grid areas (left, top, right, bottom), like Grid.changes_since returns
+        :return: True if the field should be dropped
+        """
+        if changes is None:
+            return True
+        if self._bounds is None:
+            return False
+        pathfinder = self._pathfinder
+        # Passability of neighbours of the settled tiles is read by the search
+        x0, y0, x1, y1 = self._bounds
+        x0 += pathfinder._corner_x - 1
+        y0 += pathfinder._corner_y - 1
+        x1 += pathfinder._corner_x + 1
+        y1 += pathfinder._corner_y + 1
+        # Tile is passable for a big creature, if all the tiles of its square are free.
+        # So changed tile affects tiles up to objsize-1 to the left and above of it
+        extent = pathfinder._objsize - 1
+        for left, top, right, bottom in changes:
+            if left - extent <= x1 and right - 1 >= x0 and top - extent <= y1 and bottom - 1 >= y0:
+                return True
+        return False
+
+    # Expand search until tile with specified index is settled
+    def _settle(self, index):
+        closed = self._closed
+        if closed[index]:
+            return
+        pathfinder = self._pathfinder
+        objsize = pathfinder._objsize
+        clearance = pathfinder._clearance
+        width = pathfinder._width
+        # Max coordinates, where creature is still inside the window
+        max_x = width - objsize
+        max_y = pathfinder._height - objsize
+        cost = self._cost
+        next_tile = self._next
+        open_list = self._open_list
+        heappush = heapq.heappush
+        heappop = heapq.heappop
+
+        while open_list and not closed[index]:
+            g, current = heappop(open_list)
+            if closed[current]:
+                continue
+            closed[current] = True
+            y, x = divmod(current, width)
+            self._extend_bounds(x, y)
+
+            # Looking for tiles, that can make a move to the current tile
+            for dx, dy, move_cost, a, b in NEIGHBOUR_MOVES:
+                px = x - dx
+                py = y - dy
+                if not (0 <= px <= max_x and 0 <= py <= max_y):
+                    continue
+                prev = px + py * width
+                if closed[prev] or clearance[prev] < objsize:
+                    continue
+                # Diagonal move also needs both straight moves from previous tile.
+                # These tiles are neighbours of the current one, so they are inside the window
+                if a != b and (clearance[prev + dx] < objsize or clearance[prev + dy * width] < objsize):
+                    continue
+                new_g = g + move_cost
+                if cost[prev] < 0 or new_g < cost[prev]:
+                    cost[prev] = new_g
+                    next_tile[prev] = current
+                    heappush(open_list, (new_g, prev))
+
+    def distance(self, x, y):
+        """
+        Get path cost from specified tile to the nearest destination
+        :param x:int grid x coordinate
+        :param y:int grid y coordinate
+        :return:int path cost, or None if destination can not be reached
+        """
+        pathfinder = self._pathfinder
+        x -= pathfinder._corner_x
+        y -= pathfinder._corner_y
+        if not pathfinder.is_passable(x, y):
+            return None
+        index = x + y * pathfinder._width
+        self._settle(index)
+        if not self._closed[index]:
+            return None
+        return self._cost[index]
+
+    def path_from(self, start_pos):
+        """
+        Get path from specified position to the nearest destination.
+        Starting tile can be impassable, like for A* search: it is usually occupied by the creature itself.
+        Creature does not block itself, so the tiles, that overlap its own square, are searched separately
+        and the field is followed from the first tile outside of it
+        :param start_pos:Point starting position
+        :return:Path | None
+        """
+        pathfinder = self._pathfinder
+        width = pathfinder._width
+        corner_x = pathfinder._corner_x
+        corner_y = pathfinder._corner_y
+        start_x = start_pos.x - corner_x
+        start_y = start_pos.y - corner_y
+        if not pathfinder.is_inside(start_x, start_y):
+            return None
+        path = Path(pathfinder.grid)
+        start = start_x + start_y * width
+        if start in self._targets:
+            return path
+
+        size = pathfinder._objsize
+        is_passable = pathfinder.is_passable
+        if size > 1:
+            def is_passable(x, y):
+                return pathfinder.is_passable_from(x, y, start_x, start_y)
+
+        # Search over the tiles of own square: index -> (cost, previous index)
+        local = {start: (0, -1)}
+        local_closed = set()
+        local_open = [(0, start)]
+        # Best way to the destination: (total cost, last local tile, first field tile)
+        best = None
+        while local_open:
+            g, index = heapq.heappop(local_open)
+            if index in local_closed:
+                continue
+            local_closed.add(index)
+            y, x = divmod(index, width)
+            if index != start and index in self._targets and (best is None or g < best[0]):
+                best = (g, index, -1)
+
+            straight = (is_passable(x + 1, y), is_passable(x - 1, y),
+                        is_passable(x, y + 1), is_passable(x, y - 1))
+            for dx, dy, move_cost, a, b in NEIGHBOUR_MOVES:
+                if not (straight[a] and straight[b]):
+                    continue
+                nx = x + dx
+                ny = y + dy
+                if a != b and not is_passable(nx, ny):
+                    continue
+                next_index = nx + ny * width
+                new_g = g + move_cost
+                if abs(nx - start_x) < size and abs(ny - start_y) < size:
+                    if next_index not in local or new_g < local[next_index][0]:
+                        local[next_index] = (new_g, index)
+                        heapq.heappush(local_open, (new_g, next_index))
+                    continue
+                # Following the field from here
+                self._settle(next_index)
+                if not self._closed[next_index]:
+                    continue
+                total = new_g + self._cost[next_index]
+                if best is None or total < best[0]:
+                    best = (total, index, next_index)
+
+        if best is None:
+            return None
+
+        _, index, field_index = best
+        steps = []
+        while index != start:
+            steps.append(index)
+            index = local[index][1]
+        steps.reverse()
+        index = field_index
+        while index >= 0:
+            steps.append(index)
+            index = self._next[index]
+        for index in steps:
+            y, x = divmod(index, width)
+            path.append(Coord(x + corner_x, y + corner_y))
+        return path
+
+
+def get_reach_tiles(target, reach, objsize=1):
+    """
+    Get tiles for the top left corner of the mover, where target is in its reach
+    :param Entity target: target entity
+    :param reach: reach of the mover, in tiles
+    :param int objsize: size of the mover
+    :return: list of (x, y) tiles
+    """
+    # Big mover is measured from its border, so the area is shifted and grown by the size of the mover
+    shift = (objsize - 1) * 0.5
+    near = (target.get_size() + objsize - 1) * 0.5
+    far = near + reach
+    center = target.get_center()
+    return get_melee_range_tiles(Point(x=center.x - shift, y=center.y - shift), near, far)
+
+
+class DistanceFieldCache(object):
+    """
+    Shares distance fields between all the brains of a battle
+
+    Fields are keyed by (target, target position, reach, mover size), so brains, pursuing
+    the same enemy, read the same field. When grid revision changes, only the fields,
+    that have read the changed tiles, are dropped. Combatants change the grid by every move,
+    so a field survives only while all the movers stay away from its explored area.
+    """
+
+    def __init__(self, grid):
+        self._grid = grid
+        self._revision = grid.revision
+        # Pathfinders for each mover size, attached to the whole grid
+        self._pathfinders = {}
+        self._fields = {}
+        self.hits = 0
+        self.misses = 0
+
+    def get_pathfinder(self, objsize=1):
+        """
+        Get pathfinder for the movers of specified size, synced to the current state of the grid
+        :param int objsize: size of the mover
+        :rtype: PathFinder
+        """
+        pathfinder = self._pathfinders.get(objsize)
+        if pathfinder is None:
+            pathfinder = PathFinder(objsize=objsize)
+            self._pathfinders[objsize] = pathfinder
+        # Costmap is synced incrementally
+        pathfinder.sync_grid(self._grid)
+        return pathfinder
+
+    # Drop fields, that are affected by the grid changes
+    def _invalidate(self):
+        changes = self._grid.changes_since(self._revision)
+        self._revision = self._grid.revision
+        if changes is None:
+            self._fields.clear()
+            return
+        for key, field in list(self._fields.items()):
+            if field.is_affected(changes):
+                del self._fields[key]
+
+    def get_field(self, target, reach, objsize=1):
+        """
+        Get distance field to any tile in reach of target
+        :param Entity target: target entity
+        :param reach: reach of the mover, in tiles
+        :param int objsize: size of the mover
+        :return:DistanceField
+        """
+        if self._grid.revision != self._revision:
+            self._invalidate()
+
+        key = (target, target.x, target.y, reach, objsize)
+        field = self._fields.get(key)
+        # Kept fields continue the search on the current costmap
+        pathfinder = self.get_pathfinder(objsize)
+        if field is None:
+            self.misses += 1
+            field = DistanceField(pathfinder, get_reach_tiles(target, reach, objsize))
+            self._fields[key] = field
+        else:
+            self.hits += 1
+        return field
+
+    # Number of cached fields
+    def __len__(self):
+        return len(self._fields)
 
 
 class Path(object):
@@ -0,0 +1,287 @@
+"""
+Attack profiles for what-if analysis
+
+AttackProfile is an immutable snapshot of the combatant state, that is used for attack generation.
+Hypothetical styles, weapons and status flags are applied to a profile and produce a new profile,
+so live combatants are never changed by speculative estimations.
+"""
+from .core import *
+from . import attackdesc
+
+
+class AttackProfile(object):
+    """
+    Immutable snapshot of a combatant for attack estimations
+
+    Profile mimics the part of Combatant interface, that is used by attack generation, AC calculation,
+    styles and on_calc_attack handlers of the feats. So handlers get a profile instead of combatant.
+    Profiles can be shared between threads. Feat handlers are closures, so profiles should be built
+    inside a worker process, if a process pool is used.
+    """
+    __slots__ = ('name', 'health', '_stats', '_size_type', '_size_cat', '_BAB',
+                 '_attack_bonus_style', '_damage_bonus_style', '_two_hand_wield', '_many_weapon_wield',
+                 '_main_weapon', '_offhand_weapon', '_bonus_strikes', '_calc_handlers', '_feat_names',
+                 '_AC', '_ac_armor', '_ac_dodge', '_ac_natural', '_ac_deflection', '_max_dex_ac',
+                 '_status_flags', '_active_styles', '_skills', '_armor_check_penalty', '_armor_type',
+                 '_frozen')
+
+    def __init__(self, combatant):
+        """
+        Take a snapshot of the combatant
+        :param Combatant combatant: source combatant
+        """
+        values = {
+            'name': combatant.get_name(),
+            'health': combatant.health,
+            '_stats': tuple(combatant._stats),
+            '_size_type': combatant._size_type,
+            '_size_cat': combatant._size_cat,
+            '_BAB': combatant._BAB,
+            '_attack_bonus_style': combatant._attack_bonus_style,
+            '_damage_bonus_style': combatant._damage_bonus_style,
+            '_two_hand_wield': combatant._two_hand_wield,
+            '_many_weapon_wield': combatant._many_weapon_wield,
+            '_main_weapon': combatant.get_main_weapon(),
+            '_offhand_weapon': combatant.get_offhand_weapon(),
+            '_bonus_strikes': tuple(desc.copy() for desc in combatant._additional_strikes),
+            '_calc_handlers': tuple(combatant.event_manager.on_calc_attack),
+            '_feat_names': tuple(feat.name for feat in combatant._feats),
+            '_AC': combatant._AC,
+            '_ac_armor': combatant._ac_armor,
+            '_ac_dodge': combatant._ac_dodge,
+            '_ac_natural': combatant._ac_natural,
+            '_ac_deflection': combatant._ac_deflection,
+            '_max_dex_ac': combatant._max_dex_ac,
+            '_status_flags': frozenset(combatant._status_flags),
+            '_active_styles': tuple(combatant._active_styles),
+            '_skills': tuple((skill, combatant.skill_levels(skill))
+                             for skill in set(combatant._skills) | set(combatant._skill_bonus)),
+            '_armor_check_penalty': combatant.armor_check_penalty(),
+            '_armor_type': combatant.get_armor_type(),
+        }
+        for key, value in values.items():
+            object.__setattr__(self, key, value)
+        object.__setattr__(self, '_frozen', True)
+
+    @staticmethod
+    def from_combatant(combatant):
+        """
+        :rtype: AttackProfile
+        """
+        return AttackProfile(combatant)
+
+    def __setattr__(self, key, value):
+        if self._frozen:
+            raise AttributeError("AttackProfile is immutable")
+        object.__setattr__(self, key, value)
+
+    # Get mutable copy. Used only to build a new profile
+    def _thaw(self):
+        result = object.__new__(AttackProfile)
+        for key in AttackProfile.__slots__:
+            object.__setattr__(result, key, getattr(self, key))
+        object.__setattr__(result, '_frozen', False)
+        return result
+
+    def _freeze(self):
+        object.__setattr__(self, '_frozen', True)
+        return self
+
+    def __getstate__(self):
+        return {key: getattr(self, key) for key in AttackProfile.__slots__}
+
+    def __setstate__(self, state):
+        for key, value in state.items():
+            object.__setattr__(self, key, value)
+
+    # What-if modifications #
+
+    def with_styles(self, *styles):
+        """
+        Get profile with activated styles
+        Styles keep their own state, like applied bonuses. A private copy of the style is activated,
+        so shared style objects are never changed, and profiles can be built concurrently
+        :rtype: AttackProfile
+        """
+        result = self._thaw()
+        for style in styles:
+            result._active_styles = result._active_styles + (style,)
+            style.copy().on_start(result)
+        return result._freeze()
+
+    def with_weapons(self, main=None, offhand=None):
+        """
+        Get profile with different weapons. Wield style is recalculated, like check_weapon_wield does
+        :param Weapon main: main hand weapon
+        :param Item offhand: offhand item, like a weapon or a shield
+        :rtype: AttackProfile
+        """
+        result = self._thaw()
+        result._attack_bonus_style += self._wield_penalty()
+        result._main_weapon = main
+        result._offhand_weapon = offhand
+
+        two_handed = False
+        two_weapon_fighting = False
+        if main is not None:
+            two_handed = main.is_two_handed()
+            if offhand is not None and offhand.is_weapon():
+                two_handed = False
+                two_weapon_fighting = True
+        result._two_hand_wield = two_handed
+        result._many_weapon_wield = two_weapon_fighting
+        result._attack_bonus_style -= result._wield_penalty()
+        return result._freeze()
+
+    def with_status_flag(self, status, enabled=True):
+        """
+        Get profile with added or removed status flag
+        :rtype: AttackProfile
+        """
+        result = self._thaw()
+        if enabled:
+            result._status_flags = self._status_flags | {status}
+        else:
+            result._status_flags = self._status_flags - {status}
+        return result._freeze()
+
+    # Attack penalty for two weapon fighting
+    def _wield_penalty(self):
+        if not self._many_weapon_wield:
+            return 0
+        return 4 if self._offhand_weapon.is_light(self) else 6
+
+    # Part of combatant interface, that is used by styles #
+
+    def modify_ac_dodge(self, mod, source=None):
+        self._ac_dodge += mod
+
+    def modify_ac_armor(self, mod, source=None):
+        self._ac_armor += mod
+
+    def modify_ac_dex(self, mod):
+        self._max_dex_ac = min(self._max_dex_ac, mod)
+
+    def modify_stat(self, stat, value, source=None):
+        stats = list(self._stats)
+        stats[stat] += int(value)
+        self._stats = tuple(stats)
+
+    # Saves and movement do not affect attacks
+    def modify_save_will(self, mod, *args):
+        pass
+
+    def modify_movement(self, mod):
+        pass
+
+    def modify_move_speed(self, mod, source=None):
+        pass
+
+    def add_bonus_strike(self, weapon, immediate=False, **kwargs):
+        attack = kwargs.pop('attack', 0)
+        if 'bab' in kwargs:
+            attack = self._BAB + kwargs['bab'] + self._attack_bonus_style
+        desc = self.generate_attack(attack, weapon, target=None, **kwargs)
+        self._bonus_strikes = self._bonus_strikes + (desc,)
+        return desc
+
+    def expend_attack(self, desc):
+        pass
+
+    # Read-only combatant interface #
+
+    def get_name(self):
+        return self.name
+
+    def __repr__(self):
+        return "<profile " + self.name + ">"
+
+    def has_status_flag(self, status):
+        return status in self._status_flags
+
+    def get_main_weapon(self, default=None):
+        return self._main_weapon if self._main_weapon is not None else default
+
+    def get_offhand_weapon(self, default=None):
+        return self._offhand_weapon if self._offhand_weapon is not None else default
+
+    def get_armor_type(self):
+        return self._armor_type
+
+    def armor_check_penalty(self):
+        return self._armor_check_penalty
+
+    def skill_levels(self, skill):
+        for known, levels in self._skills:
+            if known == skill:
+                return levels
+        if skill.trained:
+            return 0
+        result = ability_modifier(self._stats[skill.ability])
+        if skill.armor:
+            result -= self._armor_check_penalty
+        return result
+
+    def strength_modifier(self):
+        return ability_modifier(self._stats[STAT_STR])
+
+    def dexterity_modifier(self):
+        return ability_modifier(self._stats[STAT_DEX])
+
+    def constitution_modifier(self):
+        return ability_modifier(self._stats[STAT_CON])
+
+    def intellect_modifier(self):
+        return ability_modifier(self._stats[STAT_INT])
+
+    def wisdom_modifier(self):
+        return ability_modifier(self._stats[STAT_WIS])
+
+    def charisma_modifier(self):
+        return ability_modifier(self._stats[STAT_CHA])
+
+    def get_armor_class(self, target=None):
+        armor_class = self._AC + self._ac_deflection + self._ac_dodge + self._ac_natural + self._ac_armor
+        if self._size_cat is not None:
+            armor_class += self._size_cat.ac_mod
+        armor_class += min(self.dexterity_modifier(), self._max_dex_ac)
+        return armor_class
+
+    def get_touch_armor_class(self, target=None):
+        armor_class = self._AC + self._ac_deflection + self._ac_dodge
+        if self._size_cat is not None:
+            armor_class += self._size_cat.ac_mod
+        armor_class += min(self.dexterity_modifier(), self._max_dex_ac)
+        return armor_class
+
+    def state_fingerprint(self):
+        """
+        Hashable fingerprint of the profile. Health is not included
+        :return: tuple
+        """
+        strikes = tuple((desc.weapon, desc.attack, desc.damage, desc.bonus_damage,
+                         desc.critical_confirm_bonus, desc.touch, desc.offhand) for desc in self._bonus_strikes)
+        return ('profile', self._stats, self._size_type, self._BAB,
+                self._attack_bonus_style, self._damage_bonus_style,
+                self._two_hand_wield, self._many_weapon_wield, self._main_weapon, self._offhand_weapon,
+                self._AC, self._ac_armor, self._ac_dodge, self._ac_natural, self._ac_deflection, self._max_dex_ac,
+                self._status_flags, self._feat_names, self._active_styles, strikes)
+
+    # Attack generation #
+
+    def generate_attack(self, attack, weapon, target, **kwargs):
+        """
+        The same as Combatant.generate_attack, but on_calc_attack handlers get the profile
+        :rtype: AttackDesc
+        """
+        return attackdesc.generate_attack(self, attack, weapon, target, self._calc_handlers, **kwargs)
+
+    def generate_bab_chain(self, target=None, **kwargs):
+        """
+        Generate attack chain for full attack action. Bonus strikes are not consumed
+        :param target: target to be attacked
+        :return: list of AttackDesc
+        """
+        attack_chain = attackdesc.generate_bab_chain(self, target, **kwargs)
+        attack_chain.extend(desc.copy() for desc in self._bonus_strikes)
+        return attack_chain
@@ -0,0 +1,216 @@
+"""
+Opt-in profiling of battle turn processing
+
+Battle reports phases of turn processing to a Profiler, if it is attached:
+brain turn preparation, action generation, pathfinding, attacks of opportunity
+and grid registration. Profiler collects wall time and call counts per phase,
+per combatant and per round, and exports them as json or Chrome trace format.
+Phases can be nested, like pathfinding inside make_turn. Phase 'time' counts only its own time,
+without the nested phases, so the times of all phases add up to the profiled time.
+Phase 'inclusive' time counts the nested phases as well.
+Battles without profiler pay only for a check for None.
+"""
+import contextlib
+import json
+import time
+
+
+# Context manager that does nothing. Used when profiling is disabled
+NULL_SECTION = contextlib.nullcontext()
+
+
+class _Section(object):
+    """
+    Times a single phase call
+    """
+    __slots__ = ('_profiler', '_phase', '_name', '_start')
+
+    def __init__(self, profiler, phase, name):
+        self._profiler = profiler
+        self._phase = phase
+        self._name = name
+        self._start = 0
+
+    def __enter__(self):
+        self._profiler._push()
+        self._start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        elapsed = time.perf_counter() - self._start
+        own = self._profiler._pop(elapsed)
+        self._profiler.record(self._phase, self._name, self._start, elapsed, own=own)
+        return False
+
+
+class Profiler(object):
+    """
+    Collects wall time and call counts of battle phases
+    """
+    def __init__(self, **kwargs):
+        """
+        :param bool trace: keep every call for Chrome trace export
+        """
+        self.trace = kwargs.get('trace', True)
+        # Current battle round. Updated by the battle
+        self.round = 0
+        # (phase, combatant name, round) -> [calls, own time, inclusive time]
+        self._stats = {}
+        # Time of nested sections for every open section
+        self._nested = []
+        self._events = []
+        self._origin = time.perf_counter()
+
+    @staticmethod
+    def _get_name(combatant):
+        if combatant is None:
+            return None
+        return combatant.get_name() if hasattr(combatant, 'get_name') else str(combatant)
+
+    def section(self, phase, combatant=None):
+        """
+        Get context manager, that times a phase call
+        :param str phase: phase name, like 'prepare_turn'
+        :param combatant: combatant, that is processed by the phase
+        """
+        return _Section(self, phase, self._get_name(combatant))
+
+    # Open a section
+    def _push(self):
+        self._nested.append(0.0)
+
+    # Close a section. Its time is added to the enclosing section as nested one
+    # :return: own time of the section, without nested sections
+    def _pop(self, elapsed):
+        nested = self._nested.pop()
+        if self._nested:
+            self._nested[-1] += elapsed
+        return elapsed - nested
+
+    def record(self, phase, name, start, elapsed, calls=1, own=None):
+        """
+        Record phase time
+        :param str phase: phase name
+        :param name: combatant name, or None
+        :param float start: perf_counter value at the start of the call
+        :param float elapsed: wall time of the call, in seconds
+        :param int calls: number of calls
+        :param float own: time without nested sections. Same as elapsed if None
+        """
+        if own is None:
+            own = elapsed
+        key = (phase, name, self.round)
+        stats = self._stats.get(key)
+        if stats is None:
+            self._stats[key] = [calls, own, elapsed]
+        else:
+            stats[0] += calls
+            stats[1] += own
+            stats[2] += elapsed
+        if self.trace:
+            self._events.append((phase, name, self.round, start, elapsed))
+
+    def wrap_generator(self, generator, phase, combatant=None):
+        """
+        Time a generator. Only the time spent inside the generator is counted,
+        not the time of the consumer between the steps. Whole generator is counted as a single call
+        :return: generator, that yields the same values
+        """
+        name = self._get_name(combatant)
+        total = 0.0
+        own = 0.0
+        started = None
+        try:
+            while True:
+                self._push()
+                start = time.perf_counter()
+                if started is None:
+                    started = start
+                finished = False
+                try:
+                    value = next(generator)
+                except StopIteration:
+                    finished = True
+                finally:
+                    elapsed = time.perf_counter() - start
+                    own += self._pop(elapsed)
+                    total += elapsed
+                if finished:
+                    return
+                if self.trace:
+                    self._events.append((phase, name, self.round, start, elapsed))
+                yield value
+        finally:
+            if started is not None:
+                key = (phase, name, self.round)
+                stats = self._stats.setdefault(key, [0, 0.0, 0.0])
+                stats[0] += 1
+                stats[1] += own
+                stats[2] += total
+
+    def clear(self):
+        self._stats = {}
+        self._events = []
+        self._origin = time.perf_counter()
+
+    @staticmethod
+    def _add(table, key, calls, own, total):
+        entry = table.setdefault(key, {'calls': 0, 'time': 0.0, 'inclusive': 0.0})
+        entry['calls'] += calls
+        entry['time'] += own
+        entry['inclusive'] += total
+
+    def to_dict(self):
+        """
+        Get aggregated stats
+        :return: dict with 'phases', 'combatants' and 'rounds' tables. Times are in seconds.
+            'time' excludes nested phases, 'inclusive' counts them
+        """
+        phases = {}
+        combatants = {}
+        rounds = {}
+        for (phase, name, round), (calls, own, total) in sorted(self._stats.items(), key=lambda item: str(item[0])):
+            self._add(phases, phase, calls, own, total)
+            if name is not None:
+                self._add(combatants.setdefault(name, {}), phase, calls, own, total)
+            self._add(rounds.setdefault(round, {}), phase, calls, own, total)
+        return {
+            'phases': phases,
+            'combatants': combatants,
+            'rounds': dict(sorted(rounds.items())),
+        }
+
+    def to_chrome_trace(self):
+        """
+        Get recorded calls in Chrome trace event format. Can be opened by chrome://tracing or Perfetto
+        Every combatant gets its own thread row
+        :return: dict
+        """
+        threads = {}
+        events = []
+        for phase, name, round, start, elapsed in self._events:
+            thread = threads.setdefault(name, len(threads))
+            events.append({
+                'name': phase,
+                'cat': 'battle',
+                'ph': 'X',
+                'ts': (start - self._origin) * 1e6,
+                'dur': elapsed * 1e6,
+                'pid': 0,
+                'tid': thread,
+                'args': {'round': round, 'combatant': name},
+            })
+        for name, thread in threads.items():
+            events.append({'name': 'thread_name', 'ph': 'M', 'pid': 0, 'tid': thread,
+                           'args': {'name': name if name is not None else 'battle'}})
+        return {'traceEvents': events, 'displayTimeUnit': 'ms'}
+
+    def save(self, path, format='json'):
+        """
+        Save profile to a file
+        :param str path: file path
+        :param str format: 'json' for aggregated stats, or 'chrome' for Chrome trace
+        """
+        data = self.to_chrome_trace() if format == 'chrome' else self.to_dict()
+        with open(path, 'w') as file:
+            json.dump(data, file, indent=1)
@@ -43,11 +43,9 @@ class Basic(Progression):
         if ch.current_level() == 0:
             hit_points += self.hits
             level_to -= 1
-        dice = Dice()
-        for a in range(level_to):
-            dice.add_die(self.hits)
+        dice = Dice().with_die(self.hits, level_to)
 
-        hit_points += dice.roll()
+        hit_points += dice.roll(ch.rng)
         ch._health_max += hit_points
 
 
@@ -0,0 +1,348 @@
+"""
+Battle replay
+
+ReplayWriter is a combat log sink, that stores records as a compact append-only binary stream.
+Battle start, spawned combatants, initiative, resolved attack rolls, moves, damage and status changes
+are enough to rebuild the state of the combatants, so brains and pathfinding are not run again.
+Records refer to combatants by name, so names of combatants in a recorded battle must be unique.
+Writer also stores snapshots of the state every few rounds. Replay seeks to the nearest snapshot
+and applies only the events after it.
+
+Usage:
+    writer = ReplayWriter(snapshot_interval=5)
+    run_battle(scenario, log=CombatLog(writer))
+    replay = Replay(writer.getvalue())
+    state = replay.state_at(12)
+
+Stream format: magic bytes, then frames. Every frame starts with a byte code:
+    - record frame: record code and fields, packed by record layout from sim.combatlog
+    - string frame: new entry of the string table, strings in records are indices in this table
+    - snapshot frame: round, size of the payload and states of all the combatants
+"""
+import bisect
+import io
+import struct
+
+from .combatlog import RECORD_TYPES, BattleStart, Spawn, Initiative, Damage, Move, StatusFlag, RoundStart, RoundEnd
+
+MAGIC = b'PD20RPL1'
+
+_FRAME_STRING = 255
+_FRAME_SNAPSHOT = 254
+
+# code, length of utf-8 text
+_STRING_HEADER = struct.Struct('<BH')
+# code, round, payload size in bytes
+_SNAPSHOT_HEADER = struct.Struct('<BiI')
+# name, faction, x, y, health, health max, initiative, number of status flags
+_COMBATANT = struct.Struct('<IIiiiiiH')
+_FLAG = struct.Struct('<i')
+
+
+class CombatantState(object):
+    """
+    Replayed state of a combatant
+    """
+    __slots__ = ('name', 'faction', 'x', 'y', 'health', 'health_max', 'initiative', 'flags')
+
+    def __init__(self, name, faction, x, y, health, health_max, initiative=0, flags=()):
+        self.name = name
+        self.faction = faction
+        self.x = x
+        self.y = y
+        self.health = health
+        self.health_max = health_max
+        self.initiative = initiative
+        self.flags = set(flags)
+
+    def copy(self):
+        return CombatantState(self.name, self.faction, self.x, self.y, self.health, self.health_max,
+                              self.initiative, self.flags)
+
+    def is_consciousness(self):
+        return self.health >= 0
+
+    def is_dead(self):
+        return self.health <= -10
+
+    def to_tuple(self):
+        return (self.name, self.faction, self.x, self.y, self.health, self.health_max, self.initiative,
+                frozenset(self.flags))
+
+    def __eq__(self, other):
+        return isinstance(other, CombatantState) and self.to_tuple() == other.to_tuple()
+
+    def __repr__(self):
+        return "%s(%s) at (%d, %d) HP=%d/%d" % (self.name, self.faction, self.x, self.y, self.health, self.health_max)
+
+
+class ReplayState(object):
+    """
+    State of the battle, rebuilt from the records
+    """
+    def __init__(self):
+        self.width = 0
+        self.height = 0
+        self.seed = -1
+        # Current round
+        self.round = 0
+        # name -> CombatantState, in order of spawning
+        self.combatants = {}
+
+    def copy(self):
+        result = ReplayState()
+        result.width = self.width
+        result.height = self.height
+        result.seed = self.seed
+        result.round = self.round
+        result.combatants = {name: state.copy() for name, state in self.combatants.items()}
+        return result
+
+    def apply(self, record):
+        """
+        Apply a record to the state. Records, that do not change the state, are skipped
+        """
+        handler = ReplayState._handlers.get(type(record))
+        if handler is not None:
+            handler(self, record)
+
+    def _on_battle_start(self, record):
+        self.width, self.height, self.seed = record
+
+    def _on_spawn(self, record):
+        if record.combatant in self.combatants:
+            raise ValueError("Combatant name '%s' is not unique, it can not be replayed" % record.combatant)
+        self.combatants[record.combatant] = CombatantState(*record)
+
+    def _on_initiative(self, record):
+        self.combatants[record.combatant].initiative = record.initiative
+
+    def _on_damage(self, record):
+        self.combatants[record.target].health = record.health
+
+    def _on_move(self, record):
+        state = self.combatants[record.combatant]
+        state.x = record.dest_x
+        state.y = record.dest_y
+
+    def _on_status_flag(self, record):
+        flags = self.combatants[record.combatant].flags
+        if record.enabled:
+            flags.add(record.status)
+        else:
+            flags.discard(record.status)
+
+    def _on_round(self, record):
+        self.round = record.round
+
+    _handlers = {
+        BattleStart: _on_battle_start,
+        Spawn: _on_spawn,
+        Initiative: _on_initiative,
+        Damage: _on_damage,
+        Move: _on_move,
+        StatusFlag: _on_status_flag,
+        RoundStart: _on_round,
+        RoundEnd: _on_round,
+    }
+
+    def __eq__(self, other):
+        return isinstance(other, ReplayState) and self.round == other.round and self.combatants == other.combatants
+
+
+class ReplayWriter(object):
+    """
+    Combat log sink, that writes the replay stream
+    """
+    enabled = True
+
+    def __init__(self, file=None, snapshot_interval=5):
+        """
+        :param file: binary stream for the replay. In-memory stream is used if it is None
+        :param int snapshot_interval: number of rounds between snapshots
+        """
+        self.file = file if file is not None else io.BytesIO()
+        self.snapshot_interval = snapshot_interval
+        # Current state of the battle
+        self.state = ReplayState()
+        self._string_ids = {None: 0}
+        self._started = False
+        self.file.write(MAGIC)
+
+    def _intern(self, value):
+        index = self._string_ids.get(value)
+        if index is None:
+            if not isinstance(value, str):
+                return self._intern(str(value))
+            index = len(self._string_ids)
+            self._string_ids[value] = index
+            text = value.encode('utf-8')
+            self.file.write(_STRING_HEADER.pack(_FRAME_STRING, len(text)))
+            self.file.write(text)
+        return index
+
+    def write(self, record):
+        if not self._started and isinstance(record, RoundStart):
+            # State before the first round
+            self._started = True
+            self.write_snapshot()
+        # Invalid records are rejected before they get to the stream
+        self.state.apply(record)
+        values = [self._intern(value) if kind == 's' else value for kind, value in zip(record.kinds, record)]
+        self.file.write(record.layout.pack(record.code, *values))
+        if isinstance(record, RoundEnd) and record.round % self.snapshot_interval == 0:
+            self.write_snapshot()
+
+    def write_snapshot(self):
+        """
+        Write snapshot of the current state
+        """
+        combatants = [(self._intern(state.name), self._intern(state.faction), state) for state in
+                      self.state.combatants.values()]
+        payload = bytearray()
+        for name, faction, state in combatants:
+            payload += _COMBATANT.pack(name, faction, state.x, state.y, state.health, state.health_max,
+                                       state.initiative, len(state.flags))
+            for flag in sorted(state.flags):
+                payload += _FLAG.pack(flag)
+        self.file.write(_SNAPSHOT_HEADER.pack(_FRAME_SNAPSHOT, self.state.round, len(payload)))
+        self.file.write(payload)
+
+    def getvalue(self):
+        """
+        Get the stream contents, if it is an in-memory stream
+        :rtype: bytes
+        """
+        return self.file.getvalue()
+
+    def records(self):
+        return Replay(self.getvalue()).records()
+
+    def close(self):
+        self.file.flush()
+
+
+class Replay(object):
+    """
+    Reads replay stream, made by ReplayWriter
+    """
+    def __init__(self, data):
+        """
+        :param bytes data: replay stream
+        """
+        if data[:len(MAGIC)] != MAGIC:
+            raise ValueError("Not a battle replay")
+        self._data = data
+        self._strings = [None]
+        # Rounds and offsets of snapshot frames
+        self._snapshot_rounds = []
+        self._snapshot_offsets = []
+        # Header of the battle: BattleStart, Spawn and StatusFlag records before the first snapshot
+        self.header = ReplayState()
+        self.rounds = 0
+        self._index()
+
+    @staticmethod
+    def load(path):
+        """
+        :rtype: Replay
+        """
+        with open(path, 'rb') as file:
+            return Replay(file.read())
+
+    # Find string table and snapshots. Records are only skipped
+    def _index(self):
+        data = self._data
+        offset = len(MAGIC)
+        end = len(data)
+        header = True
+        while offset < end:
+            code = data[offset]
+            if code == _FRAME_STRING:
+                _, length = _STRING_HEADER.unpack_from(data, offset)
+                offset += _STRING_HEADER.size
+                self._strings.append(data[offset:offset + length].decode('utf-8'))
+                offset += length
+            elif code == _FRAME_SNAPSHOT:
+                _, round, size = _SNAPSHOT_HEADER.unpack_from(data, offset)
+                self._snapshot_rounds.append(round)
+                self._snapshot_offsets.append(offset)
+                offset += _SNAPSHOT_HEADER.size + size
+                header = False
+            else:
+                cls = RECORD_TYPES[code]
+                if header:
+                    self.header.apply(self._decode(cls, offset))
+                elif cls is RoundEnd:
+                    self.rounds = self._decode(cls, offset).round
+                offset += cls.layout.size
+
+    def _decode(self, cls, offset):
+        values = cls.layout.unpack_from(self._data, offset)[1:]
+        strings = self._strings
+        return cls(*[strings[value] if kind == 's' else value for kind, value in zip(cls.kinds, values)])
+
+    # Iterate (offset, record) from specified offset. Snapshots are skipped
+    def _iterate(self, offset):
+        data = self._data
+        end = len(data)
+        while offset < end:
+            code = data[offset]
+            if code == _FRAME_STRING:
+                _, length = _STRING_HEADER.unpack_from(data, offset)
+                offset += _STRING_HEADER.size + length
+            elif code == _FRAME_SNAPSHOT:
+                _, _, size = _SNAPSHOT_HEADER.unpack_from(data, offset)
+                offset += _SNAPSHOT_HEADER.size + size
+            else:
+                cls = RECORD_TYPES[code]
+                yield offset, self._decode(cls, offset)
+                offset += cls.layout.size
+
+    def records(self):
+        """
+        Iterate all the records of the battle
+        """
+        for _, item in self._iterate(len(MAGIC)):
+            yield item
+
+    @property
+    def snapshot_rounds(self):
+        return list(self._snapshot_rounds)
+
+    def _read_snapshot(self, offset):
+        _, round, size = _SNAPSHOT_HEADER.unpack_from(self._data, offset)
+        state = self.header.copy()
+        state.round = round
+        state.combatants = {}
+        strings = self._strings
+        position = offset + _SNAPSHOT_HEADER.size
+        end = position + size
+        while position < end:
+            name, faction, x, y, health, health_max, initiative, flag_count = \
+                _COMBATANT.unpack_from(self._data, position)
+            position += _COMBATANT.size
+            flags = [_FLAG.unpack_from(self._data, position + index * _FLAG.size)[0] for index in range(flag_count)]
+            position += flag_count * _FLAG.size
+            state.combatants[strings[name]] = CombatantState(strings[name], strings[faction], x, y, health,
+                                                             health_max, initiative, flags)
+        return state, end
+
+    def state_at(self, round):
+        """
+        Rebuild the state at the end of specified round
+        Round 0 is the state before the battle. Rounds after the end of the battle give the final state
+        :param int round: round number
+        :rtype: ReplayState
+        """
+        index = bisect.bisect_right(self._snapshot_rounds, round) - 1
+        if index < 0:
+            raise ValueError("Replay has no snapshot before round %d" % round)
+        state, offset = self._read_snapshot(self._snapshot_offsets[index])
+        if state.round == round:
+            return state
+        for _, item in self._iterate(offset):
+            if isinstance(item, RoundStart) and item.round > round:
+                break
+            state.apply(item)
+        return state
@@ -0,0 +1,310 @@
+"""
+Headless battle runner
+
+Runs battles without rendering and user input, and collects structured outcomes.
+Used for Monte Carlo simulations of combatant builds.
+"""
+import collections
+import math
+import random
+
+from .battle import Battle
+from .dice import RandomStream, using_stream
+from .combatlog import NULL_LOG
+import sim.events as events
+
+
+class Scenario(object):
+    """
+    Battle setup: grid size, terrain and combatants
+
+    Combatants are created by builders, like ones in battle_utils.py, so every battle
+    gets fresh combatants.
+    """
+    def __init__(self, width=16, height=16, **kwargs):
+        """
+        :param int width: width of battle grid
+        :param int height: height of battle grid
+        :param int max_rounds: battle is stopped as a draw after this number of rounds
+        :param bool dense: use dense grid storage
+        """
+        self.width = width
+        self.height = height
+        self.max_rounds = kwargs.get('max_rounds', 50)
+        self.dense = kwargs.get('dense', False)
+        self._terrain = []
+        self._combatants = []
+
+    def add_terrain(self, painter):
+        """
+        Add terrain painter
+        :param painter: callable painter(grid), like draw_block or draw_cross with bound arguments
+        :return: self
+        """
+        self._terrain.append(painter)
+        return self
+
+    def add_combatant(self, builder, name, x, y, faction, **kwargs):
+        """
+        Add combatant to the scenario
+        :param builder: callable builder(name, **kwargs) -> Combatant
+        :param str name: combatant name
+        :param int x: x position on the grid
+        :param int y: y position on the grid
+        :param str faction: combatant faction
+        :param kwargs: additional arguments for the builder
+        :return: self
+        """
+        self._combatants.append((builder, name, x, y, faction, kwargs))
+        return self
+
+    @property
+    def factions(self):
+        factions = []
+        for desc in self._combatants:
+            if desc[4] not in factions:
+                factions.append(desc[4])
+        return factions
+
+    def create_battle(self, rng=None, profiler=None, log=None):
+        """
+        Create battle with fresh combatants
+        :param RandomStream rng: random stream for the battle. Rolls of the builders are taken from it as well
+        :param Profiler profiler: profiler for battle phases
+        :param CombatLog log: combat log. Records are printed if it is None
+        :return:Battle
+        """
+        battle = Battle(self.width, self.height, dense=self.dense, rng=rng, profiler=profiler, log=log)
+        with using_stream(battle.rng):
+            for painter in self._terrain:
+                painter(battle.grid)
+            for builder, name, x, y, faction, kwargs in self._combatants:
+                battle.add_combatant(builder(name, **kwargs), x, y, faction=faction)
+        return battle
+
+
+class CombatantOutcome(object):
+    """
+    State of a combatant after the battle
+    """
+    def __init__(self, combatant, damage_dealt):
+        self.name = combatant.get_name()
+        self.faction = combatant.get_faction()
+        self.health = combatant.health
+        self.health_max = combatant.health_max
+        self.damage_dealt = damage_dealt
+        self.conscious = combatant.is_consciousness()
+        self.dead = combatant.is_dead()
+
+    def to_dict(self):
+        return dict(self.__dict__)
+
+    def __repr__(self):
+        return "%s(%s) HP=%d/%d dealt=%d" % (self.name, self.faction, self.health, self.health_max, self.damage_dealt)
+
+
+class BattleOutcome(object):
+    """
+    Result of a single battle
+    """
+    def __init__(self, winner, rounds, combatants):
+        """
+        :param winner: winning faction, or None for a draw
+        :param int rounds: number of rounds played
+        :param combatants: list of CombatantOutcome
+        """
+        self.winner = winner
+        self.rounds = rounds
+        self.combatants = combatants
+
+    def to_dict(self):
+        return {
+            'winner': self.winner,
+            'rounds': self.rounds,
+            'combatants': [c.to_dict() for c in self.combatants],
+        }
+
+    def __repr__(self):
+        return "BattleOutcome(winner=%s, rounds=%d, %s)" % (self.winner, self.rounds, self.combatants)
+
+
+# Get factions, that still have conscious combatants
+def standing_factions(battle):
+    factions = []
+    for combatant in battle.combatants:
+        faction = combatant.get_faction()
+        if combatant.is_consciousness() and faction not in factions:
+            factions.append(faction)
+    return factions
+
+
+def run_battle(scenario, quiet=True, rng=None, profiler=None, log=None):
+    """
+    Run a single battle until only one faction is left or round limit is reached
+    :param Scenario scenario: battle setup
+    :param bool quiet: drop combat log records, if log is not specified. Records are printed otherwise
+    :param RandomStream rng: random stream for the battle. Battle is reproducible with the same stream seed
+    :param Profiler profiler: profiler for battle phases. Disabled if it is None
+    :param CombatLog log: combat log for the battle
+    :return:BattleOutcome
+    """
+    if log is None and quiet:
+        log = NULL_LOG
+    battle = scenario.create_battle(rng, profiler, log)
+    damage_dealt = {combatant: 0 for combatant in battle.combatants}
+
+    def on_get_hit(target, source, damage):
+        if source in damage_dealt:
+            damage_dealt[source] += damage
+
+    for combatant in battle.combatants:
+        combatant.event_manager.on_get_hit += on_get_hit
+
+    # Rolls without explicit stream are taken from the battle stream as well
+    with using_stream(battle.rng):
+        factions = standing_factions(battle)
+        if len(factions) > 1:
+            for event in battle.battle_generator():
+                if not isinstance(event, events.RoundEnd):
+                    continue
+                factions = standing_factions(battle)
+                if len(factions) <= 1 or event.round >= scenario.max_rounds:
+                    break
+
+    winner = factions[0] if len(factions) == 1 else None
+    combatants = [CombatantOutcome(c, damage_dealt[c]) for c in battle.combatants]
+    return BattleOutcome(winner, battle.round, combatants)
+
+
+def iterate_battles(scenario, count, seed=None, quiet=True, profiler=None):
+    """
+    Run a series of battles
+    :param Scenario scenario: battle setup
+    :param int count: number of battles
+    :param seed: base seed. Every battle gets its own random stream, seeded from it
+    :param bool quiet: drop combat log records
+    :param Profiler profiler: profiler, shared by all the battles
+    :return: generator of BattleOutcome
+    """
+    seeds = random.Random(seed)
+    for _ in range(count):
+        yield run_battle(scenario, quiet, RandomStream(seeds.getrandbits(63)), profiler)
+
+
+def run_battles(scenario, count, seed=None, quiet=True):
+    """
+    Run a series of battles
+    :return: list of BattleOutcome
+    """
+    return list(iterate_battles(scenario, count, seed, quiet))
+
+
+class OutcomeStats(object):
+    """
+    Aggregated outcomes of a series of battles
+
+    Stats from different series can be merged, so battles can be run in separate processes.
+    """
+    def __init__(self, factions=None):
+        """
+        :param factions: list of factions to be reported. Other factions are added when met in outcomes
+        """
+        self.factions = list(factions) if factions is not None else []
+        self.battles = 0
+        self.draws = 0
+        self.rounds = 0
+        # Number of battles for each number of rounds
+        self.rounds_histogram = collections.Counter()
+        self.wins = collections.Counter()
+        # Sum of health left and damage dealt for each faction
+        self.health = collections.Counter()
+        self.damage = collections.Counter()
+
+    def _add_faction(self, faction):
+        if faction not in self.factions:
+            self.factions.append(faction)
+
+    def add(self, outcome):
+        """
+        Add battle outcome
+        :param BattleOutcome outcome:
+        """
+        self.battles += 1
+        self.rounds += outcome.rounds
+        self.rounds_histogram[outcome.rounds] += 1
+        if outcome.winner is None:
+            self.draws += 1
+        else:
+            self.wins[outcome.winner] += 1
+        for combatant in outcome.combatants:
+            self._add_faction(combatant.faction)
+            self.health[combatant.faction] += combatant.health
+            self.damage[combatant.faction] += combatant.damage_dealt
+
+    def merge(self, other):
+        """
+        Add stats from another series of battles
+        :param OutcomeStats other:
+        """
+        for faction in other.factions:
+            self._add_faction(faction)
+        self.battles += other.battles
+        self.draws += other.draws
+        self.rounds += other.rounds
+        self.rounds_histogram.update(other.rounds_histogram)
+        self.wins.update(other.wins)
+        self.health.update(other.health)
+        self.damage.update(other.damage)
+
+    def win_rate(self, faction):
+        if self.battles == 0:
+            return 0.0
+        return self.wins[faction] / self.battles
+
+    def win_interval(self, faction, z=1.96):
+        """
+        Wilson score interval for win rate of the faction
+        :param faction: faction
+        :param z: quantile of normal distribution. Default is for 95% confidence
+        :return: (low, high)
+        """
+        n = self.battles
+        if n == 0:
+            return 0.0, 1.0
+        p = self.wins[faction] / n
+        denominator = 1 + z * z / n
+        center = (p + z * z / (2 * n)) / denominator
+        spread = z * math.sqrt(p * (1 - p) / n + z * z / (4 * n * n)) / denominator
+        return max(0.0, center - spread), min(1.0, center + spread)
+
+    def to_dict(self):
+        scale = 1.0 / self.battles if self.battles > 0 else 0.0
+        return {
+            'battles': self.battles,
+            'draws': self.draws,
+            'mean_rounds': self.rounds * scale,
+            'rounds_histogram': dict(sorted(self.rounds_histogram.items())),
+            'factions': {
+                faction: {
+                    'wins': self.wins[faction],
+                    'win_rate': self.win_rate(faction),
+                    'win_interval': self.win_interval(faction),
+                    'mean_health': self.health[faction] * scale,
+                    'mean_damage': self.damage[faction] * scale,
+                } for faction in self.factions
+            },
+        }
+
+
+def summarize(outcomes, factions=None):
+    """
+    Aggregate battle outcomes
+    :param outcomes: iterable of BattleOutcome
+    :param factions: list of factions to be reported. Taken from the outcomes if not specified
+    :return: dict with battle count, wins by faction, draws, rounds,
+    mean health left and mean damage dealt by faction
+    """
+    stats = OutcomeStats(factions)
+    for outcome in outcomes:
+        stats.add(outcome)
+    return stats.to_dict()
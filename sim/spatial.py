@@ -0,0 +1,176 @@
+"""
+Spatial index for proximity queries
+
+Entities are kept in buckets of a uniform grid, keyed by the cell of the entity center.
+Queries check only the buckets around the query point, so finding neighbours does not scan
+all the combatants of the battle. Distances are measured between entity centers, in tiles:
+    - within: Euclidean distance, like ranged weapons use
+    - nearest: Chebyshev distance, like melee reach uses
+"""
+import heapq
+import math
+
+
+class SpatialIndex(object):
+    """
+    Uniform bucket grid over entity positions
+    Index should be updated by move() every time entity changes its position
+    """
+    def __init__(self, cell_size=4):
+        """
+        :param int cell_size: size of a bucket, in tiles
+        """
+        self.cell_size = cell_size
+        # (cell x, cell y) -> list of entities
+        self._buckets = {}
+        # entity -> (cell x, cell y)
+        self._cells = {}
+        # Insertion order, used to break ties
+        self._order = {}
+        self._counter = 0
+        # Bounding box of non-empty cells, can be larger than actual one after removals
+        self._bounds = None
+
+    @staticmethod
+    def _center(entity):
+        half = entity.get_size() * 0.5
+        return entity.x + half, entity.y + half
+
+    def _cell_of(self, x, y):
+        return int(math.floor(x / self.cell_size)), int(math.floor(y / self.cell_size))
+
+    def __len__(self):
+        return len(self._cells)
+
+    def __contains__(self, entity):
+        return entity in self._cells
+
+    def insert(self, entity):
+        if entity in self._cells:
+            self.move(entity)
+            return
+        cell = self._cell_of(*self._center(entity))
+        self._cells[entity] = cell
+        self._order[entity] = self._counter
+        self._counter += 1
+        self._buckets.setdefault(cell, []).append(entity)
+        cx, cy = cell
+        if self._bounds is None:
+            self._bounds = [cx, cy, cx, cy]
+        else:
+            bounds = self._bounds
+            bounds[0] = min(bounds[0], cx)
+            bounds[1] = min(bounds[1], cy)
+            bounds[2] = max(bounds[2], cx)
+            bounds[3] = max(bounds[3], cy)
+
+    def remove(self, entity):
+        cell = self._cells.pop(entity, None)
+        if cell is None:
+            return
+        del self._order[entity]
+        bucket = self._buckets[cell]
+        bucket.remove(entity)
+        if not bucket:
+            del self._buckets[cell]
+
+    def move(self, entity):
+        """
+        Update bucket of the entity after it has moved
+        """
+        cell = self._cells.get(entity)
+        if cell is None:
+            return
+        new_cell = self._cell_of(*self._center(entity))
+        if new_cell == cell:
+            return
+        order = self._order[entity]
+        self.remove(entity)
+        self.insert(entity)
+        # Moving does not change the order for tie breaks
+        self._order[entity] = order
+
+    def clear(self):
+        self._buckets.clear()
+        self._cells.clear()
+        self._order.clear()
+        self._bounds = None
+
+    def within(self, x, y, radius, predicate=None):
+        """
+        Get entities with centers within radius of the point
+        :param float x: point x, in tiles
+        :param float y: point y, in tiles
+        :param float radius: radius, in tiles
+        :param predicate: filter for entities
+        :return: list of entities, sorted by distance
+        """
+        x0, y0 = self._cell_of(x - radius, y - radius)
+        x1, y1 = self._cell_of(x + radius, y + radius)
+        result = []
+        buckets = self._buckets
+        for cy in range(y0, y1 + 1):
+            for cx in range(x0, x1 + 1):
+                bucket = buckets.get((cx, cy))
+                if bucket is None:
+                    continue
+                for entity in bucket:
+                    ex, ey = self._center(entity)
+                    distance = math.hypot(ex - x, ey - y)
+                    if distance <= radius and (predicate is None or predicate(entity)):
+                        result.append((distance, self._order[entity], entity))
+        result.sort(key=lambda item: item[:2])
+        return [entity for _, _, entity in result]
+
+    def nearest(self, x, y, count=1, predicate=None):
+        """
+        Get nearest entities. Buckets are checked ring by ring, until the next ring can not contain
+        anything closer than already found entities
+        :param float x: point x, in tiles
+        :param float y: point y, in tiles
+        :param int count: number of entities
+        :param predicate: filter for entities
+        :return: list of up to count entities, sorted by Chebyshev distance. Ties are broken by insertion order
+        """
+        if self._bounds is None or count <= 0:
+            return []
+        cx, cy = self._cell_of(x, y)
+        left, top, right, bottom = self._bounds
+        max_ring = max(cx - left, right - cx, cy - top, bottom - cy)
+        # Max-heap of the best found entities: (-distance, -order, entity)
+        best = []
+        buckets = self._buckets
+        for ring in range(max(0, max_ring) + 1):
+            # Anything in this ring is at least that far
+            if len(best) >= count and (ring - 1) * self.cell_size > -best[0][0]:
+                break
+            for cell in self._ring_cells(cx, cy, ring):
+                bucket = buckets.get(cell)
+                if bucket is None:
+                    continue
+                for entity in bucket:
+                    if predicate is not None and not predicate(entity):
+                        continue
+                    ex, ey = self._center(entity)
+                    dx = abs(ex - x)
+                    dy = abs(ey - y)
+                    item = (-(dx if dx > dy else dy), -self._order[entity], entity)
+                    if len(best) < count:
+                        heapq.heappush(best, item)
+                    elif item[:2] > best[0][:2]:
+                        heapq.heapreplace(best, item)
+        best.sort(key=lambda item: item[:2], reverse=True)
+        return [entity for _, _, entity in best]
+
+    # Cells at Chebyshev distance 'ring' from the center cell
+    @staticmethod
+    def _ring_cells(cx, cy, ring):
+        if ring == 0:
+            yield cx, cy
+            return
+        for x in range(cx - ring, cx + ring + 1):
+            yield x, cy - ring
+            yield x, cy + ring
+        for y in range(cy - ring + 1, cy + ring):
+            yield cx - ring, y
+            yield cx + ring, y
@@ -13,6 +13,8 @@ There are feats:
 
 # Encapsulates current turn state
 class TurnState(object):
+    __slots__ = ('_moves_left', 'move_actions', '_moved_distance', 'standard_actions', 'moved_5ft', 'swift_actions',
+                 '_state', 'attacks', 'attack_AoO')
 
     STATE_INITIAL = 0
     # made one attack. If we make another attack - we spend std+move actions and switch to STATE_FULL_ROUND_ATTACK
@@ -42,6 +44,23 @@ class TurnState(object):
         # Attack to be used for AoO
         self.attack_AoO = []
 
+    def copy(self):
+        """
+        Get a copy of the state. Attack descriptions are shared
+        :rtype: TurnState
+        """
+        result = TurnState()
+        result._moves_left = self._moves_left
+        result.move_actions = self.move_actions
+        result._moved_distance = self._moved_distance
+        result.standard_actions = self.standard_actions
+        result.moved_5ft = self.moved_5ft
+        result.swift_actions = self.swift_actions
+        result._state = self._state
+        result.attacks = list(self.attacks)
+        result.attack_AoO = self.attack_AoO
+        return result
+
     @property
     def moves_left(self):
         return self._moves_left
@@ -0,0 +1,99 @@
+"""
+Headless battle simulation
+
+Runs a series of battles between teams, built by make_* builders from battle_utils.py
+Example:
+    python simulate.py twf_fighter angry_guisarme --count 1000 --seed 1
+"""
+import argparse
+import json
+import sys
+import time
+
+import battle_utils
+from sim.runner import Scenario, OutcomeStats, iterate_battles
+from sim.montecarlo import iterate_parallel, make_shards
+from sim.profiler import Profiler
+
+
+# Get combatant builder from battle_utils by its name, like 'twf_fighter'
+def get_builder(name):
+    builder = getattr(battle_utils, 'make_' + name, None)
+    if builder is None:
+        raise argparse.ArgumentTypeError("Unknown combatant builder '%s'" % name)
+    return builder
+
+
+def list_builders():
+    return sorted(name[5:] for name in dir(battle_utils) if name.startswith('make_'))
+
+
+def make_scenario(args):
+    size = args.size
+    scenario = Scenario(size, size, max_rounds=args.max_rounds, dense=args.dense)
+    # Teams start at the opposite corners of the grid
+    for index, name in enumerate(args.red.split(',')):
+        scenario.add_combatant(get_builder(name), "%s_red%d" % (name, index), 2, 2 + index * 3, 'red')
+    for index, name in enumerate(args.blue.split(',')):
+        scenario.add_combatant(get_builder(name), "%s_blue%d" % (name, index), size - 3, size - 3 - index * 3, 'blue')
+    return scenario
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Run headless battles and report outcomes")
+    parser.add_argument('red', help="comma separated builders for red team. One of: %s" % ', '.join(list_builders()))
+    parser.add_argument('blue', help="comma separated builders for blue team")
+    parser.add_argument('--count', type=int, default=100, help="number of battles")
+    parser.add_argument('--size', type=int, default=16, help="size of battle grid")
+    parser.add_argument('--max-rounds', type=int, default=50, help="battle is a draw after this number of rounds")
+    parser.add_argument('--seed', type=int, default=None, help="random seed")
+    parser.add_argument('--dense', action='store_true', help="use dense grid storage")
+    parser.add_argument('--json', action='store_true', help="print summary as json")
+    parser.add_argument('--outcomes', action='store_true', help="include every battle outcome to json output")
+    parser.add_argument('--workers', type=int, default=1,
+                        help="number of worker processes. 0 - use all CPUs. Outcomes are kept only for a single worker")
+    parser.add_argument('--profile', help="save time of battle phases as json to this file. Battles are run in a single process")
+    parser.add_argument('--trace', help="save battle phases in Chrome trace format to this file")
+    args = parser.parse_args()
+
+    scenario = make_scenario(args)
+    outcomes = []
+    profiler = Profiler(trace=args.trace is not None) if args.profile or args.trace else None
+    start = time.time()
+    if (args.outcomes and args.workers == 1) or profiler is not None:
+        # Serial run with the same shards, as parallel run has. Every outcome is kept, battles can be profiled
+        stats = OutcomeStats(scenario.factions)
+        for size, seed in make_shards(args.count, args.seed):
+            for outcome in iterate_battles(scenario, size, seed=seed, profiler=profiler):
+                stats.add(outcome)
+                outcomes.append(outcome)
+    else:
+        workers = args.workers if args.workers > 0 else None
+        for stats in iterate_parallel(scenario, args.count, seed=args.seed, workers=workers):
+            if not args.json:
+                print("%d/%d battles done" % (stats.battles, args.count), file=sys.stderr)
+    elapsed = time.time() - start
+
+    if args.profile:
+        profiler.save(args.profile)
+    if args.trace:
+        profiler.save(args.trace, format='chrome')
+
+    summary = stats.to_dict()
+    summary['elapsed'] = elapsed
+    if args.json:
+        if args.outcomes:
+            summary['outcomes'] = [outcome.to_dict() for outcome in outcomes]
+        print(json.dumps(summary, indent=2))
+        return
+
+    print("%d battles in %.1fs, %.0f battles/min" % (summary['battles'], elapsed, 60 * summary['battles'] / max(elapsed, 1e-9)))
+    print("Mean rounds: %.2f, draws: %d" % (summary['mean_rounds'], summary['draws']))
+    for faction, desc in summary['factions'].items():
+        low, high = desc['win_interval']
+        print("%s: wins=%d (%.1f%%, 95%% CI %.1f-%.1f%%) mean HP left=%.1f mean damage=%.1f" % (
+            faction, desc['wins'], 100 * desc['win_rate'], 100 * low, 100 * high, desc['mean_health'], desc['mean_damage']))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,123 @@
+from unittest import TestCase
+
+from battle_utils import make_twf_fighter, make_angry_guisarme
+from sim.core import ACTION_TYPE_STANDARD, SIZE_LARGE
+from sim.combatlog import NULL_LOG
+from sim.dice import RandomStream, using_stream
+from sim.grid import Coord, TERRAIN_WALL
+from sim.pathfinder import Path
+from sim.runner import Scenario
+import sim.actions
+import sim.events as events
+
+
+# Closed ring of walls around the tile
+def wall_ring(cx, cy, radius):
+    def paint(grid):
+        for d in range(-radius, radius + 1):
+            for x, y in ((cx + d, cy - radius), (cx + d, cy + radius), (cx - radius, cy + d), (cx + radius, cy + d)):
+                grid.set_terrain(x, y, TERRAIN_WALL)
+    return paint
+
+
+class BrainTest(TestCase):
+
+    def test_unreachable_target(self):
+        # Nobody can reach the enemy, so brains should give up instead of looping
+        scenario = Scenario(16, 16)
+        scenario.add_terrain(wall_ring(11, 11, 3))
+        scenario.add_combatant(make_twf_fighter, 'A', 2, 2, 'red')
+        scenario.add_combatant(make_angry_guisarme, 'B', 11, 11, 'blue')
+        battle = scenario.create_battle(RandomStream(1), log=NULL_LOG)
+        position = battle.combatants[1].get_coord()
+        with using_stream(battle.rng):
+            for event in battle.battle_generator():
+                if isinstance(event, events.RoundEnd) and event.round >= 2:
+                    break
+        assert battle.round == 2
+        assert battle.combatants[1].get_coord() == position
+        assert all(c.health == c.health_max for c in battle.combatants)
+
+    def test_move_actions_spent(self):
+        scenario = Scenario(24, 8)
+        scenario.add_combatant(make_twf_fighter, 'A', 1, 1, 'red')
+        battle = scenario.create_battle(RandomStream(1), log=NULL_LOG)
+        mover = battle.combatants[0]
+        tiles = mover.move_speed // 5
+        # The last tile of a single move action is threatened by the enemy, and the path goes on
+        with using_stream(battle.rng):
+            enemy = make_twf_fighter('B')
+        battle.add_combatant(enemy, tiles + 2, 2, faction='blue')
+        path = Path(battle.grid)
+        for x in range(2, tiles + 6):
+            path.append(Coord(x, 1))
+
+        state = mover.on_turn_start(battle, brain=False)
+        state.use_action(mover, ACTION_TYPE_STANDARD)
+        moves = []
+        with using_stream(battle.rng):
+            for action in mover.do_action_move_tiles(battle, state, path):
+                moves.append(action)
+                list(battle.execute_combatant_action(action, state))
+        # Movement stops, when the only move action is spent
+        assert len(moves) == 1 and isinstance(moves[0], sim.actions.MoveAction)
+        assert mover.get_coord() == Coord(tiles + 1, 1)
+        assert not state.can_move_distance()
+
+    def test_large_reaches_melee(self):
+        scenario = Scenario(20, 20)
+        scenario.add_combatant(lambda name: make_twf_fighter(name, csize=SIZE_LARGE), 'big', 2, 2, 'red')
+        scenario.add_combatant(make_twf_fighter, 'f', 15, 15, 'blue')
+        battle = scenario.create_battle(RandomStream(1), log=NULL_LOG)
+        big, enemy = battle.combatants
+        assert big.get_size() == 2
+        with using_stream(battle.rng):
+            for event in battle.battle_generator():
+                if isinstance(event, events.RoundEnd) and (big.is_adjacent(enemy) or event.round >= 5):
+                    break
+        assert big.is_adjacent(enemy)
+        assert big.get_coord() != (2, 2)
+
+    def test_charge(self):
+        def create_battle(wall):
+            scenario = Scenario(16, 16)
+            scenario.add_terrain(lambda grid: grid.set_terrain(wall, 5, TERRAIN_WALL))
+            scenario.add_combatant(make_twf_fighter, 'A', 2, 5, 'red')
+            scenario.add_combatant(make_twf_fighter, 'B', 9, 5, 'blue')
+            return scenario.create_battle(RandomStream(1), log=NULL_LOG)
+
+        battle = create_battle(6)
+        first, second = battle.combatants
+        assert first._brain.check_straight_path(battle, first.get_coord(), second) is None
+
+        battle = create_battle(12)
+        first, second = battle.combatants
+        # Line ends at the first tile in reach of the target, and is not blocked by the combatants
+        path = first._brain.check_straight_path(battle, first.get_coord(), second)
+        assert [(point.x, point.y) for point in path] == [(x, 5) for x in range(3, 9)]
+
+        charges = []
+        for combatant in battle.combatants:
+            charge = combatant.do_action_charge
+            combatant.do_action_charge = lambda *args, charge=charge: charges.append(args) or charge(*args)
+        with using_stream(battle.rng):
+            for event in battle.battle_generator():
+                if isinstance(event, events.RoundEnd):
+                    break
+        assert len(charges) == 1
+        assert first.is_adjacent(second)
+
+    def test_shared_exchange_cache(self):
+        scenario = Scenario(16, 16)
+        for index in range(2):
+            scenario.add_combatant(make_twf_fighter, 'r%d' % index, 1 + 2 * index, 1, 'red')
+            scenario.add_combatant(make_angry_guisarme, 'b%d' % index, 14 - 2 * index, 14, 'blue')
+        battle = scenario.create_battle(RandomStream(1), log=NULL_LOG)
+        with using_stream(battle.rng):
+            for event in battle.battle_generator():
+                if isinstance(event, events.RoundEnd):
+                    break
+        cache = battle.exchange_cache
+        assert all(c._brain.get_exchange_cache(battle) is cache for c in battle.combatants)
+        # Combatants of the same build reuse the estimations of each other
+        assert cache.hits > 0
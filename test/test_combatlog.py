@@ -0,0 +1,55 @@
+import io
+import os
+import tempfile
+from unittest import TestCase
+
+from battle_utils import make_twf_fighter, make_angry_guisarme
+from sim.dice import RandomStream
+from sim.runner import Scenario, run_battle
+from sim.combatlog import *
+
+
+class CombatLogTest(TestCase):
+
+    def test_ring_buffer(self):
+        sink = RingBufferSink(4)
+        for index in range(6):
+            sink.write(AttackRoll('A', 'B', ATTACK_HIT, index + 1, 5, 15))
+        sink.write(Fall('B', True))
+        records = list(sink.records())
+        # Only the latest records are kept
+        assert len(sink) == 4 and sink.written == 7
+        assert [record.roll for record in records[:3]] == [4, 5, 6]
+        assert records[3] == Fall('B', True)
+        assert records[0].format() == "A hits B with roll 9(r4+5) vs AC=15"
+
+    def test_jsonl(self):
+        path = os.path.join(tempfile.mkdtemp(), 'log.jsonl')
+        log = CombatLog(JsonlSink(path))
+        log.write(Move('A', 1, 2, 3, 4, 10, 2))
+        log.write(TargetFound('A', None))
+        assert list(log.lines()) == ["moving A from (1, 2) to (3, 4), moves=10, tiles=2", "A has no targets"]
+        log.close()
+
+    def test_battle_log(self):
+        scenario = Scenario(12, 12, max_rounds=20)
+        scenario.add_combatant(make_twf_fighter, 'A', 2, 2, 'red')
+        scenario.add_combatant(make_angry_guisarme, 'B', 9, 9, 'blue')
+        log = CombatLog(RingBufferSink(10000))
+        outcome = run_battle(scenario, rng=RandomStream(3), log=log)
+        records = list(log.records())
+        # Logging does not change the battle
+        assert outcome.to_dict() == run_battle(scenario, rng=RandomStream(3)).to_dict()
+        assert records[0] == BattleStart(12, 12, 3)
+        assert [record.combatant for record in records if isinstance(record, Spawn)] == ['A', 'B']
+        assert RoundStart(1) in records
+        assert records[-1] == RoundEnd(outcome.rounds)
+        damage = {}
+        for record in records:
+            if isinstance(record, Damage):
+                damage[record.source] = damage.get(record.source, 0) + record.damage
+        assert damage == {c.name: c.damage_dealt for c in outcome.combatants if c.damage_dealt > 0}
+
+        output = io.StringIO()
+        run_battle(scenario, rng=RandomStream(3), log=CombatLog(PrintSink(output)))
+        assert output.getvalue() == "".join(line + "\n" for line in log.lines())
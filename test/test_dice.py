@@ -0,0 +1,105 @@
+from unittest import TestCase
+
+from sim.dice import Dice, Distribution, RandomStream, d20, compile_dice, make_roll, make_roll_many, using_stream, get_default_stream
+
+
+class DiceTest(TestCase):
+
+    def test_stream_seed(self):
+        first = RandomStream(11)
+        second = RandomStream(11)
+        dice = Dice("3d6")
+        rolls = [dice.roll(first) for _ in range(100)]
+        assert rolls == [dice.roll(second) for _ in range(100)]
+        assert min(rolls) >= 3 and max(rolls) <= 18
+
+    def test_stream_state(self):
+        stream = RandomStream(3)
+        d20.roll(stream)
+        state = stream.get_state()
+        rolls = [d20.roll(stream) for _ in range(2000)]
+        stream.set_state(state)
+        assert [d20.roll(stream) for _ in range(2000)] == rolls
+
+    def test_roll_range(self):
+        stream = RandomStream(3)
+        rolls = set(d20.roll(stream) for _ in range(2000))
+        assert rolls == set(range(1, 21))
+        assert make_roll("2d4+3", stream) in range(5, 12)
+        assert stream.randint(5, 5) == 5
+
+    def test_using_stream(self):
+        stream = RandomStream(5)
+        expected = d20.roll(RandomStream(5))
+        with using_stream(stream):
+            assert get_default_stream() is stream
+            assert d20.roll() == expected
+        assert get_default_stream() is not stream
+
+    def test_compile_dice(self):
+        dice = compile_dice("3d6 + 2d4 - 1")
+        assert dice.dice == {6: 3, 4: 2, 1: -1}
+        assert dice.to_string() == "3d6+2d4-1"
+        assert compile_dice("d20+5").dice == {20: 1, 1: 5}
+        # Compiled dice are interned and immutable
+        assert compile_dice("2d6") is compile_dice("2d6")
+        assert Dice("2d6") == compile_dice("2d6") and hash(Dice("2d6")) == hash(compile_dice("2d6"))
+        assert compile_dice("2d6") + 1 == compile_dice("2d6+1")
+        with self.assertRaises(AttributeError):
+            compile_dice("2d6").extra = 1
+        with self.assertRaises(ValueError):
+            compile_dice("2d6+x")
+        with self.assertRaises(ValueError):
+            compile_dice("1d6-4d6kh3")
+
+    def test_keep(self):
+        dice = compile_dice("4d6kh3")
+        assert dice.to_string() == "4d6kh3"
+        assert dice.get_range() == (3, 18)
+        dist = dice.distribution()
+        assert abs(dist.mean() - 12.2446) < 1e-3
+        assert abs(sum(p for _, p in dist.items()) - 1) < 1e-12
+        assert abs(dice.mean() - dist.mean()) < 1e-12
+        lowest = compile_dice("2d20kl1")
+        assert abs(lowest.prob_at_least(20) - 1 / 400) < 1e-12
+        stream = RandomStream(4)
+        assert all(3 <= dice.roll(stream) <= 18 for _ in range(200))
+        rolls = dice.roll_many(20000, stream)
+        assert abs(rolls.mean() - dist.mean()) < 0.1
+
+    def test_roll_many(self):
+        stream = RandomStream(9)
+        rolls = make_roll_many("3d6+2d4", 20000, stream)
+        assert len(rolls) == 20000
+        assert rolls.min() >= 5 and rolls.max() <= 26
+        assert abs(rolls.mean() - 15.5) < 0.1
+        # Modifiers are stored as dice with a single side
+        dice = Dice("2d8") + 3
+        rolls = dice.roll_many(1000, stream)
+        assert rolls.min() >= 5 and rolls.max() <= 19
+
+    def test_distribution(self):
+        dice = Dice("2d6")
+        dist = dice.distribution()
+        assert dist.min == 2 and dist.max == 12
+        assert abs(dist.probability(7) - 6 / 36) < 1e-12
+        assert abs(dist.mean() - 7) < 1e-12
+        assert abs(dist.variance() - 35 / 6) < 1e-12
+        assert dist.percentile(0.5) == 7
+        assert abs(dist.prob_at_least(11) - 3 / 36) < 1e-12
+
+    def test_distribution_negative(self):
+        dice = Dice("1d6").with_die(4, -1).with_die(1, -2)
+        dist = dice.distribution()
+        assert (dist.min, dist.max) == dice.get_range() == (-5, 3)
+        assert abs(dist.mean() - dice.mean()) < 1e-12
+        assert abs(sum(p for _, p in dist.items()) - 1) < 1e-12
+        stream = RandomStream(1)
+        assert all(-5 <= dice.roll(stream) <= 3 for _ in range(200))
+
+    def test_distribution_ops(self):
+        d4 = Distribution(1, [0.25] * 4)
+        assert (d4 + 2).min == 3
+        assert (d4 - d4).probability(0) == 0.25
+        assert d4.scale(3).probability(6) == 0.25
+        assert d4.mix(Distribution.constant(0), 0.5).probability(0) == 0.5
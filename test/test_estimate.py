@@ -0,0 +1,220 @@
+import concurrent.futures
+import threading
+from unittest import TestCase
+
+from battle_utils import make_twf_fighter, make_angry_guisarme
+from brain import ExchangeCache, StyleOptimizer, style_groups, estimate_attack_round, estimate_attack_distribution
+from sim.attackdesc import AttackDesc, estimate_full_attack
+from sim.combatant import Combatant
+from sim.core import roll_hits
+from sim.dice import RandomStream, compile_dice, d20, using_stream
+from sim.profile import AttackProfile
+import dnd.feats
+from dnd.styles import StyleDefenciveFight
+import dnd.weapon
+
+
+class EstimateTest(TestCase):
+
+    def test_hit_chances(self):
+        desc = AttackDesc(dnd.weapon.falchion, attack=10, damage=compile_dice("2d6+4"))
+        desc.critical_confirm_bonus = 2
+        # Hits on 10+, threats on 18-20, confirms on 8+
+        hit, crit = desc.hit_chances(20)
+        assert abs(hit - 11 / 20) < 1e-12
+        assert abs(crit - 3 / 20 * 13 / 20) < 1e-12
+        # Natural 20 always hits, but only a threat that hits can be a critical hit
+        hit, crit = desc.hit_chances(40)
+        assert abs(hit - 1 / 20) < 1e-12
+        assert abs(crit - 1 / 20 * 1 / 20) < 1e-12
+
+    def test_strike_distribution(self):
+        desc = AttackDesc(dnd.weapon.falchion, attack=8, damage=compile_dice("2d6+4"))
+        desc.bonus_damage = compile_dice("1d6")
+        ac = 18
+        dist = desc.damage_distribution(ac)
+        assert abs(sum(p for _, p in dist.items()) - 1) < 1e-12
+        assert dist.max == 2 * 16 + 6
+        # Compare with sampled strikes, resolved like do_action_strike does
+        stream = RandomStream(5)
+        total = 0
+        count = 40000
+        for _ in range(count):
+            roll, confirm = d20.roll(stream), d20.roll(stream)
+            if not roll_hits(desc.attack, roll, ac):
+                continue
+            damage = desc.roll_damage(stream)
+            if desc.is_critical(roll) and roll_hits(desc.attack, confirm, ac):
+                damage *= desc.weapon.crit_mult
+            total += damage + desc.roll_bonus_damage(stream)
+        assert abs(total / count - dist.mean()) < 0.15
+
+    def test_full_attack(self):
+        attacker = make_twf_fighter('A')
+        defender = make_angry_guisarme('B')
+        attacks, expected, dist = estimate_attack_distribution(attacker, defender)
+        _, round_damage = estimate_attack_round(attacker, defender)
+        assert abs(expected - round_damage) < 1e-9
+        assert abs(dist.mean() - expected) < 1e-9
+        assert dist.min == 0 and len(attacks) > 1
+
+    def test_exchange_cache(self):
+        cache = ExchangeCache(max_size=2)
+        attacker = make_twf_fighter('A')
+        defender = make_angry_guisarme('B')
+        # Combatants with the same builds have equal fingerprints
+        assert attacker.state_fingerprint() == make_twf_fighter('C').state_fingerprint()
+        assert attacker.state_fingerprint() != defender.state_fingerprint()
+
+        first = cache.estimate(attacker, defender)
+        second = cache.estimate(attacker, defender)
+        assert first is second
+        assert (cache.hits, cache.misses) == (1, 1)
+        assert second.damage == estimate_attack_round(attacker, defender)[1]
+        assert second.distribution is None
+        # Distribution is calculated, when it is requested
+        full = cache.estimate(attacker, defender, distribution=True)
+        assert abs(full.distribution.mean() - full.damage) < 1e-9 and cache.misses == 2
+
+        # Changed state makes another estimation
+        attacker.add_status_flag('test')
+        cache.estimate(attacker, defender)
+        assert cache.misses == 3
+        cache.estimate(defender, attacker)
+        assert len(cache) == 2
+
+        # Styles are a part of the key
+        style = TestStyle(0)
+        attacker.activate_style(style)
+        cache.estimate(attacker, defender)
+        assert cache.misses == 5
+        attacker.deactivate_style(style)
+
+    # Hit points are rolled, so duelists are created from a fixed stream
+    @staticmethod
+    def make_duelists(seed=1):
+        with using_stream(RandomStream(seed)):
+            attacker = make_twf_fighter('A')
+            defender = make_angry_guisarme('B')
+        attacker.recalculate()
+        defender.recalculate()
+        return attacker, defender
+
+    def test_style_optimizer(self):
+        attacker, defender = self.make_duelists()
+        for index in range(3):
+            attacker.allow_effect_activation(TestStyle(index, attack=index, ac=2 - index))
+        attacker.allow_effect_activation(TestStyle(3, attack=-2, ac=4, group='defence'))
+        attacker.allow_effect_activation(TestStyle(4, attack=-4, ac=6, group='defence'))
+
+        exhaustive = StyleOptimizer(attacker, defender, mode='exhaustive')
+        style, exchange, score = exhaustive.find_best()
+        # Exclusion group gives 3 choices, instead of 4. Defensive fighting is known as well
+        assert exhaustive.evaluations == 2 * 2 * 2 * 3 * 2
+        assert not {'test3', 'test4'} <= {s.name for s in style.styles}
+        # Search does not change the combatant
+        assert attacker._active_styles == [] and attacker._attack_bonus_style == 0
+
+        beam = StyleOptimizer(attacker, defender, mode='beam', beam_width=2)
+        assert beam.find_best()[2] == score
+        assert beam.evaluations < exhaustive.evaluations
+
+        # Bigger sets are searched in bounded time
+        for index in range(5, 20):
+            attacker.allow_effect_activation(TestStyle(index, attack=index % 3 - 1, ac=1 - index % 2))
+        optimizer = StyleOptimizer(attacker, defender)
+        assert optimizer.find_best()[2] >= score
+        assert optimizer.evaluations < 500
+
+    def test_style_search_agrees(self):
+        for seed in range(4):
+            attacker, defender = self.make_duelists(seed)
+            attacker.add_feat(dnd.feats.CombatExpertise())
+            # Combat expertise values share a group, defensive fighting has its own one
+            assert sorted(len(group) for group in style_groups(attacker)) == [1, 5]
+
+            style, _, score = StyleOptimizer(attacker, defender, mode='exhaustive').find_best()
+            assert sum(s.exclusion_group == 'combat_expertise' for s in style.styles) <= 1
+            # Beam as wide as the biggest group finds the same set, and the search is repeatable
+            for mode in ('beam', 'auto', 'beam'):
+                found, _, found_score = StyleOptimizer(attacker, defender, mode=mode).find_best()
+                assert found_score == score and str(found) == str(style)
+
+    def test_attack_profile(self):
+        attacker = make_twf_fighter('A')
+        defender = make_angry_guisarme('B')
+        for combatant in (attacker, defender):
+            combatant.recalculate()
+            combatant.check_weapon_wield()
+        profile = AttackProfile.from_combatant(attacker)
+        target = AttackProfile.from_combatant(defender)
+        assert target.get_armor_class() == defender.get_armor_class()
+
+        attacker.add_bonus_strike(attacker.get_offhand_weapon(), bab=-5, offhand=True)
+        profile = AttackProfile.from_combatant(attacker)
+        chain = [desc.text() for desc in profile.generate_bab_chain(target)]
+        # Bonus strikes are not consumed by a profile
+        assert chain == [desc.text() for desc in profile.generate_bab_chain(target)]
+        assert chain == [desc.text() for desc in attacker.generate_bab_chain(defender)]
+        with self.assertRaises(AttributeError):
+            profile._BAB = 10
+
+        style = TestStyle(0, attack=-2, ac=3)
+        defensive = profile.with_styles(style)
+        assert defensive.get_armor_class() == profile.get_armor_class() + 3
+        assert defensive.generate_bab_chain()[0].attack == profile.generate_bab_chain()[0].attack - 2
+        assert attacker._active_styles == [] and profile._active_styles == ()
+        # Styles are shared by profiles, and their own state is not changed
+        fight_defence = StyleDefenciveFight()
+        fighting = profile.with_styles(fight_defence)
+        assert fighting.get_armor_class() == profile.get_armor_class() + 2
+        assert fighting._active_styles[0] is fight_defence and fight_defence.applied == 0
+
+        # Single weapon removes offhand strike and two weapon fighting penalty. Pending bonus strike is kept
+        single = profile.with_weapons(attacker.get_main_weapon(), None)
+        assert len(single.generate_bab_chain()) == len(chain) - 1
+        assert single.generate_bab_chain()[0].attack > profile.generate_bab_chain()[0].attack
+        assert profile.with_status_flag('test').has_status_flag('test')
+        assert not profile.has_status_flag('test')
+
+        # Profiles can be evaluated concurrently
+        with concurrent.futures.ThreadPoolExecutor(4) as executor:
+            results = list(executor.map(lambda p: estimate_full_attack(p.generate_bab_chain(), p, target)[0],
+                                        [profile, defensive, single] * 10))
+        assert results[:3] * 10 == results
+
+        # Profiles with the same style can be built concurrently
+        shared = CountingStyle(threading.Barrier(2, timeout=5))
+        with concurrent.futures.ThreadPoolExecutor(2) as executor:
+            built = list(executor.map(lambda _: profile.with_styles(shared), range(2)))
+        assert [p.get_armor_class() for p in built] == [profile.get_armor_class() + 1] * 2
+        assert shared.count == 0
+
+
+class TestStyle(Combatant.StatusEffect):
+    def __init__(self, index, attack=0, ac=0, group=None):
+        super(TestStyle, self).__init__("test%d" % index)
+        self.attack = attack
+        self.ac = ac
+        self.exclusion_group = group
+
+    def on_start(self, combatant, **kwargs):
+        combatant._attack_bonus_style += self.attack
+        combatant.modify_ac_dodge(self.ac)
+
+    def on_finish(self, combatant, **kwargs):
+        combatant._attack_bonus_style -= self.attack
+        combatant.modify_ac_dodge(-self.ac)
+
+
+# Style, that changes its own state. Activations wait for each other in the middle
+class CountingStyle(Combatant.StatusEffect):
+    def __init__(self, barrier):
+        super(CountingStyle, self).__init__("counting")
+        self.barrier = barrier
+        self.count = 0
+
+    def on_start(self, combatant, **kwargs):
+        self.count += 1
+        self.barrier.wait()
+        combatant.modify_ac_dodge(self.count)
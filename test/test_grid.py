@@ -1,6 +1,20 @@
+import random
 from unittest import TestCase
 
-from sim.grid import Grid, PathFinder, OccupationTemplate
+from sim.grid import Grid, Point, Coord, OccupationTemplate, TERRAIN_WALL
+from sim.pathfinder import PathFinder, DistanceFieldCache
+from sim.entity import Entity
+
+
+def make_entity(name, faction, x, y, size=1, reach=1, far=False):
+    entity = Entity(name, size=size)
+    entity.natural_reach = lambda: reach
+    entity.has_reach_near = lambda: True
+    entity.has_reach_far = lambda: far
+    entity.get_faction = lambda: faction
+    entity.x = x
+    entity.y = y
+    return entity
 
 
 class TestGrid(TestCase):
@@ -9,6 +23,22 @@ class TestGrid(TestCase):
         grid = Grid(3, 3)
         assert len(grid.get_tiles()) == 9
 
+    def test_coord(self):
+        a = Coord(2, 3)
+        assert a == (2, 3) and {a: 1}[(2, 3)] == 1
+        assert a + Coord(1, 1) == Coord(3, 4)
+        assert a - Coord(2, 3) == Coord(0, 0)
+        center = a + Point(x=0.5, y=0.5)
+        assert isinstance(center, Point) and (center.x, center.y) == (2.5, 3.5)
+        assert a.distance_melee(Coord(5, 1)) == 3
+        assert a.distance_tiles(Coord(5, 7)) == 5
+        assert Coord.unpack(a.pack(16), 16) == a
+        entity = make_entity('e', 'red', 4, 4, size=2)
+        assert entity.get_coord() == Coord(4, 4)
+        # Measured from the border, like for a medium creature at (5, 4)
+        assert entity.distance_melee(make_entity('f', 'blue', 7, 4)) == 1.5
+        assert entity.distance_melee(make_entity('g', 'blue', 6, 3)) == 0.5
+
     def test_path_between_tiles(self):
         grid = Grid(5, 5)
         start = grid.get_tile(1, 1)
@@ -18,6 +48,40 @@ class TestGrid(TestCase):
         assert path is not None
         assert path.length() > 0
 
+    def test_path_around_wall(self):
+        grid = Grid(8, 8)
+        for y in range(0, 7):
+            grid.set_terrain(4, y, TERRAIN_WALL)
+        pf = PathFinder(grid)
+        path = pf.path_between_tiles(grid.get_tile(1, 1), grid.get_tile(6, 1))
+        assert path is not None
+        assert path.last().x == 6 and path.last().y == 1
+        for point in path:
+            assert grid.get_terrain(point.x, point.y) != TERRAIN_WALL
+        # Should go through the gap at the bottom
+        assert max(point.y for point in path) == 7
+
+    def test_path_to_melee_range(self):
+        grid = Grid(16, 16)
+        pf = PathFinder()
+        pf.attach_grid(grid, 2, 2, 14, 14)
+        path = pf.path_to_melee_range(Point(x=3, y=3), Point(x=10.5, y=10.5), 0.5, 1.5)
+        assert path.count() == 6
+        assert path.last().distance_melee(Point(x=10, y=10)) == 1
+
+    def test_straight_path_window(self):
+        grid = Grid(16, 16)
+        grid.set_terrain(5, 5, TERRAIN_WALL)
+        pf = PathFinder()
+        pf.attach_grid(grid, 2, 2, 14, 14)
+        # Line is checked on grid tiles, not on the tiles with the same window coordinates
+        path = pf.check_straight_path(Coord(3, 3), Coord(7, 3))
+        assert path is not None and path.count() == 4
+        assert [(point.x, point.y) for point in path] == [(x, 3) for x in range(4, 8)]
+        assert pf.check_straight_path(Coord(3, 5), Coord(7, 5)) is None
+        # Line leaves the window
+        assert pf.check_straight_path(Coord(3, 3), Coord(15, 3)) is None
+
     def test_occupation_template(self):
         template1_1 = OccupationTemplate(1, 1)
         print(str(template1_1))
@@ -34,3 +98,211 @@ class TestGrid(TestCase):
         print(str(template2_2))
         print(str(template2_3))
 
+
+    def test_dense_grid(self):
+        grid = Grid(4, 3, dense=True)
+        assert len(grid.get_tiles()) == 12
+        tile = grid.get_tile(2, 1)
+        assert tile is grid.get_tile(2, 1)
+        assert grid.get_tile(4, 1) is None
+
+        revision = grid.revision
+        grid.set_terrain(2, 1, TERRAIN_WALL)
+        assert tile.terrain == TERRAIN_WALL
+        assert not tile.is_empty()
+        assert grid.revision == revision + 1
+
+    def test_dense_register(self):
+        for dense in (False, True):
+            grid = Grid(8, 8, dense=dense)
+            entity = make_entity("dummy", None, 3, 3, size=2)
+            grid.register_entity(entity)
+            assert len(entity.occupied_tiles) == 4
+            assert len(grid.get_threatened_tiles(entity)) == 12
+            assert grid.get_tile(4, 4).has_occupation(entity)
+            assert grid.get_tile(2, 2).threaten == [entity]
+
+            grid.unregister_entity(entity)
+            assert len(grid.get_tile(4, 4).occupation) == 0
+            assert len(grid.get_tile(2, 2).threaten) == 0
+
+    def test_dense_stamp_border(self):
+        grid = Grid(6, 6, dense=True)
+        entity = make_entity("dummy", None, 0, 4, size=3, reach=2, far=True)
+        grid.register_entity(entity)
+        # Template covers 11x11 block, and only its part is inside the grid
+        assert len(grid.get_threatened_tiles(entity)) == 36 - 6
+        assert grid.get_threatening_entities(5, 0) == [entity]
+        assert grid.get_threatening_entities(1, 5) == []
+
+        grid.unregister_entity(entity)
+        assert not grid._threats.any()
+        assert not grid._occupants.any()
+
+    def test_hostile_threats(self):
+        for dense in (False, True):
+            grid = Grid(10, 10, dense=dense)
+            red = make_entity("red", "red", 2, 2)
+            blue = make_entity("blue", "blue", 6, 6, size=2)
+            grid.register_entity(red)
+            grid.register_entity(blue)
+
+            assert grid.hostile_threats(3, 3, "blue") == 1
+            assert grid.hostile_threats(3, 3, "red") == 0
+            assert grid.area_threatened(4, 4, 2, "red")
+            assert not grid.area_threatened(3, 3, 2, "red")
+            assert grid.get_hostile_threateners(1, 1, 1, "blue") == [red]
+            assert grid.get_hostile_threateners(4, 4, 2, "red") == [blue]
+            assert grid.get_hostile_threateners(4, 4, 2, "blue") == []
+
+            grid.unregister_entity(blue)
+            assert not grid.area_threatened(4, 4, 2, "red")
+
+    def test_dense_threat_lookup(self):
+        generator = random.Random(3)
+        grids = [Grid(30, 30), Grid(30, 30, dense=True)]
+        entities = [[], []]
+        for index in range(40):
+            faction = generator.choice(['red', 'blue', 'green'])
+            x, y = generator.randrange(-2, 30), generator.randrange(-2, 30)
+            size = generator.choice([1, 1, 2, 3])
+            for grid, created in zip(grids, entities):
+                entity = make_entity('e%d' % index, faction, x, y, size=size)
+                grid.register_entity(entity)
+                created.append(entity)
+        # Some entities are moved, so registration order differs from creation order
+        for index in range(0, 40, 3):
+            x, y = generator.randrange(30), generator.randrange(30)
+            for grid, created in zip(grids, entities):
+                grid.unregister_entity(created[index])
+                created[index].x, created[index].y = x, y
+                grid.register_entity(created[index])
+
+        def names(items):
+            return [entity.name for entity in items]
+        sparse, dense = grids
+        for y in range(-1, 31):
+            for x in range(-1, 31):
+                assert names(dense.get_threatening_entities(x, y)) == names(sparse.get_threatening_entities(x, y))
+                assert dense.hostile_threats(x, y, 'red') == sparse.hostile_threats(x, y, 'red')
+                for size in (1, 3):
+                    expected = sparse.get_hostile_threateners(x, y, size, 'red')
+                    assert sorted(names(dense.get_hostile_threateners(x, y, size, 'red'))) == sorted(names(expected))
+
+    def test_changes_since(self):
+        grid = Grid(10, 10)
+        revision = grid.revision
+        assert grid.changes_since(revision) == []
+        grid.set_terrain(3, 4, TERRAIN_WALL)
+        assert grid.changes_since(revision) == [(3, 4, 4, 5)]
+        entity = make_entity("red", "red", 5, 5)
+        grid.register_entity(entity)
+        assert len(grid.changes_since(revision)) == 2
+        assert grid.changes_since(-Grid.JOURNAL_SIZE * 2) is None
+
+    def test_incremental_costmap(self):
+        for dense in (False, True):
+            grid = Grid(16, 16, dense=dense)
+            entity = make_entity("red", "red", 5, 5)
+            grid.register_entity(entity)
+            finder = PathFinder()
+            finder.attach_grid(grid, 2, 2, 12, 12)
+
+            grid.set_terrain(4, 4, TERRAIN_WALL)
+            grid.unregister_entity(entity)
+            entity.x = 8
+            grid.register_entity(entity)
+            # Shift the window and sync the changes
+            finder.attach_grid(grid, 3, 2, 13, 12)
+
+            fresh = PathFinder()
+            fresh.attach_grid(grid, 3, 2, 13, 12)
+            assert finder._costmap == fresh._costmap
+
+    def test_clearance(self):
+        for dense in (False, True):
+            grid = Grid(10, 10, dense=dense)
+            # Wall with a gap of 2 tiles
+            for y in range(10):
+                if y not in (4, 5):
+                    grid.set_terrain(5, y, TERRAIN_WALL)
+            small = PathFinder(grid, objsize=2)
+            large = PathFinder(grid, objsize=3)
+            assert small.get_clearance(4, 3) == 1
+            assert small.get_clearance(4, 4) == 2
+            assert small.get_clearance(5, 4) == 2
+            assert small.get_clearance(0, 0) == 5
+            assert small.path_between_tiles(grid.get_tile(1, 4), grid.get_tile(7, 4)) is not None
+            assert large.path_between_tiles(grid.get_tile(1, 4), grid.get_tile(7, 4)) is None
+
+            # Closing the gap is synced incrementally
+            grid.set_terrain(5, 5, TERRAIN_WALL)
+            small.sync_grid(grid)
+            assert small.get_clearance(5, 4) == 1
+            assert small.path_between_tiles(grid.get_tile(1, 4), grid.get_tile(7, 4)) is None
+
+    def test_distance_field(self):
+        for dense in (False, True):
+            grid = Grid(16, 16, dense=dense)
+            for y in range(2, 14):
+                grid.set_terrain(6, y, TERRAIN_WALL)
+            target = make_entity("target", "blue", 10, 10)
+            grid.register_entity(target)
+            cache = DistanceFieldCache(grid)
+            field = cache.get_field(target, 1)
+            assert cache.get_field(target, 1) is field
+            assert len(cache) == 1
+
+            pf = PathFinder(grid)
+            start = Point(x=3, y=8)
+            expected = pf.path_to_melee_range(start, target.get_center(), 0.5, 1.5)
+            path = field.path_from(start)
+            assert path.count() == expected.count()
+            assert path.last().distance_melee(Point(x=10, y=10)) == 1
+            assert field.distance(11, 11) == 0
+            assert field.distance(6, 5) is None
+
+            # Change of the explored area drops the field
+            grid.set_terrain(6, 1, TERRAIN_WALL)
+            assert cache.get_field(target, 1) is not field
+            assert len(cache) == 1
+
+            # Field is kept, when the grid is changed far from the explored area
+            grid = Grid(32, 32, dense=dense)
+            target = make_entity("target", "blue", 4, 4)
+            grid.register_entity(target)
+            cache = DistanceFieldCache(grid)
+            field = cache.get_field(target, 1)
+            assert field.distance(7, 4) == 2 * field.distance(6, 4)
+            grid.set_terrain(30, 30, TERRAIN_WALL)
+            assert cache.get_field(target, 1) is field
+            assert (cache.hits, cache.misses) == (1, 1)
+            # Kept field continues the search on the changed grid
+            grid.set_terrain(29, 4, TERRAIN_WALL)
+            assert cache.get_field(target, 1) is field
+            assert field.distance(29, 4) is None
+            assert field.distance(28, 4) == 23 * field.distance(6, 4)
+            grid.set_terrain(7, 4, TERRAIN_WALL)
+            assert cache.get_field(target, 1) is not field
+
+    def test_big_mover(self):
+        for dense in (False, True):
+            grid = Grid(20, 20, dense=dense)
+            # Mover does not block itself
+            mover = make_entity("big", "red", 2, 2, size=2)
+            grid.register_entity(mover)
+            target = make_entity("target", "blue", 15, 15)
+            grid.register_entity(target)
+            pf = PathFinder(grid, objsize=2)
+            path = pf.path_to_melee_range(mover.get_coord(), target.get_center(), 1, 2)
+            assert path is not None and path.count() == 11
+
+            field = DistanceFieldCache(grid).get_field(target, 1, 2)
+            path = field.path_from(mover.get_coord())
+            assert path is not None and path.count() == 11
+            mover.x, mover.y = path.last()
+            assert mover.distance_melee(target) == 0.5
+            # Walls of its own square still block the mover
+            assert not pf.is_passable(3, 2) and pf.is_passable_from(3, 2, 2, 2)
+            grid.set_terrain(3, 3, TERRAIN_WALL)
+            assert not pf.is_passable_from(3, 2, 2, 2)
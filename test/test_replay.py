@@ -0,0 +1,57 @@
+from unittest import TestCase
+
+from battle_utils import make_twf_fighter, make_angry_guisarme
+from sim.dice import RandomStream, using_stream
+from sim.runner import Scenario, standing_factions
+from sim.combatlog import CombatLog, RoundEnd
+from sim.replay import Replay, ReplayWriter, CombatantState
+import sim.events as events
+
+
+class ReplayTest(TestCase):
+
+    @staticmethod
+    def live_state(battle):
+        return {c.get_name(): CombatantState(c.get_name(), c.get_faction(), c.x, c.y, c.health, c.health_max,
+                                             0, c._status_flags) for c in battle.combatants}
+
+    def test_replay(self):
+        scenario = Scenario(16, 16, max_rounds=30)
+        for index in range(3):
+            scenario.add_combatant(make_twf_fighter, 'r%d' % index, 1 + 2 * index, 1, 'red')
+            scenario.add_combatant(make_angry_guisarme, 'b%d' % index, 14 - 2 * index, 14, 'blue')
+        writer = ReplayWriter(snapshot_interval=2)
+        battle = scenario.create_battle(RandomStream(5), log=CombatLog(writer))
+
+        # Live state at the end of every round
+        states = {0: self.live_state(battle)}
+        with using_stream(battle.rng):
+            for event in battle.battle_generator():
+                if isinstance(event, events.RoundEnd):
+                    states[event.round] = self.live_state(battle)
+                    if len(standing_factions(battle)) <= 1 or event.round >= 30:
+                        break
+
+        replay = Replay(writer.getvalue())
+        assert replay.rounds == battle.round
+        assert replay.header.seed == 5 and replay.header.width == 16
+        assert replay.snapshot_rounds == list(range(0, battle.round + 1, 2))
+        for round, state in states.items():
+            replayed = replay.state_at(round)
+            assert replayed.round == round
+            assert replayed.combatants == state
+        assert list(replay.records())[-1] == RoundEnd(battle.round)
+
+    def test_bad_stream(self):
+        with self.assertRaises(ValueError):
+            Replay(b'not a replay')
+
+    def test_duplicate_names(self):
+        scenario = Scenario(16, 16)
+        scenario.add_combatant(make_twf_fighter, 'A', 1, 1, 'red')
+        scenario.add_combatant(make_angry_guisarme, 'A', 14, 14, 'blue')
+        writer = ReplayWriter()
+        with self.assertRaises(ValueError):
+            scenario.create_battle(RandomStream(5), log=CombatLog(writer))
+        # Stream keeps only valid records
+        assert len(Replay(writer.getvalue()).header.combatants) == 1
@@ -0,0 +1,102 @@
+import time
+from unittest import TestCase
+
+from battle_utils import make_twf_fighter, make_angry_guisarme
+from sim.dice import RandomStream
+from sim.runner import Scenario, OutcomeStats, run_battle, run_battles, summarize
+from sim.montecarlo import run_parallel
+from sim.profiler import Profiler
+
+
+class RunnerTest(TestCase):
+
+    def make_scenario(self):
+        scenario = Scenario(12, 12, max_rounds=20)
+        scenario.add_combatant(make_twf_fighter, 'A', 2, 2, 'red')
+        scenario.add_combatant(make_angry_guisarme, 'B', 9, 9, 'blue')
+        return scenario
+
+    def test_run_battles(self):
+        scenario = self.make_scenario()
+        outcomes = run_battles(scenario, 5, seed=1)
+        assert len(outcomes) == 5
+        for outcome in outcomes:
+            assert outcome.winner in ('red', 'blue', None)
+            assert 1 <= outcome.rounds <= 20
+            assert [c.name for c in outcome.combatants] == ['A', 'B']
+            # Damage dealt by one is damage taken by another
+            a, b = outcome.combatants
+            assert a.damage_dealt == b.health_max - b.health
+            assert b.damage_dealt == a.health_max - a.health
+
+        summary = summarize(outcomes, scenario.factions)
+        assert summary['battles'] == 5
+        wins = sum(stats['wins'] for stats in summary['factions'].values())
+        assert wins + summary['draws'] == 5
+
+    def test_seed(self):
+        scenario = self.make_scenario()
+        first = [o.to_dict() for o in run_battles(scenario, 3, seed=7)]
+        second = [o.to_dict() for o in run_battles(scenario, 3, seed=7)]
+        assert first == second
+
+    def test_battle_stream(self):
+        scenario = self.make_scenario()
+        first = run_battle(scenario, rng=RandomStream(21)).to_dict()
+        assert run_battle(scenario, rng=RandomStream(21)).to_dict() == first
+
+    def test_parallel(self):
+        scenario = self.make_scenario()
+        serial = run_parallel(scenario, 12, seed=3, workers=1, shard_size=5)
+        parallel = run_parallel(scenario, 12, seed=3, workers=2, shard_size=5)
+        assert serial.battles == 12
+        assert serial.to_dict() == parallel.to_dict()
+        assert sum(serial.rounds_histogram.values()) == 12
+
+    def test_win_interval(self):
+        stats = OutcomeStats(['red', 'blue'])
+        stats.battles = 100
+        stats.wins['red'] = 50
+        low, high = stats.win_interval('red')
+        assert abs(low - 0.4038) < 1e-3
+        assert abs(high - 0.5962) < 1e-3
+        assert stats.win_interval('blue')[0] == 0.0
+
+    def test_profiler(self):
+        scenario = self.make_scenario()
+        profiler = Profiler()
+        outcome = run_battle(scenario, rng=RandomStream(3), profiler=profiler)
+        report = profiler.to_dict()
+        for phase in ('prepare_turn', 'make_turn', 'pathfinding', 'grid_register'):
+            assert report['phases'][phase]['calls'] > 0
+        assert set(report['combatants']) == {'A', 'B'}
+        assert max(report['rounds']) == outcome.rounds
+        trace = profiler.to_chrome_trace()['traceEvents']
+        assert all(event['dur'] >= 0 for event in trace if event['ph'] == 'X')
+        # Profiling does not change the battle
+        assert outcome.to_dict() == run_battle(scenario, rng=RandomStream(3)).to_dict()
+        # Nested phases are not counted twice
+        make_turn = report['phases']['make_turn']
+        assert make_turn['time'] < make_turn['inclusive']
+
+    def test_profiler_nested(self):
+        profiler = Profiler()
+
+        def steps():
+            for _ in range(2):
+                with profiler.section('inner'):
+                    time.sleep(0.01)
+                yield None
+
+        with profiler.section('outer'):
+            with profiler.section('inner'):
+                time.sleep(0.02)
+        list(profiler.wrap_generator(steps(), 'generator'))
+        phases = profiler.to_dict()['phases']
+        assert phases['inner']['calls'] == 3 and phases['inner']['time'] >= 0.04
+        assert phases['outer']['inclusive'] >= 0.02 and phases['outer']['time'] < 0.01
+        assert phases['generator']['calls'] == 1
+        assert phases['generator']['inclusive'] >= 0.02 and phases['generator']['time'] < 0.01
+        # Own times add up to the time of the top level sections
+        total = sum(phase['time'] for phase in phases.values())
+        assert abs(total - phases['outer']['inclusive'] - phases['generator']['inclusive']) < 1e-9
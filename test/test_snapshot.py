@@ -0,0 +1,73 @@
+from unittest import TestCase
+
+from battle_utils import make_twf_fighter, make_angry_guisarme
+from sim.core import STATUS_STUNNED
+from dnd.styles import StyleDefenciveFight
+from sim.combatlog import NULL_LOG
+from sim.dice import RandomStream, using_stream
+from sim.runner import Scenario, standing_factions
+import sim.events as events
+
+
+class SnapshotTest(TestCase):
+
+    def make_battle(self):
+        scenario = Scenario(16, 16, max_rounds=30)
+        for index in range(3):
+            scenario.add_combatant(make_twf_fighter, 'r%d' % index, 1 + 2 * index, 1, 'red')
+            scenario.add_combatant(make_angry_guisarme, 'b%d' % index, 14 - 2 * index, 14, 'blue')
+        return scenario.create_battle(RandomStream(5), log=NULL_LOG)
+
+    # Play some rounds and get the state of combatants at the end of each round
+    @staticmethod
+    def play(battle, rounds):
+        trace = []
+        with using_stream(battle.rng):
+            for event in battle.battle_generator():
+                if isinstance(event, events.RoundEnd):
+                    trace.append([(c.x, c.y, c.health, set(c._status_flags)) for c in battle.combatants])
+                    if len(standing_factions(battle)) <= 1 or event.round >= rounds:
+                        break
+        return trace
+
+    def test_restore(self):
+        battle = self.make_battle()
+        self.play(battle, 1)
+        snapshot = battle.save_snapshot()
+        combatant = battle.combatants[0]
+        position = (combatant.x, combatant.y)
+        flags = set(combatant._status_flags)
+
+        first = self.play(battle, 8)
+        assert battle.round > 1
+        battle.restore_snapshot(snapshot)
+        assert battle.round == 1
+        assert (combatant.x, combatant.y) == position
+        assert battle.grid.get_tile(*position).occupation == [combatant]
+        # Rewound battle goes exactly the same way
+        assert self.play(battle, 8) == first
+
+        # The same snapshot can be restored many times
+        combatant.add_status_flag(STATUS_STUNNED)
+        combatant.receive_damage(100, battle.combatants[1])
+        battle.restore_snapshot(snapshot)
+        assert combatant._status_flags == flags
+        assert combatant.is_consciousness()
+        assert self.play(battle, 8) == first
+
+    def test_restore_style(self):
+        battle = self.make_battle()
+        combatant = battle.combatants[0]
+        armor_class = combatant.get_armor_class()
+        style = StyleDefenciveFight()
+        combatant.activate_style(style)
+        assert combatant.get_armor_class() == armor_class + 2
+        snapshot = battle.save_snapshot()
+
+        # Rewind across deactivation of the style
+        combatant.deactivate_style(style)
+        assert combatant.get_armor_class() == armor_class
+        battle.restore_snapshot(snapshot)
+        assert combatant.get_armor_class() == armor_class + 2
+        combatant.deactivate_style(style)
+        assert combatant.get_armor_class() == armor_class
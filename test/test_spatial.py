@@ -0,0 +1,81 @@
+import math
+import random
+from unittest import TestCase
+
+from battle_utils import make_twf_fighter, make_angry_guisarme
+from sim.combatlog import NULL_LOG
+from sim.dice import RandomStream, using_stream
+from sim.entity import Entity
+from sim.runner import Scenario, standing_factions
+from sim.spatial import SpatialIndex
+import sim.events as events
+
+
+class SpatialIndexTest(TestCase):
+
+    @staticmethod
+    def make_entities(count, size=40):
+        generator = random.Random(7)
+        entities = []
+        for index in range(count):
+            entity = Entity('e%d' % index, size=generator.choice([1, 1, 2]))
+            entity.x = generator.randrange(size)
+            entity.y = generator.randrange(size)
+            entities.append(entity)
+        return entities
+
+    @staticmethod
+    def center(entity):
+        return entity.x + entity.get_size() * 0.5, entity.y + entity.get_size() * 0.5
+
+    def test_queries(self):
+        entities = self.make_entities(200)
+        index = SpatialIndex(cell_size=3)
+        for entity in entities:
+            index.insert(entity)
+        # Move some entities and remove others
+        for entity in entities[:20]:
+            entity.x = (entity.x + 17) % 40
+            index.move(entity)
+        for entity in entities[20:40]:
+            index.remove(entity)
+        alive = [entity for entity in entities if entity in index]
+        assert len(index) == len(alive) == 180
+
+        even = lambda entity: int(entity.name[1:]) % 2 == 0
+        for x, y in [(0, 0), (20.5, 13), (39, 39), (-10, 55)]:
+            def chebyshev(entity):
+                ex, ey = self.center(entity)
+                return max(abs(ex - x), abs(ey - y))
+            for radius in [0.5, 4, 11]:
+                expected = [e for e in alive if math.hypot(self.center(e)[0] - x, self.center(e)[1] - y) <= radius]
+                assert set(index.within(x, y, radius)) == set(expected)
+            for count in [1, 5, 30]:
+                expected = sorted([e for e in alive if even(e)], key=chebyshev)[:count]
+                found = index.nearest(x, y, count, even)
+                assert [chebyshev(e) for e in found] == [chebyshev(e) for e in expected]
+        assert SpatialIndex().nearest(0, 0, 3) == []
+
+    def test_battle(self):
+        scenario = Scenario(16, 16, max_rounds=30)
+        scenario.add_combatant(make_twf_fighter, 'r0', 1, 1, 'red')
+        scenario.add_combatant(make_angry_guisarme, 'b0', 14, 14, 'blue')
+        scenario.add_combatant(make_angry_guisarme, 'b1', 4, 2, 'blue')
+        battle = scenario.create_battle(RandomStream(5), log=NULL_LOG)
+        red, far, near = battle.combatants
+        assert battle.find_enemy(red) is near
+        assert battle.nearest_enemies(red, 5) == [near, far]
+        assert battle.find_enemies(red, 20) == [near]
+
+        # Index follows the moves
+        with using_stream(battle.rng):
+            for event in battle.battle_generator():
+                if isinstance(event, events.RoundEnd):
+                    for combatant in battle.combatants:
+                        center = combatant.get_center()
+                        assert combatant in battle.spatial.within(center.x, center.y, 0)
+                    if len(standing_factions(battle)) <= 1 or event.round >= 5:
+                        break
+        battle.remove_combatant(near)
+        assert near not in battle.spatial
+        assert battle.nearest_enemies(red, 5) == ([far] if far.is_consciousness() else [])